@@ -5,8 +5,14 @@
 
 import math as m
 import Utility as u 
+import DepositCurve as dc
 import enum
 import unittest
+import collections
+import copy
+import pickle
+import numpy as np
+import scipy.special as ss
 
 
 class OptionType(enum.Enum):
@@ -25,16 +31,416 @@ class ExoticType(enum.Enum):
     DownInEu = 6
     UpOutEu = 7
     UpInEu = 8
+
+
+def GetOptionSign(optionType):
+    # Returns +1.0 for calls and -1.0 for puts. optionType is either an OptionType or an array 
+    # of OptionTypes/OptionType values (1 = Put, 2 = Call), in which case an array of signs is returned
+    if isinstance(optionType, OptionType):
+        return -1.0 if optionType == OptionType.Put else 1.0
+
+    types = np.asarray(optionType)
+    if (types.dtype == object):
+        types = np.vectorize(lambda t: t.value if isinstance(t, OptionType) else t, otypes=[int])(types)
+
+    return np.where(types == OptionType.Put.value, -1.0, 1.0)
+
+
+def GetArrayd1d2(spot, strike, expiryTerm, depositDomestic, depositForeign, volatility):
+    # Vectorized version of Vanilla.Getd1()/Getd2(). Inputs are broadcast against each other. 
+    # As for the scalar version d1 is set to zero where spot, strike, volatility or expiry is not positive
+    s0, K, T = np.asarray(spot, dtype=float), np.asarray(strike, dtype=float), np.asarray(expiryTerm, dtype=float)
+    r, d, vol = np.asarray(depositDomestic, dtype=float), np.asarray(depositForeign, dtype=float), np.asarray(volatility, dtype=float)
+
+    valid = (s0 > 0.0) & (K > 0.0) & (vol > 0.0) & (T > 0.0)
+    rootT = np.sqrt(np.maximum(T, 0.0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = np.where(valid, (np.log(s0/K) + (r - d + 0.5*vol*vol)*T)/(vol*rootT), 0.0)
+
+    return d1, d1 - vol*rootT
+
+
+def GarmanKohlhagenValue(spot, strike, expiryTerm, depositDomestic, depositForeign, volatility, optionType):
+    """   Garman-Kohlhagen premium for arrays of options in one vectorized pass. Spot, strike, 
+        expiry, deposits, volatility and optionType are broadcast against each other (NumPy rules),
+        so e.g. one spot and an array of strikes/vols may be priced in one call. optionType is an
+        OptionType or an array of OptionType values (see GetOptionSign).
+    """
+    s0, K, T = np.asarray(spot, dtype=float), np.asarray(strike, dtype=float), np.asarray(expiryTerm, dtype=float)
+    r, d = np.asarray(depositDomestic, dtype=float), np.asarray(depositForeign, dtype=float)
+    sign = GetOptionSign(optionType)
+    d1, d2 = GetArrayd1d2(s0, K, T, r, d, volatility)
+
+    return sign * (np.exp(-d * T) * s0 * u.NormCdf(sign * d1) - np.exp(-r * T) * K * u.NormCdf(sign * d2))
     
     
+# Option value and all Greeks calculated from one shared set of intermediates (d1, d2, discount factors). 
+# The fields are floats (Vanilla.GetAllGreeks) or arrays (GarmanKohlhagenGreeks)
+Greeks = collections.namedtuple('Greeks', ['value', 'domesticSpotDelta', 'gamma', 'vega', 'vanna', 'volga', 'theta',
+                                           'dualDelta', 'dualGamma', 'dualVega'])
+
+
+def GreeksFromIntermediates(s0, K, r, q, vol, rootT, sign, d1, d2, dfDomestic, dfForeign, Phi_d1, Phi_d2, phi_d1, phi_d2):
+    # Greeks tuple from d1/d2, the discount factors and Phi(sign*d1), Phi(sign*d2), phi(d1), phi(d2). Plain arithmetic
+    # only, so the same formulas serve floats (GarmanKohlhagenGreeksScalar) and arrays (GarmanKohlhagenGreeks)
+    vega = s0 * dfForeign * rootT * phi_d1
+    return Greeks(value = sign * (dfForeign * s0 * Phi_d1 - dfDomestic * K * Phi_d2),
+                  domesticSpotDelta = sign * dfForeign * Phi_d1,
+                  gamma = dfForeign * phi_d1 / (s0 * vol * rootT),
+                  vega = vega,
+                  vanna = -dfForeign * d2 / vol * phi_d1,
+                  volga = vega * d1 * d2 / vol,
+                  theta = (-s0 * dfForeign * phi_d1 * vol / (2.0 * rootT) + sign * q * s0 * Phi_d1 * dfForeign 
+                           - sign * r * K * dfDomestic * Phi_d2),
+                  dualDelta = -sign * dfDomestic * Phi_d2,
+                  dualGamma = dfDomestic * phi_d2 / (K * vol * rootT),
+                  dualVega = s0 / K * dfForeign * d1 / vol * phi_d1)
+
+
+def GarmanKohlhagenGreeks(spot, strike, expiryTerm, depositDomestic, depositForeign, volatility, optionType):
+    """   Vectorized option value and Greeks. Inputs are broadcast as in GarmanKohlhagenValue() and
+        a Greeks tuple of arrays is returned. Entries with non-positive expiry, volatility, spot or 
+        strike are returned as nan/inf rather than raising as the scalar Greeks of Vanilla do.
+    """
+    s0, K, T = np.asarray(spot, dtype=float), np.asarray(strike, dtype=float), np.asarray(expiryTerm, dtype=float)
+    r, q, vol = np.asarray(depositDomestic, dtype=float), np.asarray(depositForeign, dtype=float), np.asarray(volatility, dtype=float)
+    sign = GetOptionSign(optionType)
+    d1, d2 = GetArrayd1d2(s0, K, T, r, q, vol)
+
+    rootT = np.sqrt(np.maximum(T, 0.0))
+    dfDomestic = np.exp(-r * T)
+    dfForeign = np.exp(-q * T)
+    Phi_d1 = u.NormCdf(sign * d1)
+    Phi_d2 = u.NormCdf(sign * d2)
+    phi_d1 = u.Constants._OneOverRootTwoPi * np.exp(-0.5 * d1 * d1)
+    phi_d2 = u.Constants._OneOverRootTwoPi * np.exp(-0.5 * d2 * d2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return GreeksFromIntermediates(s0, K, r, q, vol, rootT, sign, d1, d2, dfDomestic, dfForeign, Phi_d1, Phi_d2, phi_d1, phi_d2)
+
+
+def NormalizedBlackOTM(x, s):
+    # Normalised out-of-the-money Black price b(x, s) = exp(x/2)N(x/s + s/2) - exp(-x/2)N(x/s - s/2) for x = ln(F/K) <= 0
+    # and s = vol*sqrt(T) > 0. For x/s + s/2 < 0 both terms are tiny and the difference is formed from erfcx() with 
+    # the common factor exp(-(h^2 + t^2)/2) pulled out, which avoids the underflow/cancellation of the plain formula
+    h = x / s
+    t = 0.5 * s
+    with np.errstate(over='ignore', invalid='ignore'):
+        b_erfcx = 0.5 * np.exp(-0.5 * (h * h + t * t)) * (ss.erfcx(-(h + t) / u.Constants._SqrtTwo) - ss.erfcx(-(h - t) / u.Constants._SqrtTwo))
+        b_direct = np.exp(0.5 * x) * u.NormCdf(h + t) - np.exp(-0.5 * x) * u.NormCdf(h - t)
+
+    return np.where(h + t < 0.0, b_erfcx, b_direct)
+
+
+def NormalizedBlackOTMScalar(x, s):
+    # Scalar version of NormalizedBlackOTM()
+    h = x / s
+    t = 0.5 * s
+    if (h + t < 0.0):
+        return 0.5 * m.exp(-0.5 * (h * h + t * t)) * float(ss.erfcx(-(h + t) / u.Constants._SqrtTwo) - ss.erfcx(-(h - t) / u.Constants._SqrtTwo))
+    else:
+        return 0.5 * (m.exp(0.5 * x) * m.erfc(-(h + t) / u.Constants._SqrtTwo) - m.exp(-0.5 * x) * m.erfc(-(h - t) / u.Constants._SqrtTwo))
+
+
+def ImpliedVolatility(price, spot, strike, expiryTerm, depositDomestic, depositForeign, optionType, accuracy=1.0e-12, maxIterations=30):
+    """   Implied Garman-Kohlhagen volatility, in the spirit of P. Jaeckel, "Let's be rational" (2015).
+        The price is normalised to the out-of-the-money time value b of the normalised Black function.
+        The inflection point s_c = sqrt(2|x|) of b(s) splits the problem in a lower and an upper branch:
+        - upper branch (b >= b(s_c)): objective b(s) - b
+        - lower branch (b <  b(s_c)): objective 1/ln(b) - 1/ln(b(s)), which is close to linear in s
+        The initial guess is the better of the small-s (ln b ~ -x^2/(2s^2)) and the large-s asymptotic 
+        guesses. It is refined by third order Householder (Halley) steps safeguarded by a bracket that is
+        tightened on every iteration, so deep ITM/OTM and near-expiry options converge as well. 
+        Typically 3-4 iterations give full double precision.
+        Inputs are broadcast as for GarmanKohlhagenValue(). Prices outside the no-arbitrage bounds 
+        return nan, a price equal to the intrinsic value (within round-off) returns 0.0.
+    """
+    if (isinstance(optionType, OptionType) and all(np.ndim(v) == 0 for v in [price, spot, strike, expiryTerm, depositDomestic, depositForeign])):
+        return ImpliedVolatilityScalar(price, spot, strike, expiryTerm, depositDomestic, depositForeign, optionType, accuracy, maxIterations)
+
+    p, s0, K = np.asarray(price, dtype=float), np.asarray(spot, dtype=float), np.asarray(strike, dtype=float)
+    T, r, q = np.asarray(expiryTerm, dtype=float), np.asarray(depositDomestic, dtype=float), np.asarray(depositForeign, dtype=float)
+    sign = GetOptionSign(optionType)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        forward = s0 * np.exp((r - q) * T)
+        x = np.log(forward / K)
+        beta = p / (np.exp(-r * T) * np.sqrt(forward * K))
+
+        # Out-of-the-money time value via put-call parity. A time value within round-off of zero is intrinsic
+        tolerance = 1.0e-14 * beta
+        beta = beta - np.maximum(sign * (np.exp(0.5 * x) - np.exp(-0.5 * x)), 0.0)
+        x = -np.abs(x)
+        bmax = np.exp(0.5 * x)
+        valid = (beta > 0.0) & (beta < bmax) & (T > 0.0)
+        intrinsic = (beta <= 0.0) & (beta >= -tolerance) & (T > 0.0)
+        beta = np.where(valid, beta, 0.5 * bmax)
+        logbeta = np.log(beta)
+
+        sc = np.sqrt(-2.0 * x)
+        bc = np.where(sc > 0.0, NormalizedBlackOTM(x, np.where(sc > 0.0, sc, 1.0)), 0.0)
+        upper = beta >= bc
+
+        # Initial guess: best of the two asymptotic guesses, restricted to the branch of the root
+        s_large = -2.0 * ss.ndtri((bmax - beta) / (bmax + 1.0 / bmax))
+        s_small = -x / np.sqrt(-2.0 * logbeta)
+        lo = np.where(upper, sc, 0.0)
+        hi = np.where(upper, np.inf, sc)
+        s_large = np.where(s_large > lo, np.minimum(s_large, hi), sc)
+        s_small = np.where(s_small > lo, np.minimum(s_small, hi), sc)
+        s_large = np.where(s_large > 0.0, s_large, 1.0)
+        s_small = np.where(s_small > 0.0, s_small, 1.0)
+        err_large = np.abs(np.log(NormalizedBlackOTM(x, s_large)) - logbeta)
+        err_small = np.abs(np.log(NormalizedBlackOTM(x, s_small)) - logbeta)
+        s = np.where(err_small < err_large, s_small, s_large)
+
+        i = 0
+        while (i < maxIterations):
+            b = NormalizedBlackOTM(x, s)
+            vega = u.Constants._OneOverRootTwoPi * np.exp(-0.5 * (x * x / (s * s) + 0.25 * s * s))
+            c = x * x / (s * s * s) - 0.25 * s    # b''/b'
+            logb = np.log(b)
+            dlogb = vega / b
+            d2logb = dlogb * (c - dlogb)
+
+            f = np.where(upper, b - beta, 1.0 / logbeta - 1.0 / logb)
+            f1 = np.where(upper, vega, dlogb / (logb * logb))
+            f2 = np.where(upper, vega * c, d2logb / (logb * logb) - 2.0 * dlogb * dlogb / (logb * logb * logb))
+
+            lo = np.where(f < 0.0, s, lo)
+            hi = np.where(f > 0.0, s, hi)
+
+            newton = -f / f1
+            halley = newton / (1.0 - 0.5 * newton * f2 / f1)
+            ds = np.where(np.isfinite(halley) & (np.abs(halley) <= 2.0 * np.abs(newton)), halley, newton)
+            s_new = s + ds
+            converged = (np.abs(ds) <= accuracy * s) | (f == 0.0)
+            outside = ~((s_new > lo) & (s_new < hi)) & ~converged
+            s_new = np.where(outside, np.where(np.isinf(hi), 2.0 * s, 0.5 * (lo + hi)), s_new)
+            s = np.where(f == 0.0, s, s_new)
+            if (converged | ~valid).all():
+                break
+            i += 1
+
+        vol = np.where(valid, s / np.sqrt(T), np.nan)
+
+    return np.where(intrinsic, 0.0, vol)
+
+
+def ImpliedVolatilityScalar(price, spot, strike, expiryTerm, depositDomestic, depositForeign, optionType: OptionType, accuracy=1.0e-12, maxIterations=30):
+    # Scalar version of ImpliedVolatility() in plain Python floats (same algorithm, no NumPy array overhead)
+    if not (expiryTerm > 0.0 and spot > 0.0 and strike > 0.0):
+        return m.nan
+
+    sign = GetOptionSign(optionType)
+    forward = spot * m.exp((depositDomestic - depositForeign) * expiryTerm)
+    x = m.log(forward / strike)
+    beta = price / (m.exp(-depositDomestic * expiryTerm) * m.sqrt(forward * strike))
+    tolerance = 1.0e-14 * beta
+    beta -= max(sign * (m.exp(0.5 * x) - m.exp(-0.5 * x)), 0.0)
+    x = -abs(x)
+    bmax = m.exp(0.5 * x)
+
+    if (beta <= 0.0 and beta >= -tolerance):
+        return 0.0
+    elif (beta < 0.0 or beta >= bmax):
+        return m.nan
+
+    logbeta = m.log(beta)
+    sc = m.sqrt(-2.0 * x)
+    bc = NormalizedBlackOTMScalar(x, sc) if sc > 0.0 else 0.0
+    upper = beta >= bc
+    lo, hi = (sc, m.inf) if upper else (0.0, sc)
+
+    guesses = []
+    for guess in [-2.0 * float(ss.ndtri((bmax - beta) / (bmax + 1.0 / bmax))), -x / m.sqrt(-2.0 * logbeta)]:
+        guess = min(guess, hi) if guess > lo else sc
+        guess = guess if guess > 0.0 else 1.0
+        b = NormalizedBlackOTMScalar(x, guess)
+        guesses.append((abs(m.log(b) - logbeta) if b > 0.0 else m.inf, guess))
+    s = min(guesses)[1]
+
+    i = 0
+    while (i < maxIterations):
+        b = NormalizedBlackOTMScalar(x, s)
+        vega = u.Constants._OneOverRootTwoPi * m.exp(-0.5 * (x * x / (s * s) + 0.25 * s * s))
+        c = x * x / (s * s * s) - 0.25 * s
+        if (upper):
+            f, f1, f2 = b - beta, vega, vega * c
+        elif (b > 0.0):
+            logb = m.log(b)
+            dlogb = vega / b
+            f = 1.0 / logbeta - 1.0 / logb
+            f1 = dlogb / (logb * logb)
+            f2 = dlogb * (c - dlogb) / (logb * logb) - 2.0 * dlogb * dlogb / (logb * logb * logb)
+        else:
+            f, f1, f2 = -1.0, 0.0, 0.0
+
+        if (f == 0.0):
+            break
+        elif (f < 0.0):
+            lo = s
+        else:
+            hi = s
+
+        ds = m.nan
+        if (f1 > 0.0):
+            ds = -f / f1
+            halley = ds / (1.0 - 0.5 * ds * f2 / f1)
+            if (abs(halley) <= 2.0 * abs(ds)):
+                ds = halley
+
+        if (abs(ds) <= accuracy * s):
+            s += ds
+            break
+        elif (lo < s + ds < hi):
+            s += ds
+        else:
+            s = 2.0 * s if m.isinf(hi) else 0.5 * (lo + hi)
+        i += 1
+
+    return s / m.sqrt(expiryTerm)
+
+
+def GarmanKohlhagenValueScalar(spot, strike, expiryTerm, depositDomestic, depositForeign, volatility, optionType: OptionType):
+    # Plain float Garman-Kohlhagen value. Same conventions as Vanilla.GetOptionValueSVO() (d1 = 0 for
+    # non-positive inputs) but without touching any object state
+    if (spot > 0 and strike > 0 and volatility > 0 and expiryTerm > 0):
+        d1 = (m.log(spot/strike) + (depositDomestic - depositForeign + 0.5*volatility*volatility)*expiryTerm)/(volatility*m.sqrt(expiryTerm))
+    else:
+        d1 = 0.0
+    d2 = d1 - volatility*m.sqrt(expiryTerm)
+    sign = GetOptionSign(optionType)
+
+    return sign * (m.exp(-depositForeign * expiryTerm) * spot * u.NormCdf(sign * d1) - m.exp(-depositDomestic * expiryTerm) * strike * u.NormCdf(sign * d2))
+
+
+def GarmanKohlhagenGreeksScalar(spot, strike, expiryTerm, depositDomestic, depositForeign, volatility, optionType: OptionType):
+    # Plain float option value and all Greeks from one set of intermediates, see Vanilla.GetAllGreeks()
+    s0 = spot
+    K = strike
+    r = depositDomestic
+    q = depositForeign
+    vol = volatility
+    T = expiryTerm
+
+    if not (vol > 0.0 and T > 0.0 and s0 > 0.0 and K > 0.0):
+        raise ValueError("Expiry term + volatility + spot + strike needs to be positive - GarmanKohlhagenGreeksScalar")
+
+    sign = GetOptionSign(optionType)
+    rootT = m.sqrt(T)
+    d1 = (m.log(s0/K) + (r - q + 0.5*vol*vol)*T)/(vol*rootT)
+    d2 = d1 - vol*rootT
+    dfDomestic = m.exp(-r * T)
+    dfForeign = m.exp(-q * T)
+    Phi_d1 = u.NormCdf(sign * d1)
+    Phi_d2 = u.NormCdf(sign * d2)
+    phi_d1 = u.Constants._OneOverRootTwoPi * m.exp(-0.5 * d1 * d1)
+    phi_d2 = u.Constants._OneOverRootTwoPi * m.exp(-0.5 * d2 * d2)
+
+    return GreeksFromIntermediates(s0, K, r, q, vol, rootT, sign, d1, d2, dfDomestic, dfForeign, Phi_d1, Phi_d2, phi_d1, phi_d2)
+
+
+class MarketState:
+    """   Immutable FX market state: spot and continuously compounded domestic/foreign deposits.
+        Instances use __slots__ (no per-object __dict__) and can be shared between threads.
+    """
+    __slots__ = ('spot', 'depositDomestic', 'depositForeign')
+
+    def __init__(self, spot, depositDomestic, depositForeign):
+        object.__setattr__(self, 'spot', float(spot))
+        object.__setattr__(self, 'depositDomestic', float(depositDomestic))
+        object.__setattr__(self, 'depositForeign', float(depositForeign))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MarketState is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('MarketState is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, MarketState) and self._Key() == other._Key()
+
+    def __hash__(self):
+        return hash(self._Key())
+
+    def __repr__(self):
+        return 'MarketState(spot=%r, depositDomestic=%r, depositForeign=%r)' % self._Key()
+
+    def __reduce__(self):
+        # copy/deepcopy/pickle rebuild through __init__ (attributes cannot be set on an existing instance)
+        return (MarketState, self._Key())
+
+    def _Key(self):
+        return (self.spot, self.depositDomestic, self.depositForeign)
+
+    def GetForward(self, expiryTerm):
+        return self.spot * m.exp((self.depositDomestic - self.depositForeign) * expiryTerm)
+
+
+class VanillaContract:
+    """   Immutable vanilla option contract: strike, expiry (in years) and Put/Call.
+    """
+    __slots__ = ('strike', 'expiryTerm', 'optionType')
+
+    def __init__(self, strike, expiryTerm, optionType: OptionType):
+        object.__setattr__(self, 'strike', float(strike))
+        object.__setattr__(self, 'expiryTerm', float(expiryTerm))
+        object.__setattr__(self, 'optionType', optionType)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('VanillaContract is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('VanillaContract is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, VanillaContract) and self._Key() == other._Key()
+
+    def __hash__(self):
+        return hash(self._Key())
+
+    def __repr__(self):
+        return 'VanillaContract(strike=%r, expiryTerm=%r, optionType=%r)' % self._Key()
+
+    def __reduce__(self):
+        return (VanillaContract, self._Key())
+
+    def _Key(self):
+        return (self.strike, self.expiryTerm, self.optionType)
+
+
+# Pure pricing functions on MarketState/VanillaContract. They never modify their inputs, so one 
+# market state/contract may be valued concurrently from many threads without locking
+def VanillaValue(market: MarketState, contract: VanillaContract, volatility):
+    return GarmanKohlhagenValueScalar(market.spot, contract.strike, contract.expiryTerm, market.depositDomestic, 
+                                      market.depositForeign, volatility, contract.optionType)
+
+
+def VanillaGreeks(market: MarketState, contract: VanillaContract, volatility):
+    return GarmanKohlhagenGreeksScalar(market.spot, contract.strike, contract.expiryTerm, market.depositDomestic, 
+                                       market.depositForeign, volatility, contract.optionType)
+
+
+def VanillaImpliedVolatility(market: MarketState, contract: VanillaContract, price):
+    return ImpliedVolatility(price, market.spot, contract.strike, contract.expiryTerm, market.depositDomestic, 
+                             market.depositForeign, contract.optionType)
+
+
 class GarmanKohlhagen:
     def __init__(self, spot, strike, expiryTerm, depositDomestic, depositForeign, volatility):
+        # Deposits: floats or DepositCurve objects (read at expiryTerm)
         self._spot = spot
         self._strike = strike
         self._expiryTerm = expiryTerm
-        self._depositDomestic = depositDomestic
-        self._depositForeign = depositForeign
+        self._depositDomestic = dc.GetDeposit(depositDomestic, expiryTerm)
+        self._depositForeign = dc.GetDeposit(depositForeign, expiryTerm)
         self._volatility = volatility
+        
+        # Discount factors are fixed for the object, the Greeks below reuse them
+        self._discountDomestic = m.exp(-self._depositDomestic * expiryTerm)
+        self._discountForeign = m.exp(-self._depositForeign * expiryTerm)
 
 
 class Vanilla(GarmanKohlhagen):  
@@ -63,9 +469,6 @@ class Vanilla(GarmanKohlhagen):
         
         self._strike = strike
         s0 = self._spot        
-        r = self._depositDomestic
-        d = self._depositForeign
-        T = self._expiryTerm
         d1 = self.Getd1(volatility)
         d2 = self.Getd2(volatility)
         
@@ -73,7 +476,7 @@ class Vanilla(GarmanKohlhagen):
         if (optionType == OptionType.Put):
             sign = -1.0
         
-        return sign * (m.exp(-d * T) * s0 * u.Norm().cdf(sign * d1) - m.exp(-r * T) * strike * u.Norm().cdf(sign * d2))
+        return sign * (self._discountForeign * s0 * u.NormCdf(sign * d1) - self._discountDomestic * strike * u.NormCdf(sign * d2))
 
     
     def GetBaseOptionValue(self, optionType: OptionType, volatility):        
@@ -87,42 +490,64 @@ class Vanilla(GarmanKohlhagen):
     def GetOptionValue(self, optionType: OptionType):        
         return self.GetBaseOptionValue(optionType, self._volatility)
 
+
+    def GetOptionValueArray(self, strikes, volatilities, optionTypes):
+        # Vectorized GetOptionValueSVO(): values arrays of strikes/vols/option types on the market
+        # data of this object. Unlike GetOptionValueSVO() the object is not modified
+        return GarmanKohlhagenValue(self._spot, strikes, self._expiryTerm, self._depositDomestic, 
+                                    self._depositForeign, volatilities, optionTypes)
+
         
-    def ObjectFuncImpliedVol(self, volatility):                
-        return self.GetBaseOptionValue(self._optionType, volatility) - self._targetValue        
-        
-        
+    def GetAllGreeks(self, optionType: OptionType):
+        # Option value plus all Greeks below in one pass: d1/d2, the discount factors and the normal
+        # density/distribution values are only calculated once. Returns a Greeks tuple of floats
+        return GarmanKohlhagenGreeksScalar(self._spot, self._strike, self._expiryTerm, self._depositDomestic, 
+                                           self._depositForeign, self._volatility, optionType)
+
+
+    def GetAllGreeksArray(self, strikes, volatilities, optionTypes):
+        # Vectorized GetAllGreeks() for arrays of strikes/vols/option types on the market data of this object
+        return GarmanKohlhagenGreeks(self._spot, strikes, self._expiryTerm, self._depositDomestic, 
+                                     self._depositForeign, volatilities, optionTypes)
+
+
     def GetImpliedVolatility(self, targetValue: float, optionType: OptionType):        
-        low = 0.001
-        high = 0.90
-        self._optionType = optionType
-        self._targetValue = targetValue
         
-        return u.bisection(self.ObjectFuncImpliedVol, low, high, 0.000000001, 50)
+        vol = float(ImpliedVolatility(targetValue, self._spot, self._strike, self._expiryTerm, 
+                                      self._depositDomestic, self._depositForeign, optionType))
+        if (m.isnan(vol)):
+            raise ValueError('No implied volatility for this target value: GarmanKohlhagen->Vanilla->GetImpliedVolatility')
+        
+        return vol
+
+
+    def GetImpliedVolatilityArray(self, targetValues, strikes, optionTypes):
+        # Vectorized GetImpliedVolatility() for arrays of prices/strikes/option types on the market data of this object
+        return ImpliedVolatility(targetValues, self._spot, strikes, self._expiryTerm, 
+                                 self._depositDomestic, self._depositForeign, optionTypes)
 
 
     def GetDomesticSpotDelta(self, optionType: OptionType):        
             
-        q = self._depositForeign
         sign = 1.0        
         if (optionType == OptionType.Put):
             sign = -1.0
     
         d1 = self.Getd1(self._volatility)
-        signPhi_d1 = u.Norm().cdf(sign * d1)
+        signPhi_d1 = u.NormCdf(sign * d1)
 
-        return sign * m.exp(-q * self._expiryTerm) * signPhi_d1
+        return sign * self._discountForeign * signPhi_d1
 
 
     def GetGamma(self):
         retval = 0
         d1 = self.Getd1(self._volatility)
-        phi_d1 = u.Norm().pdf(d1)
+        phi_d1 = u.NormPdf(d1)
         variance = self._volatility * self._volatility * self._expiryTerm
         rootVariance = m.sqrt(variance)
 
         if ((self._volatility > 0.0) and (self._expiryTerm > 0.0) and (self._spot > 0.0)):
-            retval = 1.0 / (rootVariance * self._spot) * m.exp(- self._depositForeign * self._expiryTerm) * phi_d1
+            retval = 1.0 / (rootVariance * self._spot) * self._discountForeign * phi_d1
         else:
             raise ValueError("Expiry term + volatility + spot needs to be positive - GarmanKohlhagen->Vanilla->GetGamma")
 
@@ -137,13 +562,13 @@ class Vanilla(GarmanKohlhagen):
         if (optiontype == OptionType.Put):
             sign = -1.0
         
-        return -sign*m.exp(-self._depositDomestic*self._expiryTerm)*u.Norm().cdf(sign*d2)
+        return -sign*self._discountDomestic*u.NormCdf(sign*d2)
 
 
     def GetDualGamma(self):
         d2 = self.Getd2(self._volatility)
         try:
-            return m.exp(-self._depositDomestic*self._expiryTerm)*u.Norm().pdf(d2)/(self._strike*self._volatility*m.sqrt(self._expiryTerm))
+            return self._discountDomestic*u.NormPdf(d2)/(self._strike*self._volatility*m.sqrt(self._expiryTerm))
         except:     
             raise ValueError('Divide with zero: GarmanKohlhagen->Vanilla->GetDualGamma')
     
@@ -152,16 +577,16 @@ class Vanilla(GarmanKohlhagen):
         
         # Dual Vega = dVega/dStrike
         d1 = self.Getd1(self._volatility)
-        return self._spot/self._strike*m.exp(-self._depositForeign*self._expiryTerm)*d1/self._volatility*u.Norm().pdf(d1)
+        return self._spot/self._strike*self._discountForeign*d1/self._volatility*u.NormPdf(d1)
     
     
     def GetVega(self):
         
         d1 = self.Getd1(self._volatility)
-        phi_d1 = u.Norm().pdf(d1)
+        phi_d1 = u.NormPdf(d1)
 
         if (self._expiryTerm > 0.0):
-            return self._spot * m.exp(- self._depositForeign * self._expiryTerm) * m.sqrt(self._expiryTerm) * phi_d1
+            return self._spot * self._discountForeign * m.sqrt(self._expiryTerm) * phi_d1
         else:
             raise ValueError("Expiry term + volatility needs to be positive - GarmanKohlhagen->Vanilla->GetVega")
 
@@ -171,10 +596,10 @@ class Vanilla(GarmanKohlhagen):
         retval = 0
         d1 = self.Getd1(self._volatility)
         d2 = self.Getd2(self._volatility)
-        phi_d1 = u.Norm().pdf(d1)
+        phi_d1 = u.NormPdf(d1)
 
         if (self._volatility > 0.0 and self._expiryTerm > 0.0):
-            retval = self._spot / self._volatility * m.exp(- self._depositForeign * self._expiryTerm) * m.sqrt(self._expiryTerm) * d1 * d2 * phi_d1
+            retval = self._spot / self._volatility * self._discountForeign * m.sqrt(self._expiryTerm) * d1 * d2 * phi_d1
         else:
             raise ValueError("Expiry term + volatility needs to be positive - GarmanKohlhagen->Vanilla->GetVolga")
 
@@ -185,10 +610,10 @@ class Vanilla(GarmanKohlhagen):
         retval = 0
         d1 = self.Getd1(self._volatility)
         d2 = self.Getd2(self._volatility)
-        phi_d1 = u.Norm().pdf(d1)
+        phi_d1 = u.NormPdf(d1)
 
         if (self._volatility > 0.0 and self._expiryTerm > 0.0):
-            retval = -m.exp(-self._depositForeign * self._expiryTerm) * d2 / self._volatility * phi_d1
+            retval = -self._discountForeign * d2 / self._volatility * phi_d1
         else:
             raise ValueError("Expiry term + volatility needs to be positive - GarmanKohlhagen->Vanilla->GetVanna")
 
@@ -207,13 +632,13 @@ class Vanilla(GarmanKohlhagen):
             d1 = self.Getd1(self._volatility)
             d2 = self.Getd2(self._volatility)
             
-            Phi_d1 = u.Norm().cdf(sign * d1)
-            phi_d1 = u.Norm().pdf(d1)
-            Phi_d2 = u.Norm().cdf(sign * d2)
+            Phi_d1 = u.NormCdf(sign * d1)
+            phi_d1 = u.NormPdf(d1)
+            Phi_d2 = u.NormCdf(sign * d2)
 
-            retval = (-self._spot * m.exp(-self._depositForeign * self._expiryTerm) * phi_d1 * self._volatility / (2.0 * m.sqrt(self._expiryTerm)) 
-            + sign * self._depositForeign * self._spot * Phi_d1 * m.exp(-self._depositForeign * self._expiryTerm) 
-            - sign * self._depositDomestic * self._strike * m.exp(-self._depositDomestic * self._expiryTerm) * Phi_d2)
+            retval = (-self._spot * self._discountForeign * phi_d1 * self._volatility / (2.0 * m.sqrt(self._expiryTerm)) 
+            + sign * self._depositForeign * self._spot * Phi_d1 * self._discountForeign 
+            - sign * self._depositDomestic * self._strike * self._discountDomestic * Phi_d2)
 
         else:
             raise ValueError("Expiry term + volatility needs to be positive - GarmanKohlhagen->Vanilla->GetTheta")
@@ -251,12 +676,79 @@ class TestBSMethods(unittest.TestCase):
     def test_GetImpliedVolatility(self):        
         self.assertEqual(round(self.bs.GetImpliedVolatility(4.206984, OptionType.Put), 4), 0.1854)
         
+    def test_ImpliedVolatility(self):
+        # Round trip: deep ITM/OTM, near expiry and vols above 90%
+        strikes = np.array([20.0, 35.0, 46.0, 60.0, 120.0])
+        for T in [1.0/365.0, 0.876, 5.0]:
+            for vol in [0.02, 0.18, 1.5]:
+                for optionType in [OptionType.Put, OptionType.Call]:
+                    prices = GarmanKohlhagenValue(45.451, strikes, T, 0.054, 0.1, vol, optionType)
+                    ivs = ImpliedVolatility(prices, 45.451, strikes, T, 0.054, 0.1, optionType)
+                    # Only options with a time value well above the round-off of the price can be inverted. Where the
+                    # time value is at least 0.1% of the price the vol is recovered to 1e-12 (relative); options that
+                    # are almost all intrinsic value lose the digits of the price lost to the intrinsic value
+                    intrinsic = GarmanKohlhagenValue(45.451, strikes, T, 0.054, 0.1, 1.0e-8, optionType)
+                    test = (prices - intrinsic) > 1.0e-10 * prices + 1.0e-200
+                    wellConditioned = (prices - intrinsic) > 1.0e-3 * prices
+                    self.assertTrue((np.abs(ivs[test] - vol) < 1.0e-6 * vol).all())
+                    self.assertTrue((np.abs(ivs[wellConditioned] - vol) < 1.0e-12 * vol).all())
+        
+        self.assertTrue(np.isnan(ImpliedVolatility(50.0, 45.451, 46.0, 0.876, 0.054, 0.1, OptionType.Call)))
+
+    def test_ImmutableContract(self):
+        market = MarketState(45.451, 0.054, 0.1)
+        contract = VanillaContract(46, 0.876, OptionType.Put)
+        self.assertEqual(round(VanillaValue(market, contract, 0.18), 6), round(4.12504280568063, 6))
+        self.assertEqual(round(VanillaGreeks(market, contract, 0.18).vega, 12), round(15.1547507432278, 12))
+        self.assertEqual(round(VanillaImpliedVolatility(market, contract, 4.206984), 4), 0.1854)
+        with self.assertRaises(AttributeError):
+            contract.strike = 47.0
+        with self.assertRaises(AttributeError):
+            market.extra = 1.0
+        self.assertEqual(contract, VanillaContract(46.0, 0.876, OptionType.Put))
+        self.assertEqual(copy.deepcopy(market), market)
+        self.assertEqual(pickle.loads(pickle.dumps(contract)), contract)
+
     def test_GetDualDelta(self):
         self.assertEqual( round(self.bs.GetDualDelta(OptionType.Call), 12), round(-0.330524888341401, 12))
         
     def test_GetDualGamma(self):
         self.assertEqual( round(self.bs.GetDualGamma(), 12), round(0.0454209823850242, 12))
 
+    def test_GetOptionValueArray(self):
+        strikes = np.array([40.0, 46.0, 52.0])
+        vols = np.array([0.21, 0.18, 0.16])
+        types = np.array([OptionType.Put, OptionType.Call, OptionType.Call])
+        values = self.bs.GetOptionValueArray(strikes, vols, types)
+        bs_s = Vanilla(45.451, 46, 0.876, 0.054, 0.1, 0.18)
+        for i in range(3):
+            self.assertAlmostEqual(values[i], bs_s.GetOptionValueSVO(strikes[i], vols[i], types[i]), 12)
+        
+        # Broadcasting: one strike against a vector of spots and expiries
+        values = GarmanKohlhagenValue(np.array([44.0, 45.451]), 46.0, np.array([0.5, 0.876]), 0.054, 0.1, 0.18, OptionType.Put)
+        self.assertEqual(round(values[1], 6), round(4.12504280568063, 6))
+
+    def test_GetAllGreeks(self):
+        for optionType in [OptionType.Put, OptionType.Call]:
+            greeks = self.bs.GetAllGreeks(optionType)
+            self.assertAlmostEqual(greeks.value, self.bs.GetOptionValue(optionType), 12)
+            self.assertAlmostEqual(greeks.domesticSpotDelta, self.bs.GetDomesticSpotDelta(optionType), 12)
+            self.assertAlmostEqual(greeks.gamma, self.bs.GetGamma(), 12)
+            self.assertAlmostEqual(greeks.vega, self.bs.GetVega(), 12)
+            self.assertAlmostEqual(greeks.vanna, self.bs.GetVanna(), 12)
+            self.assertAlmostEqual(greeks.volga, self.bs.GetVolga(), 12)
+            self.assertAlmostEqual(greeks.theta, self.bs.GetTheta(optionType), 12)
+            self.assertAlmostEqual(greeks.dualDelta, self.bs.GetDualDelta(optionType), 12)
+            self.assertAlmostEqual(greeks.dualGamma, self.bs.GetDualGamma(), 12)
+            self.assertAlmostEqual(greeks.dualVega, self.bs.GetDualVega(), 12)
+
+    def test_GetAllGreeksArray(self):
+        greeks = self.bs.GetAllGreeksArray(np.array([46.0, 46.0]), 0.18, np.array([OptionType.Put.value, OptionType.Call.value]))
+        for i, optionType in enumerate([OptionType.Put, OptionType.Call]):
+            scalar = self.bs.GetAllGreeks(optionType)
+            for field in Greeks._fields:
+                self.assertAlmostEqual(getattr(greeks, field)[i], getattr(scalar, field), 12)
+
     def test_GetDualVega(self):
         bs_dv = Vanilla(11.7336, 10.6283066245267, 180/365, 0.000901339, 0.056517435, 0.169934519201955)       
         self.assertEqual(round(bs_dv.GetDualVega(), 12), round(1.33669386647298, 12))
@@ -0,0 +1,170 @@
+"""
+ FX Vanilla option tools: Persistent (on-disk) cache of SABR/wing calibrations
+
+"""
+import hashlib
+import os
+import tempfile
+import numpy as np
+import VolatilitySurface as vs
+import SABRWing as sw
+import DepositCurve as dc
+import unittest
+
+
+# Version stamp of the calibration model, stored in every entry. Bump whenever the calibration (first guess,
+# objective, weights, wing equations, ...) changes: entries written under another version are then ignored and
+# removed when their key is looked up again
+CalibrationCacheVersion = 1
+
+
+def GetCalibrationKey(surfaceType, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta, calibrationWeights,
+                      calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    # Stable (process independent) hash of the calibration inputs: SHA-256 of the raw float64 bytes. The model version is
+    # not part of the key, it is checked against the stamp stored in the entry (CalibrationCache.Get())
+    inputs = np.concatenate([[spot, domesticDeposit, foreignDeposit, expiryTerm], np.asarray(volatilitySmile, dtype=float), [beta],
+                             np.asarray(calibrationWeights, dtype=float), [calibrationMethod.value]]).astype(np.float64)
+    return hashlib.sha256(surfaceType.__name__.encode() + inputs.tobytes()).hexdigest()
+
+
+class CalibrationCache:
+    """   Calibrated surface states (see SABRVolSurface.GetCalibrationState()) stored as one compressed .npz file
+        per key in a directory, so that they survive restarts and are shared between worker processes.
+        Files are written to a temporary file and renamed, so readers never see a partial entry.
+        Eviction: least recently used (file modification time is refreshed on every hit), at most maxEntries files.
+    """
+
+    def __init__(self, directory, maxEntries=10000):
+        self._directory = directory
+        self._maxEntries = maxEntries
+        os.makedirs(directory, exist_ok=True)
+
+
+    def GetFileName(self, key):
+        return os.path.join(self._directory, key + '.npz')
+
+
+    def Get(self, key):
+        # Stored calibration state for key, or None if missing, unreadable or written by another model version
+        fileName = self.GetFileName(key)
+        try:
+            with np.load(fileName) as data:
+                calibrationState = {name: data[name] for name in data.files}
+        except (OSError, ValueError, EOFError):
+            return None
+
+        if (int(calibrationState.pop('version', -1)) != CalibrationCacheVersion):
+            self.Remove(key)
+            return None
+
+        try:
+            os.utime(fileName)
+        except OSError:
+            pass
+        return calibrationState
+
+
+    def Put(self, key, calibrationState) -> None:
+        handle, temporaryName = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(f, version=CalibrationCacheVersion, **calibrationState)
+            os.replace(temporaryName, self.GetFileName(key))
+        except BaseException:
+            os.remove(temporaryName)
+            raise
+        self.Evict()
+        pass
+
+
+    def Remove(self, key) -> None:
+        try:
+            os.remove(self.GetFileName(key))
+        except OSError:
+            pass
+
+
+    def GetNumberOfEntries(self):
+        return len([f for f in os.listdir(self._directory) if f.endswith('.npz')])
+
+
+    def Evict(self) -> None:
+        # Remove the least recently used entries above maxEntries
+        entries = []
+        for f in os.listdir(self._directory):
+            if f.endswith('.npz'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self._directory, f)), f))
+                except OSError:
+                    pass
+
+        if (len(entries) > self._maxEntries):
+            entries.sort()
+            for _, f in entries[:len(entries) - self._maxEntries]:
+                self.Remove(f[:-4])
+        pass
+
+
+    def Clear(self) -> None:
+        for f in os.listdir(self._directory):
+            if f.endswith('.npz'):
+                self.Remove(f[:-4])
+        pass
+
+
+def GetCachedWingSurface(cache: CalibrationCache, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta=0.85,
+                         calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    # SABRWingSurface hydrated from the cache when the inputs were calibrated before, calibrated and stored otherwise.
+    # Deposit curves are keyed by their deposits at expiryTerm
+    domesticDeposit, foreignDeposit = dc.GetDeposit(domesticDeposit, expiryTerm), dc.GetDeposit(foreignDeposit, expiryTerm)
+    key = GetCalibrationKey(sw.SABRWingSurface, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta,
+                            sw.WingCalibrationWeights, calibrationMethod)
+    calibrationState = cache.Get(key)
+    surface = sw.SABRWingSurface(spot, domesticDeposit, foreignDeposit, expiryTerm, np.asarray(volatilitySmile, dtype=float), beta,
+                                 calibrationMethod, calibrationState)
+    if (calibrationState is None):
+        cache.Put(key, surface.GetCalibrationState())
+
+    return surface
+
+
+
+#//     Unit-Test: Calibration cache
+class Test_CalibrationCache(unittest.TestCase):
+
+    def test_CalibrationCache(self):
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        with tempfile.TemporaryDirectory() as directory:
+            cache = CalibrationCache(directory, maxEntries=2)
+            calibrated = GetCachedWingSurface(cache, 11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+            self.assertEqual(cache.GetNumberOfEntries(), 1)
+
+            # Hydrated from disk: no calibration, same vols in the SABR body and in the wings
+            hydrated = GetCachedWingSurface(cache, 11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+            self.assertEqual(hydrated._calibrationEvaluations, 0)
+            strikes = np.array([10.2, 11.0, 11.7, 12.3, 13.0])
+            self.assertTrue(np.array_equal(hydrated.GetVolatility(strikes), calibrated.GetVolatility(strikes)))
+
+            # Different inputs give a different key
+            key = GetCalibrationKey(sw.SABRWingSurface, 11.7336, 0.001671885, 0.061701683, 30/365.0, smile, 0.85, sw.WingCalibrationWeights)
+            self.assertNotEqual(key, GetCalibrationKey(sw.SABRWingSurface, 11.7336, 0.001671885, 0.061701683, 30/365.0, smile + 1.0e-6, 0.85,
+                                                       sw.WingCalibrationWeights))
+            
+            # The entry of the same inputs written under an older model version is dropped and recalibrated
+            stale = dict(calibrated.GetCalibrationState())
+            np.savez(cache.GetFileName(key), version=CalibrationCacheVersion - 1, **stale)
+            recalibrated = GetCachedWingSurface(cache, 11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+            self.assertGreater(recalibrated._calibrationEvaluations, 0)
+            self.assertIsNotNone(cache.Get(key))
+
+            # Least recently used entries are evicted
+            for i in range(3):
+                cache.Put('entry' + str(i), stale)
+                os.utime(cache.GetFileName('entry' + str(i)), (i, i))
+            cache.Evict()
+            self.assertEqual(cache.GetNumberOfEntries(), 2)
+            self.assertIsNone(cache.Get('entry0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
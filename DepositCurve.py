@@ -0,0 +1,151 @@
+"""
+ FX Vanilla option tools: Deposit curves and FX forward curves with cached discount factors and forwards
+
+"""
+import collections
+import math as m
+import numpy as np
+import unittest
+
+
+class DepositCurve:
+    """   Continuously compounded deposit (zero) rates at pillar expiries. Between pillars r*T (the log discount
+        factor) is interpolated linearly, before the first and after the last pillar the rate is held flat.
+        Discount factors of float expiries are cached (LRU, at most maxCachedExpiries), arrays of expiries are
+        evaluated in one vectorized call. A flat deposit is a curve with one pillar.
+    """
+
+    def __init__(self, expiryTerms, deposits, maxCachedExpiries=1024):
+        self._expiryTerms = np.atleast_1d(np.asarray(expiryTerms, dtype=float))
+        self._deposits = np.broadcast_to(np.asarray(deposits, dtype=float), self._expiryTerms.shape).copy()
+
+        if (self._expiryTerms.ndim != 1 or len(self._expiryTerms) == 0 or (self._expiryTerms <= 0.0).any() or (np.diff(self._expiryTerms) <= 0.0).any()):
+            raise ValueError('Expiry terms must be positive and strictly increasing - DepositCurve')
+
+        self._logDiscountFactors = -self._deposits * self._expiryTerms
+        self._maxCachedExpiries = maxCachedExpiries
+        self._discountFactors = collections.OrderedDict()
+
+
+    def GetExpiryTerms(self):
+        return self._expiryTerms
+
+
+    def GetDeposit(self, expiryTerm):
+        # Zero rate for a float or an array of expiries
+        T = self._expiryTerms
+        if isinstance(expiryTerm, (float, int)):
+            if (expiryTerm <= T[0]):
+                return float(self._deposits[0])
+            if (expiryTerm >= T[-1]):
+                return float(self._deposits[-1])
+            return -float(np.interp(expiryTerm, T, self._logDiscountFactors)) / expiryTerm
+
+        t = np.asarray(expiryTerm, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = -np.interp(t, T, self._logDiscountFactors) / t
+        return np.where(t <= T[0], self._deposits[0], np.where(t >= T[-1], self._deposits[-1], rates))
+
+
+    def GetDiscountFactor(self, expiryTerm):
+        # exp(-r(T)*T) for a float (cached) or an array of expiries
+        if not isinstance(expiryTerm, (float, int)):
+            t = np.asarray(expiryTerm, dtype=float)
+            return np.exp(-self.GetDeposit(t) * t)
+
+        discountFactor = self._discountFactors.get(expiryTerm)
+        if (discountFactor is not None):
+            self._discountFactors.move_to_end(expiryTerm)
+            return discountFactor
+
+        discountFactor = m.exp(-self.GetDeposit(expiryTerm) * expiryTerm)
+        self._discountFactors[expiryTerm] = discountFactor
+        if (len(self._discountFactors) > self._maxCachedExpiries):
+            self._discountFactors.popitem(last=False)
+        return discountFactor
+
+
+class ForwardCurve:
+    """   Outright FX forwards spot*DFforeign(T)/DFdomestic(T) from a domestic and a foreign DepositCurve.
+        Forwards of float expiries are cached (LRU), arrays of expiries are evaluated in one vectorized call.
+    """
+
+    def __init__(self, spot, domesticCurve: DepositCurve, foreignCurve: DepositCurve, maxCachedExpiries=1024):
+        self._spot = spot
+        self._domesticCurve = domesticCurve
+        self._foreignCurve = foreignCurve
+        self._maxCachedExpiries = maxCachedExpiries
+        self._forwards = collections.OrderedDict()
+
+
+    def GetSpot(self):
+        return self._spot
+
+
+    def GetDomesticCurve(self):
+        return self._domesticCurve
+
+
+    def GetForeignCurve(self):
+        return self._foreignCurve
+
+
+    def GetForward(self, expiryTerm):
+        if not isinstance(expiryTerm, (float, int)):
+            return self._spot * self._foreignCurve.GetDiscountFactor(expiryTerm) / self._domesticCurve.GetDiscountFactor(expiryTerm)
+
+        forward = self._forwards.get(expiryTerm)
+        if (forward is not None):
+            self._forwards.move_to_end(expiryTerm)
+            return forward
+
+        forward = self._spot * self._foreignCurve.GetDiscountFactor(expiryTerm) / self._domesticCurve.GetDiscountFactor(expiryTerm)
+        self._forwards[expiryTerm] = forward
+        if (len(self._forwards) > self._maxCachedExpiries):
+            self._forwards.popitem(last=False)
+        return forward
+
+
+def GetDeposit(deposit, expiryTerm):
+    # Deposit rate for expiryTerm from a float (flat deposit) or a DepositCurve
+    if isinstance(deposit, DepositCurve):
+        return deposit.GetDeposit(expiryTerm)
+    return deposit
+
+
+
+#//     Unit-Test: Deposit and forward curves
+class Test_DepositCurve(unittest.TestCase):
+
+    def test_DepositCurve(self):
+        curve = DepositCurve([7/365.0, 30/365.0, 181/365.0, 1.0], [0.000901339, 0.001671885, 0.003722718, 0.00503213])
+
+        # Pillars are returned exactly, r*T is linear between pillars and the rate is flat outside
+        self.assertAlmostEqual(curve.GetDeposit(30/365.0), 0.001671885, 15)
+        T = 90/365.0
+        w = (T - 30/365.0)/(151/365.0)
+        self.assertAlmostEqual(curve.GetDeposit(T)*T, (1.0 - w)*0.001671885*30/365.0 + w*0.003722718*181/365.0, 15)
+        self.assertEqual(curve.GetDeposit(1/365.0), 0.000901339)
+        self.assertEqual(curve.GetDeposit(2.0), 0.00503213)
+
+        # Arrays in one call, same values as floats; float discount factors are cached
+        expiries = np.array([1/365.0, 30/365.0, 90/365.0, 2.0])
+        discountFactors = curve.GetDiscountFactor(expiries)
+        for i in range(len(expiries)):
+            self.assertAlmostEqual(discountFactors[i], curve.GetDiscountFactor(float(expiries[i])), 15)
+        self.assertEqual(len(curve._discountFactors), 4)
+        self.assertEqual(GetDeposit(0.01, 1.0), 0.01)
+        self.assertEqual(GetDeposit(curve, 2.0), 0.00503213)
+
+    def test_ForwardCurve(self):
+        forwardCurve = ForwardCurve(11.7336, DepositCurve([30/365.0, 1.0], [0.001671885, 0.00503213]),
+                                    DepositCurve([30/365.0, 1.0], [0.061701683, 0.064996107]))
+        expiries = np.array([30/365.0, 0.5, 1.0])
+        forwards = forwardCurve.GetForward(expiries)
+        self.assertAlmostEqual(forwards[0], 11.7336*m.exp((0.001671885 - 0.061701683)*30/365.0), 12)
+        for i in range(len(expiries)):
+            self.assertAlmostEqual(forwards[i], forwardCurve.GetForward(float(expiries[i])), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+"""
+ FX Vanilla option tools: Column-wise book of FX vanilla options with vectorized risk aggregation
+
+"""
+import collections
+import numpy as np
+import BlackScholes as bs
+import unittest
+
+
+# Aggregated risk of a group of trades: value, domestic spot delta, gamma and vega, all notional and direction weighted
+RiskBucket = collections.namedtuple('RiskBucket', ['pv', 'delta', 'gamma', 'vega', 'numberOfTrades'])
+
+
+class FXVanillaBook:
+    """   Book of FX vanilla options stored column-wise (pair, expiry, strike, notional, put/call, direction).
+        Trades are grouped by (pair, expiry) so that every group is valued with one volatility surface 
+        and one vectorized Garman-Kohlhagen call.
+    """
+    
+    def __init__(self):
+        self._pairs = np.empty(0, dtype=object)
+        self._expiryTerms = np.empty(0)
+        self._strikes = np.empty(0)
+        self._notionals = np.empty(0)
+        self._optionTypes = np.empty(0, dtype=int)
+        self._directions = np.empty(0)
+        self._pending = []
+        self._groups = None
+
+
+    def AddTrade(self, pair, expiryTerm, strike, notional, optionType: bs.OptionType, direction=1.0) -> None:
+        self._pending.append((pair, expiryTerm, strike, notional, optionType.value, direction))
+        self._groups = None
+        pass
+
+
+    def AddTrades(self, pairs, expiryTerms, strikes, notionals, optionTypes, directions=1.0) -> None:
+        # Bulk load of trades. All columns are broadcast to a common length; optionTypes is an OptionType
+        # or an array of OptionTypes/OptionType values and directions is +1.0 (long) or -1.0 (short)
+        self.Consolidate()
+        n = np.broadcast(np.asarray(pairs, dtype=object), expiryTerms, strikes, notionals, directions).size
+        types = np.where(bs.GetOptionSign(optionTypes) < 0.0, bs.OptionType.Put.value, bs.OptionType.Call.value)
+        
+        self._pairs = np.concatenate([self._pairs, np.broadcast_to(np.asarray(pairs, dtype=object), n)])
+        self._expiryTerms = np.concatenate([self._expiryTerms, np.broadcast_to(np.asarray(expiryTerms, dtype=float), n)])
+        self._strikes = np.concatenate([self._strikes, np.broadcast_to(np.asarray(strikes, dtype=float), n)])
+        self._notionals = np.concatenate([self._notionals, np.broadcast_to(np.asarray(notionals, dtype=float), n)])
+        self._optionTypes = np.concatenate([self._optionTypes, np.broadcast_to(types, n)])
+        self._directions = np.concatenate([self._directions, np.broadcast_to(np.asarray(directions, dtype=float), n)])
+        self._groups = None
+        pass
+
+
+    def Consolidate(self) -> None:
+        # Move trades added one by one with AddTrade() into the columns
+        if (len(self._pending) > 0):
+            pending = self._pending
+            self._pending = []
+            columns = list(zip(*pending))
+            self.AddTrades(np.array(columns[0], dtype=object), np.array(columns[1]), np.array(columns[2]), 
+                           np.array(columns[3]), np.array(columns[4]), np.array(columns[5]))
+        pass
+
+
+    def GetNumberOfTrades(self):
+        return len(self._strikes) + len(self._pending)
+
+
+    def GetGroups(self):
+        # Dictionary (pair, expiry) -> array of trade indices, cached until trades are added
+        self.Consolidate()
+        if (self._groups is None):
+            pair_keys, pair_index = np.unique(self._pairs.astype(str), return_inverse=True)
+            expiry_keys, expiry_index = np.unique(self._expiryTerms, return_inverse=True)
+            codes = pair_index * len(expiry_keys) + expiry_index
+            order = np.argsort(codes, kind='stable')
+            group_codes, starts = np.unique(codes[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            
+            self._groups = {}
+            for code, start, end in zip(group_codes, starts, ends):
+                key = (str(pair_keys[code // len(expiry_keys)]), float(expiry_keys[code % len(expiry_keys)]))
+                self._groups[key] = order[start:end]
+        
+        return self._groups
+
+
+    def GetGroupGreeks(self, key, surface):
+        # Vectorized value and Greeks (per unit notional) of the trades in one (pair, expiry) group
+        index = self.GetGroups()[key]
+        strikes = self._strikes[index]
+        vols = surface.GetVolatility(strikes)
+        
+        return bs.GarmanKohlhagenGreeks(surface._spot, strikes, key[1], surface._domesticDeposit, 
+                                        surface._foreignDeposit, vols, self._optionTypes[index])
+
+
+    def CalculateRisk(self, surfaces):
+        """   Aggregated PV/delta/gamma/vega per (pair, expiry) bucket. surfaces is a dictionary 
+            (pair, expiry) -> volatility surface (FXVolSurface or subclass) that supplies spot, 
+            deposits and vols for the group. Returns a dictionary (pair, expiry) -> RiskBucket.
+        """
+        risk = {}
+        for key, index in self.GetGroups().items():
+            if (key not in surfaces):
+                raise ValueError('No volatility surface for pair/expiry ' + str(key) + ' - FXVanillaBook->CalculateRisk')
+            
+            greeks = self.GetGroupGreeks(key, surfaces[key])
+            weight = self._notionals[index] * self._directions[index]
+            risk[key] = RiskBucket(pv = weight @ greeks.value, 
+                                   delta = weight @ greeks.domesticSpotDelta, 
+                                   gamma = weight @ greeks.gamma, 
+                                   vega = weight @ greeks.vega, 
+                                   numberOfTrades = len(index))
+        
+        return risk
+
+
+    def ScenarioLadder(self, surfaces, spotShocks, smileShocks, chunkSize=20000):
+        """   Revalue the book on a grid of relative spot shocks x smile shocks. 
+            spotShocks:  relative shifts, spot*(1 + shock), e.g. np.linspace(-0.1, 0.1, 21)
+            smileShocks: parallel vol shifts (1-d array) or shifts of the five quotes (n x 5 array)
+            Every (pair, expiry) surface is shocked and recalibrated once per smile shock (not per trade)
+            and vols are held sticky-strike across the spot shocks. Values are broadcast over 
+            (spot, smile, trades) in chunks of at most chunkSize trades to bound memory.
+            Returns a dictionary (pair, expiry) -> PV array of shape (len(spotShocks), len(smileShocks)).
+        """
+        spotFactors = 1.0 + np.asarray(spotShocks, dtype=float)
+        smileShocks = np.asarray(smileShocks, dtype=float)
+        ladder = {}
+        
+        for key, index in self.GetGroups().items():
+            if (key not in surfaces):
+                raise ValueError('No volatility surface for pair/expiry ' + str(key) + ' - FXVanillaBook->ScenarioLadder')
+            
+            surface = surfaces[key]
+            strikes = self._strikes[index]
+            vols = np.array([surface.GetShockedSurface(shock).GetVolatility(strikes) for shock in smileShocks])
+            weight = self._notionals[index] * self._directions[index]
+            pv = np.zeros((len(spotFactors), len(smileShocks)))
+            
+            for start in range(0, len(index), chunkSize):
+                chunk = slice(start, start + chunkSize)
+                values = bs.GarmanKohlhagenValue(surface._spot * spotFactors[:, None, None], strikes[None, None, chunk], key[1], 
+                                                 surface._domesticDeposit, surface._foreignDeposit, vols[None, :, chunk], 
+                                                 self._optionTypes[index][None, None, chunk])
+                pv += values @ weight[chunk]
+            
+            ladder[key] = pv
+        
+        return ladder
+
+
+def AggregateRiskByPair(risk):
+    # Sum the (pair, expiry) buckets of FXVanillaBook.CalculateRisk() per currency pair
+    totals = {}
+    for (pair, expiry), bucket in risk.items():
+        if (pair in totals):
+            total = totals[pair]
+            totals[pair] = RiskBucket(total.pv + bucket.pv, total.delta + bucket.delta, total.gamma + bucket.gamma,
+                                      total.vega + bucket.vega, total.numberOfTrades + bucket.numberOfTrades)
+        else:
+            totals[pair] = bucket
+    
+    return totals
+
+
+
+#//     Unit-Test: FX Vanilla Book
+class Test_Portfolio(unittest.TestCase):
+    
+    def test_CalculateRisk(self):
+        import VolatilitySurface as vs
+        import Utility as u
+        
+        smile = np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995])
+        surfaces = {('EURJPY', 61/365.0): vs.FXVolSurface(85.3678, 0.012, 0.0053, 61/365.0, smile, u.CubicSplineInterpolation(True)),
+                    ('EURJPY', 0.5): vs.FXVolSurface(85.3678, 0.013, 0.0055, 0.5, smile, u.CubicSplineInterpolation(True)),
+                    ('USDCHF', 0.5): vs.FXVolSurface(0.9123, 0.001, 0.02, 0.5, smile, u.CubicSplineInterpolation(True))}
+        
+        book = FXVanillaBook()
+        book.AddTrade('EURJPY', 61/365.0, 90.0, 1.0e6, bs.OptionType.Call, 1.0)
+        book.AddTrade('USDCHF', 0.5, 0.90, 2.0e6, bs.OptionType.Put, -1.0)
+        book.AddTrades('EURJPY', np.array([61/365.0, 0.5]), np.array([84.0, 86.0]), 5.0e5, 
+                       np.array([bs.OptionType.Put, bs.OptionType.Call]), np.array([-1.0, 1.0]))
+        self.assertEqual(book.GetNumberOfTrades(), 4)
+        
+        risk = book.CalculateRisk(surfaces)
+        self.assertEqual(len(risk), 3)
+        
+        # Reference: trade by trade valuation
+        expected = {}
+        trades = [('EURJPY', 61/365.0, 90.0, 1.0e6, bs.OptionType.Call, 1.0), ('USDCHF', 0.5, 0.90, 2.0e6, bs.OptionType.Put, -1.0),
+                  ('EURJPY', 61/365.0, 84.0, 5.0e5, bs.OptionType.Put, -1.0), ('EURJPY', 0.5, 86.0, 5.0e5, bs.OptionType.Call, 1.0)]
+        for pair, expiry, strike, notional, optionType, direction in trades:
+            surface = surfaces[(pair, expiry)]
+            option = bs.Vanilla(surface._spot, strike, expiry, surface._domesticDeposit, surface._foreignDeposit, surface.GetVolatility(strike))
+            expected[(pair, expiry)] = expected.get((pair, expiry), 0.0) + notional * direction * option.GetOptionValue(optionType)
+            if (pair == 'USDCHF'):
+                self.assertAlmostEqual(risk[(pair, expiry)].vega, notional * direction * option.GetVega(), 6)
+        
+        for key in expected:
+            self.assertAlmostEqual(risk[key].pv, expected[key], 6)
+        
+        byPair = AggregateRiskByPair(risk)
+        self.assertEqual(byPair['EURJPY'].numberOfTrades, 3)
+        self.assertAlmostEqual(byPair['EURJPY'].pv, expected[('EURJPY', 61/365.0)] + expected[('EURJPY', 0.5)], 6)
+
+
+    def test_ScenarioLadder(self):
+        import VolatilitySurface as vs
+        
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        surface = vs.SABRVolSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+        surfaces = {('ZARJPY', 30/365.0): surface}
+        book = FXVanillaBook()
+        book.AddTrades('ZARJPY', 30/365.0, np.array([11.0, 11.7, 12.2]), np.array([1.0e6, 2.0e6, 1.0e6]), 
+                       np.array([bs.OptionType.Put, bs.OptionType.Call, bs.OptionType.Call]), np.array([1.0, -1.0, 1.0]))
+        
+        spotShocks = np.array([-0.05, 0.0, 0.05])
+        smileShocks = np.array([-0.01, 0.0, 0.02])
+        ladder = book.ScenarioLadder(surfaces, spotShocks, smileShocks, chunkSize=2)[('ZARJPY', 30/365.0)]
+        self.assertEqual(ladder.shape, (3, 3))
+        self.assertAlmostEqual(ladder[1, 1], book.CalculateRisk(surfaces)[('ZARJPY', 30/365.0)].pv, 6)
+        
+        # Spot -5%, vols +2%: revalue trade by trade on a recalibrated surface
+        shocked = vs.SABRVolSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile + 0.02)
+        expected = 0.0
+        for strike, notional, optionType, direction in [(11.0, 1.0e6, bs.OptionType.Put, 1.0), (11.7, 2.0e6, bs.OptionType.Call, -1.0), 
+                                                        (12.2, 1.0e6, bs.OptionType.Call, 1.0)]:
+            option = bs.Vanilla(11.7336*0.95, strike, 30/365.0, 0.001671885, 0.061701683, shocked.GetVolatility(strike))
+            expected += notional * direction * option.GetOptionValue(optionType)
+        self.assertAlmostEqual(ladder[0, 2], expected, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,13 @@ from SABRWing import Test_SABRWing
 from VolatilitySurface import Test_VolSurface
 from StrikeFromDelta import Test_StrikeFromDelta
 from BlackScholes import TestBSMethods
+from Portfolio import Test_Portfolio
+from VolatilityTermStructure import Test_TermStructure
+from SurfaceCalibration import Test_SurfaceCalibration
+from CalibrationCache import Test_CalibrationCache
+from SurfaceManager import Test_SurfaceManager
+from SurfaceStore import Test_SurfaceStore
+from DepositCurve import Test_DepositCurve
 
 
 def load_tests(loader, tests, pattern):
@@ -16,6 +23,13 @@ def load_tests(loader, tests, pattern):
     suite.addTests(loader.loadTestsFromModule(Test_VolSurface()))
     suite.addTests(loader.loadTestsFromModule(Test_SABRWing()))
     suite.addTests(loader.loadTestsFromModule(TestBSMethods()))    
+    suite.addTests(loader.loadTestsFromModule(Test_Portfolio()))
+    suite.addTests(loader.loadTestsFromModule(Test_TermStructure()))
+    suite.addTests(loader.loadTestsFromModule(Test_SurfaceCalibration()))
+    suite.addTests(loader.loadTestsFromModule(Test_CalibrationCache()))
+    suite.addTests(loader.loadTestsFromModule(Test_SurfaceManager()))
+    suite.addTests(loader.loadTestsFromModule(Test_SurfaceStore()))
+    suite.addTests(loader.loadTestsFromModule(Test_DepositCurve()))
     
     return suite
 
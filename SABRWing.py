@@ -1,7 +1,7 @@
 # SABR Wing Extrapolation Surface
 
 import VolatilitySurface as vs
-import StrikeFromDelta as sfd
+import DepositCurve as dc
 import numpy as np
 import BlackScholes as bs
 import math as m
@@ -9,14 +9,116 @@ import unittest
 
 
 
-class SABRWingSurface(vs.SABRVolSurface):
+# SABR calibration weights of the wing surface (10dput, 25dput, atm, 25dcall, 10dcall)
+WingCalibrationWeights = (0.15, 2.5, 4.0, 2.5, 0.15)
+
+# Chebyshev degrees tried (in order) for the wing-vol proxy until the tolerance is met
+WingProxyDegrees = (8, 16, 24, 32, 48)
+
+
+def ChebyshevValue(x, coefficients):
+    # Clenshaw recurrence for a float x in [-1, 1] (coefficients as a tuple of floats, lowest order first)
+    b1 = b2 = 0.0
+    x2 = 2.0*x
+    for c in coefficients[:0:-1]:
+        b1, b2 = c + x2*b1 - b2, b1
+    return coefficients[0] + x*b1 - b2
+
+
+def WingPrices(strikes, K25P, wingParameters):
+    """   Wing prices of a float or an array of strikes from the coefficients [my, aput, bput, cput, ny, acall, bcall, ccall]:
+        puts below the 25 delta put strike K25P, price = exp(my*ln K + aput + bput*K + cput*K^2), calls otherwise,
+        price = exp(-ny*ln K + acall + bcall/K + ccall/K^2). Returns the prices and the option types (OptionType values).
+    """
+    my, aput, bput, cput, ny, acall, bcall, ccall = wingParameters
+    K = np.asarray(strikes, dtype=float)
+    put = K < K25P
+    with np.errstate(divide='ignore'):
+        logStrikes = np.log(K)
+        prices = np.exp(np.where(put, my*logStrikes + aput + bput*K + cput*K*K, -ny*logStrikes + acall + bcall/K + ccall/(K*K)))
+    return prices, np.where(put, bs.OptionType.Put.value, bs.OptionType.Call.value)
+
+
+def WingPriceStrikeDerivatives(strikes, K25P, wingParameters):
+    # WingPrices() and their first and second strike derivatives: price = exp(f(K)) gives price' = f'*price and
+    # price'' = (f'' + f'^2)*price
+    my, aput, bput, cput, ny, acall, bcall, ccall = wingParameters
+    K = np.asarray(strikes, dtype=float)
+    prices, optionTypes = WingPrices(K, K25P, wingParameters)
+    put = optionTypes == bs.OptionType.Put.value
+    dfdK = np.where(put, my/K + bput + 2.0*cput*K, -ny/K - bcall/(K*K) - 2.0*ccall/K**3)
+    d2fdKdK = np.where(put, -my/(K*K) + 2.0*cput, ny/(K*K) + 2.0*bcall/K**3 + 6.0*ccall/K**4)
+    return prices, dfdK*prices, (d2fdKdK + dfdK*dfdK)*prices, optionTypes
+
+
+def SolveWingParametersArray(spot, domesticDeposit, foreignDeposit, expiryTerm, strikes, volatilitySmiles, alpha, corr, vovol, beta):
+    """   Wing coefficients [my, aput, bput, cput, ny, acall, bcall, ccall] of N surfaces in one pass, shape (N, 8).
+        Market data and SABR parameters are arrays of shape (N,) (or floats), strikes and volatilitySmiles have
+        shape (N, 5). Same equations as SABRWingSurface.SolveWingParameters(): the log-prices and their strike
+        derivatives at the 25 delta strikes come from vectorized Greeks and SABR derivatives, and the 2N 4x4
+        systems are solved by one stacked np.linalg.solve().
+    """
+    strikes = np.atleast_2d(np.asarray(strikes, dtype=float))
+    volatilitySmiles = np.atleast_2d(np.asarray(volatilitySmiles, dtype=float))
+    N = strikes.shape[0]
+    spot, rd, rf, T, alpha, corr, vovol, beta = [np.broadcast_to(np.asarray(v, dtype=float), (N,)) for v in 
+                                                 [spot, domesticDeposit, foreignDeposit, expiryTerm, alpha, corr, vovol, beta]]
+    forward = spot*np.exp((rd - rf)*T)
+    
+    # Put wing at (K25P, K10P), call wing at (K25C, K10C): rows [0:N] are puts, [N:2N] calls
+    K25 = np.concatenate([strikes[:, 1], strikes[:, 3]])
+    K10 = np.concatenate([strikes[:, 0], strikes[:, 4]])
+    smile10 = np.concatenate([volatilitySmiles[:, 0], volatilitySmiles[:, 4]])
+    optionTypes = np.concatenate([np.full(N, bs.OptionType.Put.value), np.full(N, bs.OptionType.Call.value)])
+    spot2, rd2, rf2, T2, forward2 = [np.concatenate([v, v]) for v in [spot, rd, rf, T, forward]]
     
-    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta=0.85):
-        super().__init__(spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta)
+    vol25, dSABRdK, d2SABRdKdK = vs.SabrStrikeDerivatives(K25, forward2, T2, *[np.concatenate([v, v]) for v in [alpha, corr, vovol, beta]])
+    greeks = bs.GarmanKohlhagenGreeks(spot2, K25, T2, rd2, rf2, vol25, optionTypes)
+    dBSdK = greeks.dualDelta + greeks.vega*dSABRdK
+    d2BSdKdK = greeks.dualGamma + 2.0*greeks.dualVega*dSABRdK + greeks.volga*dSABRdK*dSABRdK + greeks.vega*d2SABRdKdK
     
-        # Strike and Vol are dummy values for the _bs object. This object is applied 
-        # for the wing-extrapolation calculation and these parameters are set at "run-time"
-        self._bs = bs.Vanilla(spot, 1.0, expiryTerm, domesticDeposit, foreignDeposit, 0.1)
+    rhs = np.stack([np.log(greeks.value), 
+                    dBSdK/greeks.value, 
+                    -(dBSdK/greeks.value)**2 + d2BSdKdK/greeks.value,
+                    np.log(bs.GarmanKohlhagenValue(spot2, K10, T2, rd2, rf2, smile10, optionTypes))], axis=-1)
+    
+    KP, KP10, KC, KC10 = strikes[:, 1], strikes[:, 0], strikes[:, 3], strikes[:, 4]
+    one, zero = np.ones(N), np.zeros(N)
+    putMatrix = np.stack([np.stack([np.log(KP), one, KP, KP*KP], axis=-1),
+                          np.stack([1.0/KP, zero, one, 2.0*KP], axis=-1),
+                          np.stack([-1.0/(KP*KP), zero, zero, 2.0*one], axis=-1),
+                          np.stack([np.log(KP10), one, KP10, KP10*KP10], axis=-1)], axis=1)
+    callMatrix = np.stack([np.stack([-np.log(KC), one, 1.0/KC, 1.0/(KC*KC)], axis=-1),
+                           np.stack([-1.0/KC, zero, -1.0/(KC*KC), -2.0/KC**3], axis=-1),
+                           np.stack([1.0/(KC*KC), zero, 2.0/KC**3, 6.0/KC**4], axis=-1),
+                           np.stack([-np.log(KC10), one, 1.0/KC10, 1.0/(KC10*KC10)], axis=-1)], axis=1)
+    
+    solution = np.linalg.solve(np.concatenate([putMatrix, callMatrix]), rhs[:, :, np.newaxis])[:, :, 0]
+    return np.concatenate([solution[:N], solution[N:]], axis=1)
+
+
+def CalcWingParametersBatch(surfaces) -> None:
+    # Wing coefficients of a list of calibrated SABRWingSurface objects by one SolveWingParametersArray() call
+    # (instead of one CalcWingParameters() per surface)
+    if (len(surfaces) == 0):
+        return
+    
+    wingParameters = SolveWingParametersArray([s._spot for s in surfaces], [s._domesticDeposit for s in surfaces], 
+                                              [s._foreignDeposit for s in surfaces], [s._expiryTerm for s in surfaces],
+                                              [s._strikes for s in surfaces], [s._volatilitySmile for s in surfaces], 
+                                              [s._alpha for s in surfaces], [s._corr for s in surfaces], [s._vovol for s in surfaces],
+                                              [s._beta for s in surfaces])
+    for surface, parameters in zip(surfaces, wingParameters):
+        surface._my, surface._aput, surface._bput, surface._cput, surface._ny, surface._acall, surface._bcall, surface._ccall = [float(x) for x in parameters]
+        surface.BuildWingProxy()
+    pass
+
+
+class SABRWingSurface(vs.SABRVolSurface):
+    
+    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta=0.85, 
+                 calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell, calibrationState=None,
+                 wingProxyTolerance=None, wingProxyStandardDeviations=5.0):
         
         self._ny = np.nan
         self._acall = np.nan
@@ -28,27 +130,138 @@ class SABRWingSurface(vs.SABRVolSurface):
         self._bput = np.nan
         self._cput = np.nan
         
-        self._calibrationWeights = np.array([0.15, 2.5, 4.0, 2.5, 0.15])
-        self.SabrCalibration()
-        self.CalcWingParameters()
+        # Optional Chebyshev proxy of the wing vols in log-strike, rebuilt with the wing parameters: used for strikes
+        # within wingProxyStandardDeviations ATM standard deviations of the forward, with a measured maximum error
+        # against GetImpliedWingVol() of at most wingProxyTolerance (None: exact implied vols only)
+        self._wingProxyTolerance = wingProxyTolerance
+        self._wingProxyStandardDeviations = wingProxyStandardDeviations
+        self._putWingProxy = None
+        self._callWingProxy = None
+        self._wingProxyError = np.nan
+        
+        # Immutable market state applied for the wing-extrapolation calculations. Strikes and vols are
+        # passed to the pure pricing functions of BlackScholes, so no pricer state is modified at run-time
+        domesticDeposit, foreignDeposit = dc.GetDeposit(domesticDeposit, expiryTerm), dc.GetDeposit(foreignDeposit, expiryTerm)
+        self._market = bs.MarketState(spot, domesticDeposit, foreignDeposit)
+        
+        # SABR is calibrated once (in the base constructor) with the wing calibration weights
+        super().__init__(spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta, WingCalibrationWeights, calibrationMethod, 
+                         calibrationState=calibrationState)
+        
+        if (calibrationState is None):
+            self.CalcWingParameters()
     
     
     def GetVolatilityFromSmile(self, strike, smile_vec):
         
-        if (smile_vec != self._volatilitySmile).any():
-            self.SetVolatilitySmile(smile_vec)
-            self.SabrCalibration()
-            self.CalcWingParameters()
+        if not self.IsCurrentSmile(smile_vec):
+            self.UpdateVolatilities(smile_vec)
+        if (self._calibratedVersion != self._smileVersion):
+            self.Recalibrate()
+        
+        if (np.ndim(strike) > 0):
+            return self.GetVolatilityArray(np.asarray(strike, dtype=float))
                       
         if (strike < self._strikes[1] or strike > self._strikes[3]):            
-            return self.GetImpliedWingVol(strike)
+            return self.GetWingVol(strike)
         else:
             return self.SabrImpliedVol(strike, self._alpha, self._corr, self._vovol, self._beta)
     
     
+    def Recalibrate(self) -> None:
+        super().Recalibrate()
+        self.CalcWingParameters()
+        pass
+    
+    
+    def GetVolatilityArray(self, strikes):
+        # SABR vols between the 25 delta strikes, wing vols outside (branches selected by masks)
+        vols = np.empty(strikes.shape)
+        wing = (strikes < self._strikes[1]) | (strikes > self._strikes[3])
+        vols[~wing] = self.SabrImpliedVolArray(strikes[~wing], self._alpha, self._corr, self._vovol, self._beta)
+        vols[wing] = self.GetWingVolArray(strikes[wing])
+        return vols
+    
+    
+    def GetWingVol(self, strike):
+        # Wing vol from the Chebyshev proxy when the strike is within its range, exact implied vol otherwise
+        proxy = self._putWingProxy if strike < self._strikes[1] else self._callWingProxy
+        if (proxy is not None):
+            lower, upper, coefficients = proxy
+            x = m.log(strike)
+            if (x >= lower and x <= upper):
+                return ChebyshevValue((2.0*x - lower - upper)/(upper - lower), coefficients)
+        
+        return self.GetImpliedWingVol(strike)
+    
+    
+    def GetWingVolArray(self, strikes):
+        # Vectorized GetWingVol()
+        if (self._putWingProxy is None and self._callWingProxy is None):
+            return self.GetImpliedWingVolArray(strikes)
+        
+        vols = np.empty(strikes.shape)
+        exact = np.ones(strikes.shape, dtype=bool)
+        x = np.log(strikes)
+        for proxy, side in [(self._putWingProxy, strikes < self._strikes[1]), (self._callWingProxy, strikes > self._strikes[3])]:
+            if (proxy is not None):
+                lower, upper, coefficients = proxy
+                inside = side & (x >= lower) & (x <= upper)
+                vols[inside] = np.polynomial.chebyshev.chebval((2.0*x[inside] - lower - upper)/(upper - lower), coefficients)
+                exact &= ~inside
+        
+        if exact.any():
+            vols[exact] = self.GetImpliedWingVolArray(strikes[exact])
+        return vols
+    
+    
+    def GetWingParameters(self):
+        return (self._my, self._aput, self._bput, self._cput, self._ny, self._acall, self._bcall, self._ccall)
+    
+    
+    def GetWingPriceStrikeDerivatives(self, strikes):
+        # Wing prices (puts below the 25 delta put strike, calls above) and their first and second strike derivatives
+        return WingPriceStrikeDerivatives(strikes, self._strikes[1], self.GetWingParameters())
+    
+    
+    def GetVolatilityStrikeDerivatives(self, strikes):
+        # SABR derivatives between the 25 delta strikes. In the wings the vol derivatives follow from the price
+        # derivatives: price' = dualDelta + vega*vol', price'' = dualGamma + 2*dualVega*vol' + volga*vol'^2 + vega*vol''
+        vols, dvoldK, d2voldKdK = super().GetVolatilityStrikeDerivatives(strikes)
+        wing = (strikes < self._strikes[1]) | (strikes > self._strikes[3])
+        if wing.any():
+            K = strikes[wing]
+            _, dPdK, d2PdKdK, optionTypes = self.GetWingPriceStrikeDerivatives(K)
+            vols[wing] = self.GetWingVolArray(K)
+            greeks = bs.GarmanKohlhagenGreeks(self._spot, K, self._expiryTerm, self._domesticDeposit, self._foreignDeposit, vols[wing], optionTypes)
+            dvoldK[wing] = (dPdK - greeks.dualDelta)/greeks.vega
+            d2voldKdK[wing] = (d2PdKdK - greeks.dualGamma - 2.0*greeks.dualVega*dvoldK[wing] - greeks.volga*dvoldK[wing]**2)/greeks.vega
+        return vols, dvoldK, d2voldKdK
+    
+    
+    def GetCallStrikeDerivatives(self, strikes):
+        # As FXVolSurface.GetCallStrikeDerivatives(), but the wing prices are differentiated directly (put wing
+        # through put-call parity: dC/dK = dP/dK - exp(-rd*T), d2C/dK2 = d2P/dK2)
+        wing = (strikes < self._strikes[1]) | (strikes > self._strikes[3])
+        dCdK, d2CdKdK = np.empty(strikes.shape), np.empty(strikes.shape)
+        if (~wing).any():
+            dCdK[~wing], d2CdKdK[~wing] = super().GetCallStrikeDerivatives(strikes[~wing])
+        if wing.any():
+            _, dPdK, d2PdKdK, optionTypes = self.GetWingPriceStrikeDerivatives(strikes[wing])
+            dCdK[wing] = np.where(optionTypes == bs.OptionType.Put.value, dPdK - m.exp(-self._domesticDeposit*self._expiryTerm), dPdK)
+            d2CdKdK[wing] = d2PdKdK
+        return dCdK, d2CdKdK
+    
+    
+    def GetImpliedWingVolArray(self, strikes):
+        # Vectorized GetImpliedWingVol(): puts below the 25 delta put strike, calls above
+        prices, optionTypes = WingPrices(strikes, self._strikes[1], self.GetWingParameters())
+        return bs.ImpliedVolatility(prices, self._market.spot, strikes, self._expiryTerm, self._market.depositDomestic, 
+                                    self._market.depositForeign, optionTypes)
+    
+    
     def GetImpliedWingVol(self, strike):
         
-        self._bs._strike = strike
         optionType = bs.OptionType.Call
         
         if (strike < self._strikes[1]):
@@ -57,23 +270,26 @@ class SABRWingSurface(vs.SABRVolSurface):
         else:
             price = self.CallExtrapolationFunction(strike)
                 
-        return self._bs.GetImpliedVolatility(price, optionType)
+        return bs.VanillaImpliedVolatility(self._market, bs.VanillaContract(strike, self._expiryTerm, optionType), price)
         
             
     def PutExtrapolationFunction(self, strike):    
-        return m.exp(self._my*m.log(strike) + self._aput + self._bput*strike + self._cput*strike*strike)
+        # Put wing for any strike (the split strike is pushed above it)
+        return float(WingPrices(strike, m.inf, self.GetWingParameters())[0])
     
     
     def CallExtrapolationFunction(self, strike):    
-        return m.exp(-self._ny*m.log(strike) + self._acall + self._bcall/strike + self._ccall/(strike*strike))
+        return float(WingPrices(strike, -m.inf, self.GetWingParameters())[0])
     
     
     def dI0dK(self, strike, forward, alpha, corr, vovol, beta):
         
         x = self.GetI0x(strike, forward)
+        zeta = vovol*pow(forward, 1.0 - beta)/alpha
         
-        if (forward == strike):
-            return alpha*(beta - 1.0)*pow(strike, beta - 2.0)
+        if (abs(x)*max(abs(zeta), 1.0 - beta) < vs.SabrForwardThreshold):
+            # Near the forward: I0 = alpha*F^(beta-1)*f(x) in x = ln(F/K) (vs.SabrForwardSeries())
+            return -alpha*pow(forward, beta - 1.0)*float(vs.SabrForwardSeries(x, 1.0 - beta, corr, zeta)[1])/strike
         elif (vovol == 0.0):
             den = pow(forward, 1.0 - beta) - pow(strike, 1.0 - beta)
             return -1.0/strike*alpha*(1.0 - beta)/den + x*alpha*pow(1.0 - beta, 2.0)/pow(den, 2.0)*pow(strike, -beta)
@@ -96,9 +312,11 @@ class SABRWingSurface(vs.SABRVolSurface):
     def d2I0dKdK(self, strike, forward, alpha, corr, vovol, beta):
         
         x = self.GetI0x(strike, forward)
+        zeta = vovol*pow(forward, 1.0 - beta)/alpha
         
-        if (forward == strike):
-            return alpha*(beta - 1.0)*(beta - 2.0)*pow(strike, beta - 3.0)
+        if (abs(x)*max(abs(zeta), 1.0 - beta) < vs.SabrForwardThreshold):
+            _, df, d2f = vs.SabrForwardSeries(x, 1.0 - beta, corr, zeta)
+            return alpha*pow(forward, beta - 1.0)*float(d2f + df)/(strike*strike)
         elif (vovol == 0.0):
             frac =(1.0 - beta)/(pow(forward, 1.0 - beta) - pow(strike, 1.0 - beta))            
             
@@ -123,7 +341,7 @@ class SABRWingSurface(vs.SABRVolSurface):
     
     
     def d2I1dKdK(self, strike, forward, alpha, corr, vovol, beta):
-        term1 = (alpha*pow(1.0 - beta, 3.0)*(2.0 - beta)/24.0)*1.0/pow(forward*strike, 3.0 - beta)*forward*forward
+        term1 = (alpha*alpha*pow(1.0 - beta, 3.0)*(2.0 - beta)/24.0)*1.0/pow(forward*strike, 3.0 - beta)*forward*forward
         term2 = (alpha*beta*corr*vovol*(1.0 - beta)*(3.0 - beta)/16.0)*1.0/pow(forward*strike, (5.0 - beta)/2.0)*forward*forward        
         return term1  + term2
 
@@ -142,22 +360,19 @@ class SABRWingSurface(vs.SABRVolSurface):
 
     
     def GetTotaldlogBSdK(self, strike, volatility, optiontype, forward, alpha, corr, vovol, beta):
-        self._bs._strike = strike
-        self._bs._volatility = volatility
-        return (1.0/self._bs.GetOptionValue(optiontype)*(self._bs.GetDualDelta(optiontype) 
-                                                      + self._bs.GetVega()*self.dSABRdK(strike, forward, alpha, corr, vovol, beta)))
+        greeks = bs.VanillaGreeks(self._market, bs.VanillaContract(strike, self._expiryTerm, optiontype), volatility)
+        return (1.0/greeks.value*(greeks.dualDelta + greeks.vega*self.dSABRdK(strike, forward, alpha, corr, vovol, beta)))
                 
 
     def GetTotald2logBSdKdK(self, strike, volatility, optiontype, forward, alpha, corr, vovol, beta):
         
-        self._bs._strike = strike
-        self._bs._volatility = volatility
-        BS = self._bs.GetOptionValue(optiontype)
-        dBSdK = self._bs.GetDualDelta(optiontype)
-        d2BSdKdK = self._bs.GetDualGamma()
-        vega = self._bs.GetVega()
-        volga = self._bs.GetVolga()
-        dualvega = self._bs.GetDualVega()
+        greeks = bs.VanillaGreeks(self._market, bs.VanillaContract(strike, self._expiryTerm, optiontype), volatility)
+        BS = greeks.value
+        dBSdK = greeks.dualDelta
+        d2BSdKdK = greeks.dualGamma
+        vega = greeks.vega
+        volga = greeks.volga
+        dualvega = greeks.dualVega
         dSABRdK = self.dSABRdK(strike, forward, alpha, corr, vovol, beta)
         d2SABRdKdK = self.d2SABRdKdK(strike, forward, alpha, corr, vovol, beta)
                        
@@ -167,43 +382,102 @@ class SABRWingSurface(vs.SABRVolSurface):
         return term1 + term2      
     
        
+    def GetCalibrationState(self):
+        calibrationState = super().GetCalibrationState()
+        calibrationState['wingParameters'] = np.array(self.GetWingParameters())
+        return calibrationState
+
+
+    def SetCalibrationState(self, calibrationState) -> None:
+        super().SetCalibrationState(calibrationState)
+        self._my, self._aput, self._bput, self._cput, self._ny, self._acall, self._bcall, self._ccall = [float(x) for x in calibrationState['wingParameters']]
+        self.BuildWingProxy()
+        pass
+
+
     def CalcWingParameters(self) -> None:
         
-        K10P = self._strikes[0]
-        K25P = self._strikes[1]
-        K25C= self._strikes[3]
-        K10C = self._strikes[4]
+        wingParameters = self.SolveWingParameters(self._strikes, self._volatilitySmile, self._alpha, self._corr, self._vovol)
+        self._my, self._aput, self._bput, self._cput, self._ny, self._acall, self._bcall, self._ccall = wingParameters
+        self.BuildWingProxy()
+        
+        pass
+
+
+    def BuildWingProxy(self) -> None:
+        # Chebyshev interpolation of the wing vols in log-strike on [F*exp(-n*sd), K25P] and [K25C, F*exp(n*sd)],
+        # sd = atm vol*sqrt(T). The lowest degree of WingProxyDegrees whose maximum error against the exact wing vols
+        # (checked on a grid four times denser than the nodes) is within the tolerance is kept; no proxy otherwise
+        self._putWingProxy = None
+        self._callWingProxy = None
+        self._wingProxyError = np.nan
+        if (self._wingProxyTolerance is None):
+            return
+        
+        width = self._wingProxyStandardDeviations*self._volatilitySmile[2]*m.sqrt(self._expiryTerm)
+        logForward = m.log(self._forward)
+        wings = [(logForward - width, m.log(self._strikes[1])), (m.log(self._strikes[3]), logForward + width)]
+        proxies = []
+        errors = []
+        
+        for lower, upper in wings:
+            proxy = None
+            if (upper > lower):
+                for degree in WingProxyDegrees:
+                    nodes = np.polynomial.chebyshev.chebpts1(degree + 1)
+                    coefficients = np.polynomial.chebyshev.chebfit(nodes, self.GetImpliedWingVolArray(np.exp(lower + 0.5*(nodes + 1.0)*(upper - lower))), degree)
+                    # Interior check grid: the 25 delta strikes themselves belong to the SABR region
+                    check = np.linspace(-1.0, 1.0, 4*(degree + 1) + 2)[1:-1]
+                    exact = self.GetImpliedWingVolArray(np.exp(lower + 0.5*(check + 1.0)*(upper - lower)))
+                    error = np.abs(np.polynomial.chebyshev.chebval(check, coefficients) - exact).max()
+                    if (error <= self._wingProxyTolerance):
+                        proxy = (lower, upper, tuple(float(c) for c in coefficients))
+                        errors.append(error)
+                        break
+            proxies.append(proxy)
+        
+        self._putWingProxy, self._callWingProxy = proxies
+        if (len(errors) > 0):
+            self._wingProxyError = max(errors)
+        pass
+    
+    
+    def GetWingProxyError(self):
+        # Maximum measured error of the wing-vol proxy (nan if no proxy is used)
+        return self._wingProxyError
+
+
+    def SolveWingParameters(self, strikes, smile_vec, alpha, corr, vovol):
+        # Put and call wing coefficients [my, aput, bput, cput, ny, acall, bcall, ccall] for the given strikes,
+        # smile and SABR parameters. The surface itself is not modified
+        
+        K10P = strikes[0]
+        K25P = strikes[1]
+        K25C= strikes[3]
+        K10C = strikes[4]
                         
         ##########################################
         #  Solve Put Wing
         ##########################################
-        forward = sfd.ForwardContinuousDeposit(self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm)
+        forward = self._forward
         
         put_matrix = np.array([[     m.log(K25P), 1.0,   K25P, K25P*K25P],
                                [       1.0/K25P , 0.0,    1.0,  2.0*K25P],
                                [-1.0/(K25P*K25P), 0.0,    0.0,       2.0],
                                [     m.log(K10P), 1.0,   K10P, K10P*K10P]])
                 
-        self._bs._strike = K25P
-        sabrvol25 = self.GetVolatility(K25P)
-        self._bs._volatility = sabrvol25
-        logBS25P = m.log(self._bs.GetOptionValue(bs.OptionType.Put))        
-        dlogBSdK = self.GetTotaldlogBSdK(K25P, sabrvol25, bs.OptionType.Put, forward, self._alpha, self._corr, self._vovol, self._beta)        
-        d2logBSdKdK = self.GetTotald2logBSdKdK(K25P, sabrvol25, bs.OptionType.Put, forward, self._alpha, self._corr, self._vovol, self._beta)
-        self._bs._strike = K10P
-        self._bs._volatility = self._volatilitySmile[0]
-        logBS10P = m.log(self._bs.GetOptionValue(bs.OptionType.Put))
+        sabrvol25 = self.SabrImpliedVol(K25P, alpha, corr, vovol, self._beta)
+        logBS25P = m.log(bs.VanillaValue(self._market, bs.VanillaContract(K25P, self._expiryTerm, bs.OptionType.Put), sabrvol25))
+        dlogBSdK = self.GetTotaldlogBSdK(K25P, sabrvol25, bs.OptionType.Put, forward, alpha, corr, vovol, self._beta)        
+        d2logBSdKdK = self.GetTotald2logBSdKdK(K25P, sabrvol25, bs.OptionType.Put, forward, alpha, corr, vovol, self._beta)
+        logBS10P = m.log(bs.VanillaValue(self._market, bs.VanillaContract(K10P, self._expiryTerm, bs.OptionType.Put), smile_vec[0]))
         
         rhs = np.array([[logBS25P], 
                         [dlogBSdK], 
                         [d2logBSdKdK], 
                         [logBS10P]])
         
-        put_solution = np.linalg.inv(put_matrix)@rhs       
-        self._my = put_solution[0][0]
-        self._aput = put_solution[1][0]
-        self._bput = put_solution[2][0]
-        self._cput = put_solution[3][0]
+        put_solution = np.linalg.solve(put_matrix, rhs)       
                 
         
         ##########################################
@@ -214,30 +488,56 @@ class SABRWingSurface(vs.SABRVolSurface):
                                 [ pow(K25C, -2.0), 0.0, 2.0*pow(K25C, -3.0),  6.0*pow(K25C, -4.0)],
                                 [    -m.log(K10C), 1.0,     pow(K10C, -1.0),      pow(K10C, -2.0)]])
         
-        self._bs._strike = K25C
-        sabrvol25_call = self.GetVolatility(K25C)
-        self._bs._volatility = sabrvol25_call
-        logBS25C = m.log(self._bs.GetOptionValue(bs.OptionType.Call))
+        sabrvol25_call = self.SabrImpliedVol(K25C, alpha, corr, vovol, self._beta)
+        logBS25C = m.log(bs.VanillaValue(self._market, bs.VanillaContract(K25C, self._expiryTerm, bs.OptionType.Call), sabrvol25_call))
         
-        dlogBSdK_call = self.GetTotaldlogBSdK(K25C, sabrvol25_call, bs.OptionType.Call, forward, self._alpha, self._corr, self._vovol, self._beta)        
-        d2logBSdKdK_call = self.GetTotald2logBSdKdK(K25C, sabrvol25_call, bs.OptionType.Call, forward, self._alpha, self._corr, self._vovol, self._beta)
-        self._bs._strike = K10C
-        self._bs._volatility = self._volatilitySmile[4]
-        logBS10C = m.log(self._bs.GetOptionValue(bs.OptionType.Call))
+        dlogBSdK_call = self.GetTotaldlogBSdK(K25C, sabrvol25_call, bs.OptionType.Call, forward, alpha, corr, vovol, self._beta)        
+        d2logBSdKdK_call = self.GetTotald2logBSdKdK(K25C, sabrvol25_call, bs.OptionType.Call, forward, alpha, corr, vovol, self._beta)
+        logBS10C = m.log(bs.VanillaValue(self._market, bs.VanillaContract(K10C, self._expiryTerm, bs.OptionType.Call), smile_vec[4]))
         
         rhs_c = np.array([[logBS25C], 
                         [dlogBSdK_call], 
                         [d2logBSdKdK_call], 
                         [logBS10C]])
         
-        call_solution = np.linalg.inv(call_matrix)@rhs_c
-        self._ny = call_solution[0][0]
-        self._acall = call_solution[1][0]
-        self._bcall = call_solution[2][0]
-        self._ccall = call_solution[3][0]
+        call_solution = np.linalg.solve(call_matrix, rhs_c)
         
+        return np.concatenate([put_solution[:, 0], call_solution[:, 0]])
+
+
+    def GetWingVolFromParameters(self, strike, strikes, wingParameters):
+        # Wing volatility for a strike outside [strikes[1], strikes[3]] given wing coefficients from SolveWingParameters()
+        price, optionType = WingPrices(strike, strikes[1], wingParameters)
+        return bs.VanillaImpliedVolatility(self._market, bs.VanillaContract(strike, self._expiryTerm, bs.OptionType(int(optionType))), float(price))
+
+
+    def GetBucketedVega(self, strike, optionType: bs.OptionType):
+        # Bucketed vega against the five quotes. Inside [25P, 25C] the SABR result applies. In the wings the vol 
+        # also depends on the wing coefficients: these are differentiated along the tangent directions 
+        # (dparams/dsmile_j, e_j) given by the implicit function theorem, i.e. without recalibrating SABR
+        if (strike >= self._strikes[1] and strike <= self._strikes[3]):
+            return super().GetBucketedVega(strike, optionType)
         
-        pass
+        sensitivity = self.GetCalibrationSensitivity()
+        params = np.array([self._alpha, self._corr, self._vovol])
+        smile_vec = np.array(self._volatilitySmile, dtype=float)
+        dvoldq = np.zeros(5)
+        h = 1.0e-5
+        
+        for j in range(5):
+            vols = []
+            for sign in [1.0, -1.0]:
+                p = params + sign*h*sensitivity[:, j]
+                q = smile_vec.copy()
+                q[j] += sign*h
+                strikes = self._sd.GetStrikeVector(q)
+                vols.append(self.GetWingVolFromParameters(strike, strikes, self.SolveWingParameters(strikes, q, p[0], p[1], p[2])))
+            dvoldq[j] = (vols[0] - vols[1])/(2.0*h)
+        
+        vol = self.GetImpliedWingVol(strike)
+        vega = bs.VanillaGreeks(self._market, bs.VanillaContract(strike, self._expiryTerm, optionType), vol).vega
+        
+        return vega*dvoldq
 
 
 #//     Unit-Test: SABR with wing extrapolation
@@ -246,6 +546,110 @@ class Test_SABRWing(unittest.TestCase):
     def test_dIdK(self):
         self.assertEqual(1.12345, 1.12345)
 
+    def test_GetVolatilityArray(self):
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        surface = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+        strikes = np.linspace(10.0, 13.5, 71)
+        vols = surface.GetVolatility(strikes)
+        for i in range(len(strikes)):
+            self.assertAlmostEqual(vols[i], surface.GetVolatility(float(strikes[i])), 10)
+
+    def test_WingPrices(self):
+        surface = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, np.array([0.189, 0.171, 0.153, 0.146, 0.146]))
+        K25P, K25C = surface._strikes[1], surface._strikes[3]
+        strikes = np.array([9.8, 10.6, K25P, 12.9, 13.6])
+        prices, optionTypes = WingPrices(strikes, K25P, surface.GetWingParameters())
+        self.assertTrue(np.array_equal(optionTypes, [bs.OptionType.Put.value]*2 + [bs.OptionType.Call.value]*3))
+        self.assertAlmostEqual(prices[0], surface.PutExtrapolationFunction(9.8), 14)
+        self.assertAlmostEqual(prices[4], surface.CallExtrapolationFunction(13.6), 14)
+        # The call wing meets the SABR smile at the 25 delta call strike
+        self.assertAlmostEqual(surface.GetWingVolFromParameters(K25C, surface._strikes, surface.GetWingParameters()), surface.GetVolatility(K25C), 8)
+
+        # Strike derivatives against central differences
+        h = 1.0e-4
+        _, dPdK, d2PdKdK, _ = WingPriceStrikeDerivatives(strikes, K25P, surface.GetWingParameters())
+        up, down = WingPrices(strikes + h, K25P, surface.GetWingParameters())[0], WingPrices(strikes - h, K25P, surface.GetWingParameters())[0]
+        for i in (0, 1, 3, 4):
+            self.assertAlmostEqual(dPdK[i], (up[i] - down[i])/(2.0*h), 8)
+            self.assertAlmostEqual(d2PdKdK[i], (up[i] - 2.0*prices[i] + down[i])/(h*h), 4)
+
+    def test_WingProxy(self):
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        exact = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+        proxy = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile, wingProxyTolerance=1.0e-9, wingProxyStandardDeviations=4.0)
+        self.assertTrue(m.isnan(exact.GetWingProxyError()))
+        self.assertLessEqual(proxy.GetWingProxyError(), 1.0e-9)
+        
+        # Within the stated error in both wings (arrays and floats), exact beyond the proxy range and in the SABR region
+        strikes = np.concatenate([np.linspace(9.0, 13.8, 97), [8.0, 11.7, 16.0]])
+        vols = proxy.GetVolatility(strikes)
+        exactVols = exact.GetVolatility(strikes)
+        self.assertLessEqual(np.abs(vols - exactVols).max(), 1.0e-9)
+        self.assertAlmostEqual(vols[-3], exactVols[-3], 14)
+        self.assertAlmostEqual(vols[-1], exactVols[-1], 14)
+        self.assertAlmostEqual(proxy.GetVolatility(10.3), exact.GetVolatility(10.3), 9)
+        self.assertAlmostEqual(proxy.GetVolatility(13.1), exact.GetVolatility(13.1), 9)
+
+    def test_WingParametersBatch(self):
+        markets = [(11.7336, 0.001671885, 0.061701683, 30/365.0, [0.189, 0.171, 0.153, 0.146, 0.146]),
+                   (82.82, 0.003722718, 0.007776803, 179/365.0, [0.139, 0.124, 0.116, 0.115, 0.121]),
+                   (5.7444, 0.007074041, 0.001127818, 30/365.0, [0.120, 0.116, 0.115, 0.118, 0.124])]
+        surfaces = [SABRWingSurface(*market[:4], np.array(market[4])) for market in markets]
+        
+        # Vectorized strike derivatives of the SABR vol against the scalar ones (closed forms, the series near the forward
+        # and the vovol = 0 limit; the limit itself is checked against finite differences in Test_VolSurface)
+        s = surfaces[0]
+        for vovol in [s._vovol, 0.0]:
+            strikes = np.append(s._strikes, s._forward*np.array([1.0, 1.0 + 1.0e-8]))
+            vol, dvoldK, d2voldKdK = vs.SabrStrikeDerivatives(strikes, s._forward, s._expiryTerm, s._alpha, s._corr, vovol, s._beta)
+            for i in [0, 1, 3, 4, 5, 6]:
+                self.assertAlmostEqual(dvoldK[i], s.dSABRdK(strikes[i], s._forward, s._alpha, s._corr, vovol, s._beta), 12)
+                self.assertAlmostEqual(d2voldKdK[i], s.d2SABRdKdK(strikes[i], s._forward, s._alpha, s._corr, vovol, s._beta), 12)
+        
+        # One batched solve gives the wing vols of the per-surface solve
+        strikes = [np.array([0.8, 0.95, 1.05, 1.2])*surface._forward for surface in surfaces]
+        vols = [surface.GetVolatility(K) for surface, K in zip(surfaces, strikes)]
+        CalcWingParametersBatch(surfaces)
+        for surface, K, expected in zip(surfaces, strikes, vols):
+            self.assertLessEqual(np.abs(surface.GetVolatility(K) - expected).max(), 1.0e-10)
+
+    def test_RiskNeutralDensity(self):
+        # The wing prices are differentiated analytically: the density is continuous at the 25 delta strikes and
+        # the vol derivatives in the wings agree with finite differences of the vols
+        wing = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, np.array([0.189, 0.171, 0.153, 0.146, 0.146]))
+        K25P, K25C = wing._strikes[1], wing._strikes[3]
+        density = wing.GetRiskNeutralDensity(np.array([K25P*(1.0 - 1.0e-9), K25P, K25C, K25C*(1.0 + 1.0e-9)]))
+        self.assertAlmostEqual(density.pdf[0], density.pdf[1], 6)
+        self.assertAlmostEqual(density.pdf[2], density.pdf[3], 6)
+        self.assertAlmostEqual(density.cdf[0], density.cdf[1], 7)
+        
+        strikes, h = np.array([10.2, 13.1]), 1.0e-4
+        vols, dvoldK, d2voldKdK = wing.GetVolatilityStrikeDerivatives(strikes)
+        self.assertLess(np.abs(dvoldK - (wing.GetVolatility(strikes + h) - wing.GetVolatility(strikes - h))/(2.0*h)).max(), 1.0e-8)
+        self.assertLess(np.abs(d2voldKdK - (wing.GetVolatility(strikes + h) - 2.0*vols + wing.GetVolatility(strikes - h))/(h*h)).max(), 1.0e-4)
+        
+        # The exponential wings of the USD/JPY 6M smile are arbitrage free within three standard deviations, not beyond
+        wing = SABRWingSurface(82.82, 0.003722718, 0.007776803, 179/365.0, np.array([0.139, 0.124, 0.116, 0.115, 0.121]))
+        self.assertFalse(wing.GetRiskNeutralDensity(wing.GetDensityStrikes(201, 3.0)).arbitrage.any())
+        self.assertTrue(wing.GetRiskNeutralDensity().arbitrage.any())
+
+    def test_BucketedVega(self):
+        # Bucketed vegas (SABR region and put wing) against bump-and-recalibrate
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        wing = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, smile)
+        for strike, optionType in [(11.6, bs.OptionType.Call), (10.4, bs.OptionType.Put)]:
+            vegas = wing.GetBucketedVega(strike, optionType)
+            for j in range(5):
+                h = 1.0e-4
+                up, down = smile.copy(), smile.copy()
+                up[j] += h
+                down[j] -= h
+                values = []
+                for q in [up, down]:
+                    bumped = SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, q)
+                    values.append(bs.VanillaValue(wing._market, bs.VanillaContract(strike, 30/365.0, optionType), bumped.GetVolatility(strike)))
+                self.assertAlmostEqual(vegas[j], (values[0] - values[1])/(2.0*h), 3)
+
     
 
 if __name__ == '__main__':
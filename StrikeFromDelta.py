@@ -1,6 +1,8 @@
 
 import math
+import enum
 import BlackScholes as bs
+import DepositCurve as dc
 import Utility as u
 import unittest
 import numpy as np 
@@ -10,26 +12,110 @@ def ForwardContinuousDeposit(spot, domesticDeposit, foreignDeposit, expiryTerm):
     return spot * math.exp((domesticDeposit - foreignDeposit) * expiryTerm)
 
 
+class DeltaType(enum.Enum):
+    # Spot:    delta hedged with spot, includes the foreign discount factor exp(-rf*T)
+    # Forward: delta hedged with the outright forward
+    Spot = 1
+    Forward = 2
+
+
+class PremiumType(enum.Enum):
+    # Domestic: premium paid in the domestic currency, unadjusted delta
+    # Foreign:  premium paid in the foreign currency, premium-adjusted delta (delta less the premium in foreign units)
+    Domestic = 1
+    Foreign = 2
+
+
+def GetStrikeFromDeltaArray(deltas, optionTypes, volatilities, spot, domesticDeposit, foreignDeposit, expiryTerm,
+                            deltaType: DeltaType = DeltaType.Spot, premiumType: PremiumType = PremiumType.Domestic, logStrikeAccuracy=1.0e-12):
+    """   Strikes for arrays of deltas, option types (OptionType or array of OptionType values), volatilities and 
+        market data (spot, deposits, expiry), all broadcast against each other. The deposits may be DepositCurve
+        objects, read at the expiries in one vectorized call.
+        Unadjusted deltas invert in closed form. Premium-adjusted deltas, sign*(K/F)*N(sign*d2) in forward terms,
+        are solved in log-strike by one vectorized Illinois solve (u.illinois()) for all elements: puts on 
+        [delta*F, K unadjusted] (monotonic), calls on [K of the maximum premium-adjusted delta, K unadjusted], 
+        i.e. the strike above the maximum delta strike as per market convention.
+    """
+    sign = bs.GetOptionSign(optionTypes)
+    domesticDeposit, foreignDeposit = dc.GetDeposit(domesticDeposit, expiryTerm), dc.GetDeposit(foreignDeposit, expiryTerm)
+    delta, volatility, spot, rd, rf, T = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in 
+                                                               [deltas, volatilities, spot, domesticDeposit, foreignDeposit, expiryTerm]])
+    sign = np.broadcast_to(sign, delta.shape)
+    delta = np.abs(delta)
+    delta = np.where(delta >= 1.0, 0.999, delta)
+    
+    if (volatility > 2.0).any():
+        raise ValueError('The volatility should be below 200%')
+    
+    # Deltas in forward terms
+    forward = spot*np.exp((rd - rf)*T)
+    z = np.exp(rf*T)*delta if deltaType == DeltaType.Spot else delta
+    if (z >= 1.0).any():
+        raise ValueError('No solution for this delta and/or these parameters')
+    
+    standardDeviation = volatility*np.sqrt(T)
+    unadjusted = forward*np.exp(-sign*u.NormInverseCdf(z)*standardDeviation + 0.5*standardDeviation*standardDeviation)
+    if (premiumType == PremiumType.Domestic):
+        return unadjusted
+    
+    logForward = np.log(forward)
+    call = sign > 0.0
+    lower = np.log(z*forward)
+    
+    if call.any():
+        # The premium-adjusted call delta is maximal where standardDeviation*N(d2) = n(d2)
+        sdCall = standardDeviation[call]
+        d2 = u.illinois(lambda x: sdCall*u.NormCdf(x) - u.NormPdf(x), -sdCall, 10.0, 1.0e-12).root
+        logStrikeMax = logForward[call] - d2*sdCall - 0.5*sdCall*sdCall
+        if (np.exp(logStrikeMax - logForward[call])*u.NormCdf(d2) < z[call]).any():
+            raise ValueError('Delta above the maximum premium-adjusted call delta')
+        lower[call] = logStrikeMax
+    
+    def PremiumAdjustedDelta(logStrike):
+        d2 = (logForward - logStrike)/standardDeviation - 0.5*standardDeviation
+        return np.exp(logStrike - logForward)*u.NormCdf(sign*d2) - z
+    
+    return np.exp(u.illinois(PremiumAdjustedDelta, lower, np.log(unadjusted), logStrikeAccuracy).root)
+
+
+# Deltas and option types of the four wing quotes of a smile: 10d put, 25d put, 25d call, 10d call
+_SmileDeltas = np.array([0.1, 0.25, 0.25, 0.1])
+_SmileOptionTypes = np.array([bs.OptionType.Put.value, bs.OptionType.Put.value, bs.OptionType.Call.value, bs.OptionType.Call.value])
+
+
 class StrikeFromDelta:
     
-    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm):
+    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, deltaType: DeltaType = DeltaType.Spot, 
+                 premiumType: PremiumType = PremiumType.Domestic):
+        # Deposits: floats or DepositCurve objects (read at expiryTerm)
         self._spot = spot
-        self._domesticDeposit = domesticDeposit
-        self._foreignDeposit = foreignDeposit
+        self._domesticDeposit = dc.GetDeposit(domesticDeposit, expiryTerm)
+        self._foreignDeposit = dc.GetDeposit(foreignDeposit, expiryTerm)
         self._expiryTerm = expiryTerm
+        
+        # Forward and foreign compounding factor exp(rf*T) are fixed for the object
+        self._forward = ForwardContinuousDeposit(self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm)
+        self._foreignCompounding = math.exp(self._foreignDeposit*self._expiryTerm)
+        
+        # Quoting convention of the smile deltas (GetStrikeVector())
+        self._deltaType = deltaType
+        self._premiumType = premiumType
+
+
+    def GetForward(self):
+        return self._forward
 
     
     def GetATMStrike(self, volatility):
-        fwd = ForwardContinuousDeposit(self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm)                
+        # Delta neutral straddle strike, depends on the premium type only
+        fwd = self._forward
         
-        # Below in case Premium-Type should be implemented
-        # if (_premiumtype == PremiumType.DOMESTIC):
-        #     retval = fwd * math.exp(0.5 * volatility * volatility * self._expiryTerm)
-        # elif (_premiumtype == PremiumType.FOREIGN):
-        #     retval = fwd * math.exp(-0.5 * volatility * volatility * self._expiryTerm)
-        # else:
-        #     raise ValueError('GetATMStrike Exception')        
-        return fwd * math.exp(0.5 * volatility * volatility * self._expiryTerm)
+        if (self._premiumType == PremiumType.Domestic):
+            return fwd * math.exp(0.5 * volatility * volatility * self._expiryTerm)
+        elif (self._premiumType == PremiumType.Foreign):
+            return fwd * math.exp(-0.5 * volatility * volatility * self._expiryTerm)
+        else:
+            raise ValueError('GetATMStrike Exception')
 
     
     def GetStrikeFromDomesticDelta(self, delta, optiontype: bs.OptionType, volatility):
@@ -45,7 +131,7 @@ class StrikeFromDelta:
         
         # Below in case Delta-Type should be implemented
         #if (deltaType = DeltaType:SPOT):
-        z = math.exp(self._foreignDeposit*self._expiryTerm)*delta    
+        z = self._foreignCompounding*delta    
         # else:
         #     z = delta
                         
@@ -53,7 +139,7 @@ class StrikeFromDelta:
             raise ValueError('No solution for this delta and/or these parameters')
         
         norm_inverse = u.Norm().InverseCdf(z)
-        forward = ForwardContinuousDeposit(self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm)
+        forward = self._forward
         
         if (volatility>2.0):
             raise ValueError('The volatility should be below 200%')
@@ -61,14 +147,42 @@ class StrikeFromDelta:
         return forward*math.exp(-sign*norm_inverse*volatility*math.sqrt(self._expiryTerm) + 0.5*volatility*volatility*self._expiryTerm)
 
 
+    def GetStrikeFromDomesticDeltaArray(self, deltas, optiontypes, volatilities):
+        # Vectorized GetStrikeFromDomesticDelta(): deltas, option types (OptionType or array of OptionType 
+        # values) and volatilities are broadcast against each other and one inverse-normal call is made
+        sign = bs.GetOptionSign(optiontypes)
+        delta = np.abs(np.asarray(deltas, dtype=float))
+        delta = np.where(delta >= 1.0, 0.999, delta)
+        volatility = np.asarray(volatilities, dtype=float)
+
+        z = self._foreignCompounding*delta
+        if (z >= 1.0).any():
+            raise ValueError('No solution for this delta and/or these parameters')
+        if (volatility > 2.0).any():
+            raise ValueError('The volatility should be below 200%')
+        
+        norm_inverse = u.NormInverseCdf(z)
+        forward = self._forward
+
+        return forward*np.exp(-sign*norm_inverse*volatility*math.sqrt(self._expiryTerm) + 0.5*volatility*volatility*self._expiryTerm)
+
+
+    def GetStrikeFromDeltaArray(self, deltas, optiontypes, volatilities, deltaType: DeltaType = None, premiumType: PremiumType = None):
+        # Strikes in the given delta convention (default: the convention of this object), see GetStrikeFromDeltaArray()
+        return GetStrikeFromDeltaArray(deltas, optiontypes, volatilities, self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm,
+                                       self._deltaType if deltaType is None else deltaType, self._premiumType if premiumType is None else premiumType)
+
+
     def GetStrikeVector(self, volSmile):
 
-        retval = np.zeros(5)       
-        retval[0] = self.GetStrikeFromDomesticDelta(0.1, bs.OptionType.Put, volSmile[0])
-        retval[1] = self.GetStrikeFromDomesticDelta(0.25, bs.OptionType.Put, volSmile[1])
+        retval = np.zeros(5)
+        wingVols = np.array([volSmile[0], volSmile[1], volSmile[3], volSmile[4]])
+        if (self._deltaType == DeltaType.Spot and self._premiumType == PremiumType.Domestic):
+            wings = self.GetStrikeFromDomesticDeltaArray(_SmileDeltas, _SmileOptionTypes, wingVols)
+        else:
+            wings = self.GetStrikeFromDeltaArray(_SmileDeltas, _SmileOptionTypes, wingVols)
+        retval[0], retval[1], retval[3], retval[4] = wings
         retval[2] = self.GetATMStrike(volSmile[2])
-        retval[3] = self.GetStrikeFromDomesticDelta(0.25, bs.OptionType.Call, volSmile[3])
-        retval[4] = self.GetStrikeFromDomesticDelta(0.1, bs.OptionType.Call, volSmile[4])
 
         return retval
  
@@ -110,6 +224,55 @@ class Test_StrikeFromDelta(unittest.TestCase):
     def test_GetForward(self):
         self.assertEqual(round(ForwardContinuousDeposit(100.0, 0.01, 0.05, 0.7), 12), round(97.2388366801247, 12))
 
+    def test_GetStrikeFromDomDeltaArray(self):
+        deltas = np.array([0.23, 0.1, 0.4])
+        types = np.array([bs.OptionType.Call, bs.OptionType.Put, bs.OptionType.Put])
+        vols = np.array([0.12, 0.15, 0.11])
+        strikes = self.sfd.GetStrikeFromDomesticDeltaArray(deltas, types, vols)
+        for i in range(3):
+            self.assertAlmostEqual(strikes[i], self.sfd.GetStrikeFromDomesticDelta(deltas[i], types[i], vols[i]), 12)
+
+    def test_GetStrikeFromDeltaConventions(self):
+        # Strikes of a grid of deltas in all conventions give back the deltas from the Garman-Kohlhagen Greeks
+        # (premium-adjusted delta = delta - premium/spot, forward delta = spot delta*exp(rf*T))
+        deltas = np.array([0.1, 0.25, 0.4, 0.1, 0.25, 0.4])
+        types = np.array([bs.OptionType.Put.value]*3 + [bs.OptionType.Call.value]*3)
+        vols = np.array([0.15, 0.12, 0.11, 0.11, 0.12, 0.14])
+        expiries = np.array([7/365.0, 30/365.0, 0.5, 1.0, 2.0, 0.25])
+        for deltaType in DeltaType:
+            for premiumType in PremiumType:
+                strikes = GetStrikeFromDeltaArray(deltas, types, vols, 100.0, 0.01, 0.02, expiries, deltaType, premiumType)
+                greeks = bs.GarmanKohlhagenGreeks(100.0, strikes, expiries, 0.01, 0.02, vols, types)
+                delta = greeks.domesticSpotDelta - (greeks.value/100.0 if premiumType == PremiumType.Foreign else 0.0)
+                if (deltaType == DeltaType.Forward):
+                    delta = delta*np.exp(0.02*expiries)
+                self.assertLess(np.abs(np.abs(delta) - deltas).max(), 1.0e-9)
+        
+        # Premium-adjusted call deltas are bounded, the premium-adjusted ATM strike is F*exp(-vol^2*T/2)
+        with self.assertRaises(ValueError):
+            GetStrikeFromDeltaArray(0.9, bs.OptionType.Call, 0.5, 100.0, 0.01, 0.02, 2.0, DeltaType.Forward, PremiumType.Foreign)
+        sfdAdjusted = StrikeFromDelta(100.0, 0.01, 0.02, 1.0, DeltaType.Spot, PremiumType.Foreign)
+        self.assertAlmostEqual(sfdAdjusted.GetATMStrike(0.11), ForwardContinuousDeposit(100.0, 0.01, 0.02, 1.0)*math.exp(-0.5*0.11*0.11), 12)
+        strikeVector = sfdAdjusted.GetStrikeVector(np.array([0.15, 0.12, 0.11, 0.11, 0.12]))
+        self.assertAlmostEqual(strikeVector[1], GetStrikeFromDeltaArray(0.25, bs.OptionType.Put, 0.12, 100.0, 0.01, 0.02, 1.0, 
+                                                                        DeltaType.Spot, PremiumType.Foreign)[()], 12)
+
+    def test_DepositCurveInputs(self):
+        # Deposit curves give the same results as the deposits read off the curves at expiry
+        rd = dc.DepositCurve([30/365.0, 1.0], [0.001671885, 0.00503213])
+        rf = dc.DepositCurve([30/365.0, 1.0], [0.061701683, 0.064996107])
+        T = 0.5
+        sfdCurve = StrikeFromDelta(11.7336, rd, rf, T)
+        sfdFlat = StrikeFromDelta(11.7336, rd.GetDeposit(T), rf.GetDeposit(T), T)
+        self.assertAlmostEqual(sfdCurve.GetForward(), dc.ForwardCurve(11.7336, rd, rf).GetForward(T), 12)
+        self.assertEqual(sfdCurve.GetStrikeFromDomesticDelta(0.25, bs.OptionType.Put, 0.2), sfdFlat.GetStrikeFromDomesticDelta(0.25, bs.OptionType.Put, 0.2))
+        self.assertEqual(bs.Vanilla(11.7336, 12.0, T, rd, rf, 0.2).GetOptionValue(bs.OptionType.Call),
+                         bs.Vanilla(11.7336, 12.0, T, rd.GetDeposit(T), rf.GetDeposit(T), 0.2).GetOptionValue(bs.OptionType.Call))
+
+        expiries = np.array([7/365.0, 0.5, 2.0])
+        strikes = GetStrikeFromDeltaArray(0.25, bs.OptionType.Call, 0.2, 11.7336, rd, rf, expiries)
+        self.assertAlmostEqual(strikes[1], sfdFlat.GetStrikeFromDomesticDelta(0.25, bs.OptionType.Call, 0.2), 12)
+
     def test_GetStrikeVec(self):
         strikes = np.array([9.796265875871027, 10.067098505250692, 10.356101824110898, 10.687697656702378, 11.069582777590423])
         vols = np.array([0.09852, 0.09542, 0.0973, 0.10582, 0.11732])
@@ -0,0 +1,134 @@
+"""
+ FX Vanilla option tools: Bulk calibration of many smiles on a process pool
+
+"""
+import collections
+import concurrent.futures as cf
+import math as m
+import os
+import numpy as np
+import VolatilitySurface as vs
+import SABRWing as sw
+import unittest
+
+
+# One smile to calibrate: market data and the five quotes (10dput, 25dput, atm, 25dcall, 10dcall)
+CalibrationInput = collections.namedtuple('CalibrationInput', ['spot', 'domesticDeposit', 'foreignDeposit', 'expiryTerm', 'volatilitySmile'])
+
+# Calibrated parameters of one smile. wingParameters are [my, aput, bput, cput, ny, acall, bcall, ccall] (SABRWingSurface)
+# or None (SABR only). On failure the parameters are nan and error holds the reason
+CalibrationRecord = collections.namedtuple('CalibrationRecord', ['alpha', 'corr', 'vovol', 'beta', 'wingParameters', 'error'])
+
+
+def CalibrateSmile(calibrationInput: CalibrationInput, beta=0.85, wings=True, calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    # Calibrate one smile. Errors are returned in the record, not raised
+    try:
+        spot, domesticDeposit, foreignDeposit, expiryTerm, smile = calibrationInput
+        if (wings):
+            surface = sw.SABRWingSurface(spot, domesticDeposit, foreignDeposit, expiryTerm, np.asarray(smile, dtype=float), beta, calibrationMethod)
+            wingParameters = (surface._my, surface._aput, surface._bput, surface._cput, surface._ny, surface._acall, surface._bcall, surface._ccall)
+        else:
+            surface = vs.SABRVolSurface(spot, domesticDeposit, foreignDeposit, expiryTerm, np.asarray(smile, dtype=float), beta, 
+                                        calibrationMethod=calibrationMethod)
+            wingParameters = None
+
+        return CalibrationRecord(surface._alpha, surface._corr, surface._vovol, beta, wingParameters, None)
+    except Exception as e:
+        return CalibrationRecord(m.nan, m.nan, m.nan, beta, None, type(e).__name__ + ': ' + str(e))
+
+
+def CalibrateChunk(calibrationInputs, beta=0.85, wings=True, calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    # Unit of work sent to a worker process: the SABR calibrations of a list of inputs run serially, the wing
+    # coefficients of the chunk are then solved in one batch (sw.SolveWingParametersArray())
+    if not (wings):
+        return [CalibrateSmile(calibrationInput, beta, wings, calibrationMethod) for calibrationInput in calibrationInputs]
+    
+    records = []
+    surfaces = []
+    for calibrationInput in calibrationInputs:
+        try:
+            spot, domesticDeposit, foreignDeposit, expiryTerm, smile = calibrationInput
+            surfaces.append(vs.SABRVolSurface(spot, domesticDeposit, foreignDeposit, expiryTerm, np.asarray(smile, dtype=float), beta, 
+                                              sw.WingCalibrationWeights, calibrationMethod))
+            records.append(None)
+        except Exception as e:
+            records.append(CalibrationRecord(m.nan, m.nan, m.nan, beta, None, type(e).__name__ + ': ' + str(e)))
+    
+    if (len(surfaces) > 0):
+        try:
+            wingParameters = sw.SolveWingParametersArray([s._spot for s in surfaces], [s._domesticDeposit for s in surfaces], 
+                                                         [s._foreignDeposit for s in surfaces], [s._expiryTerm for s in surfaces],
+                                                         [s._strikes for s in surfaces], [s._volatilitySmile for s in surfaces],
+                                                         [s._alpha for s in surfaces], [s._corr for s in surfaces], [s._vovol for s in surfaces], beta)
+        except np.linalg.LinAlgError:
+            # A singular wing system fails the whole batch: solve the smiles one by one to isolate it
+            return [CalibrateSmile(calibrationInput, beta, wings, calibrationMethod) for calibrationInput in calibrationInputs]
+        
+        calibrated = iter(zip(surfaces, wingParameters))
+        for i in range(len(records)):
+            if (records[i] is None):
+                surface, parameters = next(calibrated)
+                if np.isfinite(parameters).all():
+                    records[i] = CalibrationRecord(surface._alpha, surface._corr, surface._vovol, beta, tuple(float(x) for x in parameters), None)
+                else:
+                    records[i] = CalibrationRecord(m.nan, m.nan, m.nan, beta, None, 'ValueError: Wing parameters are not finite - CalibrateChunk')
+    
+    return records
+
+
+def CalibrateSmiles(calibrationInputs, beta=0.85, wings=True, maxWorkers=None, chunkSize=None, 
+                    calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    """   Calibrate a list of CalibrationInput on a process pool and return one CalibrationRecord per input
+        (same order). The inputs are split in chunks (default: about four chunks per worker) so that the
+        inter-process overhead is paid per chunk and not per smile, while the load stays balanced.
+        The calibrations are independent and CPU bound, so the throughput scales with the number of cores.
+        A failing smile gives a record with the error, the rest of the batch is calibrated.
+        maxWorkers=1 calibrates in the calling process.
+    """
+    calibrationInputs = list(calibrationInputs)
+    numberOfInputs = len(calibrationInputs)
+    if (maxWorkers is None):
+        maxWorkers = os.cpu_count() or 1
+    maxWorkers = max(1, min(maxWorkers, numberOfInputs))
+
+    if (maxWorkers == 1 or numberOfInputs <= 1):
+        return CalibrateChunk(calibrationInputs, beta, wings, calibrationMethod)
+
+    if (chunkSize is None):
+        chunkSize = max(1, m.ceil(numberOfInputs / (4 * maxWorkers)))
+    chunks = [calibrationInputs[i:i + chunkSize] for i in range(0, numberOfInputs, chunkSize)]
+
+    with cf.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        results = executor.map(CalibrateChunk, chunks, [beta]*len(chunks), [wings]*len(chunks), [calibrationMethod]*len(chunks))
+        return [record for chunk in results for record in chunk]
+
+
+
+#//     Unit-Test: Bulk calibration
+class Test_SurfaceCalibration(unittest.TestCase):
+
+    def test_CalibrateSmiles(self):
+        inputs = [CalibrationInput(11.7336, 0.001671885, 0.061701683, 30/365.0, np.array([0.189, 0.171, 0.153, 0.146, 0.146])),
+                  CalibrationInput(5.7444, 0.007074041, 0.001127818, 30/365.0, np.array([0.120, 0.116, 0.115, 0.118, 0.124])),
+                  CalibrationInput(82.82, 0.001671885, 0.004316413, 31/365.0, np.array([0.114, 0.106, -0.101, 0.103, 0.109])),
+                  CalibrationInput(82.82, 0.003722718, 0.007776803, 179/365.0, np.array([0.139, 0.124, 0.116, 0.115, 0.121]))]
+
+        records = CalibrateSmiles(inputs, maxWorkers=2, chunkSize=1)
+        self.assertEqual(len(records), 4)
+
+        # The failing smile (negative ATM vol) is reported, the others are calibrated as in the serial case
+        self.assertIsNotNone(records[2].error)
+        self.assertTrue(m.isnan(records[2].alpha))
+        for i in [0, 1, 3]:
+            self.assertIsNone(records[i].error)
+            surface = sw.SABRWingSurface(*inputs[i])
+            self.assertEqual((records[i].alpha, records[i].corr, records[i].vovol), (surface._alpha, surface._corr, surface._vovol))
+            self.assertTrue(np.allclose(records[i].wingParameters, surface.GetCalibrationState()['wingParameters'], rtol=1.0e-6, atol=0.0))
+            self.assertAlmostEqual(surface.GetWingVolFromParameters(0.9*surface._strikes[0], surface._strikes, records[i].wingParameters),
+                                   surface.GetVolatility(0.9*surface._strikes[0]), 10)
+
+        self.assertEqual(CalibrateSmiles(inputs[:2], wings=False, maxWorkers=1)[1].wingParameters, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
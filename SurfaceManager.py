@@ -0,0 +1,226 @@
+"""
+ FX Vanilla option tools: Asyncio pipeline recalibrating volatility surfaces from a stream of smile ticks
+
+"""
+import asyncio
+import collections
+import copy
+import time
+import numpy as np
+import VolatilitySurface as vs
+import SABRWing as sw
+import DepositCurve as dc
+import unittest
+
+
+# Smile update for one (pair, expiryTerm). timestamp is time.monotonic() at reception
+SmileTick = collections.namedtuple('SmileTick', ['pair', 'expiryTerm', 'spot', 'domesticDeposit', 'foreignDeposit', 'volatilitySmile', 'timestamp'])
+
+# Pipeline counters and tick-to-publish latencies (seconds) over the last latencyWindow publications
+SurfaceManagerMetrics = collections.namedtuple('SurfaceManagerMetrics', ['received', 'coalesced', 'calibrated', 'failed', 'pending',
+                                                                         'latencyMedian', 'latency99', 'latencyMax'])
+
+
+def CalibrateTick(tick: SmileTick, previous, beta=0.85, calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell):
+    # New SABRWingSurface for the tick. If only the smile moved since the previous surface, a copy of it is
+    # recalibrated (warm start, see SABRVolSurface.Recalibrate()); the previous surface itself is never modified.
+    # Deposits may be DepositCurve objects and are compared at expiry, as stored on the surface
+    smile = np.asarray(tick.volatilitySmile, dtype=float)
+    deposits = (dc.GetDeposit(tick.domesticDeposit, tick.expiryTerm), dc.GetDeposit(tick.foreignDeposit, tick.expiryTerm))
+    if (previous is not None and (previous._spot, previous._domesticDeposit, previous._foreignDeposit) == (tick.spot, *deposits)):
+        surface = copy.deepcopy(previous)
+        surface.SetVolatilitySmile(smile)
+        surface.Recalibrate()
+        return surface
+
+    return sw.SABRWingSurface(tick.spot, tick.domesticDeposit, tick.foreignDeposit, tick.expiryTerm, smile, beta, calibrationMethod)
+
+
+class SurfaceManager:
+    """   Consumes smile ticks and publishes calibrated SABRWingSurface objects per (pair, expiryTerm).
+        - Coalescing: while a key waits for calibration, newer ticks replace the pending one, so a burst
+          costs one calibration on the latest smile.
+        - Backpressure: at most maxPending keys wait for calibration, Submit() waits when the queue is full.
+        - Calibrations run in executor (None: the loop's default thread pool; a ProcessPoolExecutor may be
+          given as CalibrateTick() and the surfaces are picklable), numberOfWorkers at a time.
+        - Publication: a new surface object replaces the old one in a single assignment; published surfaces
+          are never modified afterwards, so readers (GetSurface()) always see a complete calibration.
+    """
+
+    def __init__(self, executor=None, numberOfWorkers=1, maxPending=1000, beta=0.85,
+                 calibrationMethod: vs.CalibrationMethod = vs.CalibrationMethod.Powell, latencyWindow=10000):
+        self._executor = executor
+        self._numberOfWorkers = numberOfWorkers
+        self._maxPending = maxPending
+        self._beta = beta
+        self._calibrationMethod = calibrationMethod
+
+        self._surfaces = {}
+        self._publishedTicks = {}
+        self._errors = {}
+        self._pendingTicks = {}
+        self._queue = None
+        self._workers = []
+
+        self._received = 0
+        self._coalesced = 0
+        self._calibrated = 0
+        self._failed = 0
+        self._latencies = collections.deque(maxlen=latencyWindow)
+
+
+    def Start(self) -> None:
+        # Start the calibration workers on the running event loop
+        self._queue = asyncio.Queue(maxsize=self._maxPending)
+        self._workers = [asyncio.create_task(self.Worker()) for _ in range(self._numberOfWorkers)]
+        pass
+
+
+    async def Stop(self) -> None:
+        # Calibrate what is pending, then stop the workers
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        pass
+
+
+    async def Submit(self, tick: SmileTick) -> None:
+        key = (tick.pair, tick.expiryTerm)
+        self._received += 1
+
+        if (key in self._pendingTicks):
+            self._pendingTicks[key] = tick
+            self._coalesced += 1
+            return
+
+        self._pendingTicks[key] = tick
+        await self._queue.put(key)
+        pass
+
+
+    async def Run(self, ticks) -> None:
+        # Feed an (async) iterable of ticks through the pipeline and wait until all are calibrated
+        self.Start()
+        if hasattr(ticks, '__aiter__'):
+            async for tick in ticks:
+                await self.Submit(tick)
+        else:
+            for tick in ticks:
+                await self.Submit(tick)
+        await self.Stop()
+        pass
+
+
+    async def Worker(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            key = await self._queue.get()
+            try:
+                tick = self._pendingTicks.pop(key)
+                try:
+                    surface = await loop.run_in_executor(self._executor, CalibrateTick, tick, self._surfaces.get(key), self._beta, self._calibrationMethod)
+                except Exception as e:
+                    self._failed += 1
+                    self._errors[key] = type(e).__name__ + ': ' + str(e)
+                    continue
+
+                # With several workers an older tick may finish last: only newer ticks are published
+                published = self._publishedTicks.get(key)
+                if (published is None or published.timestamp <= tick.timestamp):
+                    self._surfaces[key] = surface
+                    self._publishedTicks[key] = tick
+                    self._errors.pop(key, None)
+                self._calibrated += 1
+                self._latencies.append(time.monotonic() - tick.timestamp)
+            finally:
+                self._queue.task_done()
+
+
+    def GetSurface(self, pair, expiryTerm):
+        # Latest published surface (None before the first calibration). Readers must not modify it
+        return self._surfaces.get((pair, expiryTerm))
+
+
+    def GetError(self, pair, expiryTerm):
+        # Error of the last failed calibration of (pair, expiryTerm) since its last publication, if any
+        return self._errors.get((pair, expiryTerm))
+
+
+    def GetMetrics(self):
+        latencies = np.array(self._latencies)
+        if (len(latencies) > 0):
+            median, p99, maximum = np.percentile(latencies, 50.0), np.percentile(latencies, 99.0), latencies.max()
+        else:
+            median = p99 = maximum = np.nan
+
+        return SurfaceManagerMetrics(self._received, self._coalesced, self._calibrated, self._failed, len(self._pendingTicks),
+                                     median, p99, maximum)
+
+
+async def GenerateTicks(markets, numberOfTicks, interval=0.0, volatilityStep=0.0002, seed=1):
+    """   In-process tick generator for testing: markets maps (pair, expiryTerm) to (spot, domesticDeposit,
+        foreignDeposit, volatilitySmile). Every tick moves the five vols of a random market by a random walk
+        step (volatilityStep standard deviation). interval seconds are awaited between ticks (0.0: bursts).
+    """
+    rng = np.random.default_rng(seed)
+    keys = list(markets.keys())
+    smiles = {key: np.array(markets[key][3], dtype=float) for key in keys}
+
+    for _ in range(numberOfTicks):
+        key = keys[rng.integers(len(keys))]
+        smiles[key] = smiles[key] + rng.normal(0.0, volatilityStep, 5)
+        spot, domesticDeposit, foreignDeposit, _ = markets[key]
+        yield SmileTick(key[0], key[1], spot, domesticDeposit, foreignDeposit, smiles[key].copy(), time.monotonic())
+        await asyncio.sleep(interval)
+
+
+
+#//     Unit-Test: Surface manager
+class Test_SurfaceManager(unittest.TestCase):
+
+    def test_SurfaceManager(self):
+        markets = {('ZARJPY', 30/365.0): (11.7336, 0.001671885, 0.061701683, [0.189, 0.171, 0.153, 0.146, 0.146]),
+                   ('USDJPY', 31/365.0): (82.82, 0.001671885, 0.004316413, [0.114, 0.106, 0.101, 0.103, 0.109])}
+        manager = SurfaceManager(calibrationMethod=vs.CalibrationMethod.LevenbergMarquardt, maxPending=1)
+        ticks = []
+
+        async def Record():
+            async for tick in GenerateTicks(markets, 40):
+                ticks.append(tick)
+                yield tick
+
+        asyncio.run(manager.Run(Record()))
+        metrics = manager.GetMetrics()
+
+        # Bursts are coalesced: every tick is either calibrated or replaced by a newer one
+        self.assertEqual(metrics.received, 40)
+        self.assertEqual(metrics.coalesced + metrics.calibrated + metrics.failed, 40)
+        self.assertGreater(metrics.coalesced, 0)
+        self.assertEqual(metrics.pending, 0)
+        self.assertGreaterEqual(metrics.latencyMax, metrics.latencyMedian)
+
+        # The published surfaces are calibrated to the latest smile of each market
+        for key in markets:
+            last = [tick for tick in ticks if (tick.pair, tick.expiryTerm) == key][-1]
+            surface = manager.GetSurface(*key)
+            self.assertTrue(np.array_equal(surface._volatilitySmile, last.volatilitySmile))
+            fresh = sw.SABRWingSurface(last.spot, last.domesticDeposit, last.foreignDeposit, last.expiryTerm, last.volatilitySmile,
+                                       calibrationMethod=vs.CalibrationMethod.LevenbergMarquardt)
+            self.assertAlmostEqual(surface.GetVolatility(last.spot), fresh.GetVolatility(last.spot), 8)
+
+    def test_CalibrateTickDepositCurves(self):
+        # Ticks carrying deposit curves are warm started from the previous surface like ticks with float deposits
+        rd = dc.DepositCurve([7/365.0, 1.0], [0.000901339, 0.00503213])
+        rf = dc.DepositCurve([7/365.0, 1.0], [0.056517435, 0.064996107])
+        smile = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        previous = CalibrateTick(SmileTick('ZARJPY', 30/365.0, 11.7336, rd, rf, smile, time.monotonic()), None)
+        surface = CalibrateTick(SmileTick('ZARJPY', 30/365.0, 11.7336, rd, rf, smile + 0.001, time.monotonic()), previous)
+        self.assertTrue(surface._warmStarted)
+        self.assertFalse(previous._warmStarted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""
+ FX Vanilla option tools: Shared-memory store of calibrated SABR wing surfaces for multi-process pricing
+
+"""
+import multiprocessing as mp
+import multiprocessing.shared_memory as sm
+import numpy as np
+import BlackScholes as bs
+import VolatilitySurface as vs
+import SABRWing as sw
+import unittest
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+
+# Fixed layout of one calibrated surface (SurfaceRecordType.itemsize bytes). sequence is even when the record is consistent and odd while
+# the publisher writes it; a zero sequence marks an empty slot
+SurfaceRecordType = np.dtype([('sequence', 'i8'), ('pair', 'S16'), ('spot', 'f8'), ('domesticDeposit', 'f8'), ('foreignDeposit', 'f8'),
+                              ('expiryTerm', 'f8'), ('volatilitySmile', 'f8', 5), ('strikes', 'f8', 5), ('alpha', 'f8'), ('corr', 'f8'),
+                              ('vovol', 'f8'), ('beta', 'f8'), ('parameterBounds', 'f8', 4), ('wingParameters', 'f8', 8)])
+
+
+def EncodePair(pair):
+    # Bytes of pair as stored in the record; numpy would silently truncate longer names, so they are rejected
+    encoded = pair.encode()
+    if (len(encoded) > SurfaceRecordType['pair'].itemsize):
+        raise ValueError('Pair ' + pair + ' longer than ' + str(SurfaceRecordType['pair'].itemsize) + ' bytes - SurfaceStore->EncodePair')
+    return encoded
+
+
+def GetSurfaceRecord(pair, surface: sw.SABRWingSurface):
+    # Record (numpy structured scalar) of a calibrated SABRWingSurface
+    calibrationState = surface.GetCalibrationState()
+    record = np.zeros((), dtype=SurfaceRecordType)
+    record['pair'] = EncodePair(pair)
+    record['spot'], record['domesticDeposit'], record['foreignDeposit'] = surface._spot, surface._domesticDeposit, surface._foreignDeposit
+    record['expiryTerm'] = surface._expiryTerm
+    record['volatilitySmile'] = surface._volatilitySmile
+    record['strikes'] = calibrationState['strikes']
+    record['alpha'], record['corr'], record['vovol'] = calibrationState['sabrParameters']
+    record['beta'] = surface._beta
+    record['parameterBounds'] = calibrationState['parameterBounds']
+    record['wingParameters'] = calibrationState['wingParameters']
+    return record
+
+
+def GetRecordVolatility(record, strikes):
+    """   Vols of the SABR wing surface described by record for a float or an array of strikes, evaluated from the
+        record alone (same formulas as SABRWingSurface.GetVolatility(): SABR between the 25 delta strikes, wing
+        prices inverted to vols outside).
+    """
+    scalar = (np.ndim(strikes) == 0)
+    K = np.atleast_1d(np.asarray(strikes, dtype=float))
+    spot, rd, rf, T = float(record['spot']), float(record['domesticDeposit']), float(record['foreignDeposit']), float(record['expiryTerm'])
+    forward = spot * np.exp((rd - rf) * T)
+    K25P, K25C = record['strikes'][1], record['strikes'][3]
+
+    vols = vs.SabrImpliedVolKernel(K, forward, T, float(record['alpha']), float(record['corr']), float(record['vovol']), float(record['beta']))
+    wing = (K < K25P) | (K > K25C)
+    if wing.any():
+        Kw = K[wing]
+        prices, optionTypes = sw.WingPrices(Kw, K25P, record['wingParameters'])
+        vols[wing] = bs.ImpliedVolatility(prices, spot, Kw, T, rd, rf, optionTypes)
+
+    return float(vols[0]) if scalar else vols
+
+
+class SharedSurfaceStore:
+    """   Table of SurfaceRecordType records in a named shared-memory block. The publisher creates the store
+        (create=True) and writes calibrated surfaces with Publish(); pricing processes attach by name
+        (create=False) and read the records in place, without unpickling objects or recalibrating.
+        Records are updated under a sequence lock: the publisher makes the sequence odd, writes, makes it even;
+        readers copy a record and retry if the sequence was odd or changed meanwhile. Single publisher only.
+    """
+
+    def __init__(self, name=None, capacity=256, create=True):
+        if (create):
+            self._memory = sm.SharedMemory(name=name, create=True, size=capacity * SurfaceRecordType.itemsize)
+            self._memory.buf[:] = bytes(len(self._memory.buf))
+        else:
+            # Readers must not remove the block when they exit: only the creating process owns it. Child processes
+            # share the resource tracker of their parent, independent processes have their own and unregister
+            try:
+                self._memory = sm.SharedMemory(name=name, track=False)
+            except TypeError:
+                self._memory = sm.SharedMemory(name=name)
+                if (resource_tracker is not None and mp.parent_process() is None):
+                    try:
+                        resource_tracker.unregister(self._memory._name, 'shared_memory')
+                    except Exception:
+                        pass
+
+        self._owner = create
+        self._table = np.ndarray((len(self._memory.buf) // SurfaceRecordType.itemsize,), dtype=SurfaceRecordType, buffer=self._memory.buf)
+
+
+    def GetName(self):
+        return self._memory.name
+
+
+    def GetTable(self):
+        # Zero-copy view of all records (shared memory)
+        return self._table
+
+
+    def FindIndex(self, pair, expiryTerm):
+        # Slot of (pair, expiryTerm), -1 if not published
+        found = np.nonzero((self._table['sequence'] != 0) & (self._table['pair'] == EncodePair(pair)) & (self._table['expiryTerm'] == expiryTerm))[0]
+        return int(found[0]) if len(found) > 0 else -1
+
+
+    def Publish(self, pair, surface: sw.SABRWingSurface) -> None:
+        record = GetSurfaceRecord(pair, surface)
+        index = self.FindIndex(pair, surface._expiryTerm)
+        if (index < 0):
+            empty = np.nonzero(self._table['sequence'] == 0)[0]
+            if (len(empty) == 0):
+                raise ValueError('Surface store is full - SharedSurfaceStore->Publish')
+            index = int(empty[0])
+
+        sequence = max(int(self._table['sequence'][index]), 0)
+        self._table['sequence'][index] = sequence + 1
+        fields = [f for f in SurfaceRecordType.names if f != 'sequence']
+        self._table[fields][index] = record[fields]
+        self._table['sequence'][index] = sequence + 2
+        pass
+
+
+    def GetRecord(self, pair, expiryTerm, maxRetries=1000):
+        # Consistent copy of the record of (pair, expiryTerm), None if not published
+        index = self.FindIndex(pair, expiryTerm)
+        if (index < 0):
+            return None
+
+        for _ in range(maxRetries):
+            before = int(self._table['sequence'][index])
+            record = self._table[index].copy()
+            if (before % 2 == 0 and int(self._table['sequence'][index]) == before):
+                return record
+        raise RuntimeError('No consistent read of ' + pair + ' - SharedSurfaceStore->GetRecord')
+
+
+    def GetVolatility(self, pair, expiryTerm, strikes):
+        record = self.GetRecord(pair, expiryTerm)
+        if (record is None):
+            raise KeyError((pair, expiryTerm))
+        return GetRecordVolatility(record, strikes)
+
+
+    def Close(self) -> None:
+        self._table = None
+        self._memory.close()
+        pass
+
+
+    def Unlink(self) -> None:
+        # Remove the shared-memory block (publisher only, after the readers are done)
+        if (self._owner):
+            self._memory.unlink()
+        pass
+
+
+
+#//     Unit-Test: Shared surface store
+def ReadFromStore(name, strikes, results):
+    store = SharedSurfaceStore(name, create=False)
+    results.put(store.GetVolatility('ZARJPY', 30/365.0, strikes))
+    store.Close()
+
+
+class Test_SurfaceStore(unittest.TestCase):
+
+    def test_SharedSurfaceStore(self):
+        surface = sw.SABRWingSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, np.array([0.189, 0.171, 0.153, 0.146, 0.146]))
+        strikes = np.array([9.8, 10.6, 11.2, 11.7, 12.1, 12.9, 13.6])
+        store = SharedSurfaceStore(capacity=4)
+        try:
+            store.Publish('ZARJPY', surface)
+            store.Publish('ZARJPY', surface)
+            self.assertEqual(int(store.GetTable()['sequence'][0]), 4)
+            self.assertIsNone(store.GetRecord('USDJPY', 30/365.0))
+
+            # Pairs that do not fit the 16 byte field are rejected, not truncated onto another pair's slot
+            with self.assertRaises(ValueError):
+                store.Publish('ZARJPY.30D.CLOSE.NY', surface)
+            with self.assertRaises(ValueError):
+                store.GetRecord('ZARJPY.30D.CLOSE.NY', 30/365.0)
+
+            # Vols straight from the record, in the SABR body and in both wings
+            vols = store.GetVolatility('ZARJPY', 30/365.0, strikes)
+            for i in range(len(strikes)):
+                self.assertAlmostEqual(vols[i], surface.GetVolatility(strikes[i]), 12)
+            self.assertAlmostEqual(store.GetVolatility('ZARJPY', 30/365.0, 10.0), surface.GetVolatility(10.0), 12)
+
+            # Reader in another process attaching by name
+            context = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+            results = context.Queue()
+            reader = context.Process(target=ReadFromStore, args=(store.GetName(), strikes, results))
+            reader.start()
+            remote = results.get(timeout=60)
+            reader.join()
+            self.assertTrue(np.array_equal(remote, vols))
+        finally:
+            store.Close()
+            store.Unlink()
+
+
+if __name__ == '__main__':
+    unittest.main()
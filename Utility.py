@@ -3,7 +3,10 @@
 
 """
 import math
+import enum
+import collections
 import numpy as np
+import scipy.special as ss
 import unittest
 import sys
 
@@ -103,6 +106,172 @@ def bisection(func, x1, x2, x_accuracy, JMAX = 40):
         
     return rtb
 
+
+# Result of a root search: root (float or array), iterations used (per root), function evaluations 
+# (calls of func, a vectorized call counts once) and convergence flag (per root)
+RootResult = collections.namedtuple('RootResult', ['root', 'iterations', 'functionCalls', 'converged'])
+
+
+def brent(func, x1, x2, x_accuracy, maxIterations=100, fullOutput=False):
+    """   Brent's method (Numerical Recipes in C, zbrent): inverse quadratic interpolation and secant steps
+        safeguarded by bisection, so the root stays bracketed and convergence is superlinear for smooth 
+        functions. Drop-in replacement for bisection(): returns the root, or a RootResult if fullOutput.
+    """
+    a, b = x1, x2
+    fa, fb = func(a), func(b)
+    functionCalls = 2
+        
+    if (fa*fb>0.0):
+        raise ValueError('No root in interval from min_x to max_x')
+
+    c, fc = b, fb
+    d = e = b - a
+    converged = False
+    i = 0
+
+    while (i < maxIterations):
+        i += 1
+        if ((fb > 0.0 and fc > 0.0) or (fb < 0.0 and fc < 0.0)):
+            # Rename a, b, c and adjust the bracketing interval d
+            c, fc = a, fa
+            d = e = b - a
+        if (abs(fc) < abs(fb)):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+
+        tol1 = 2.0 * 2.2e-16 * abs(b) + 0.5 * x_accuracy
+        xm = 0.5 * (c - b)
+        if (abs(xm) <= tol1 or fb == 0.0):
+            converged = True
+            break
+
+        if (abs(e) >= tol1 and abs(fa) > abs(fb)):
+            # Attempt inverse quadratic interpolation (secant step if only two points are distinct)
+            s = fb / fa
+            if (a == c):
+                p = 2.0 * xm * s
+                q = 1.0 - s
+            else:
+                q = fa / fc
+                r = fb / fc
+                p = s * (2.0 * xm * q * (q - r) - (b - a) * (r - 1.0))
+                q = (q - 1.0) * (r - 1.0) * (s - 1.0)
+            if (p > 0.0):
+                q = -q
+            p = abs(p)
+            if (2.0 * p < min(3.0 * xm * q - abs(tol1 * q), abs(e * q))):
+                e, d = d, p / q
+            else:
+                d = e = xm
+        else:
+            d = e = xm
+
+        a, fa = b, fb
+        b += d if abs(d) > tol1 else math.copysign(tol1, xm)
+        fb = func(b)
+        functionCalls += 1
+
+    if (fullOutput):
+        return RootResult(b, i, functionCalls, converged)
+    return b
+
+
+def illinois(func, x1, x2, x_accuracy, maxIterations=100):
+    """   Vectorized Illinois (modified regula falsi) solver for many independent brackets at once.
+        func maps an array of x to an array of function values element by element; x1 and x2 are
+        broadcast to a common shape (with the shape of func's output), every element must hold a sign change. Elements converge 
+        superlinearly (order ~1.44) and are frozen once the bracket or the step is below x_accuracy.
+        Returns a RootResult with root, iterations and converged as arrays.
+    """
+    a, b = np.broadcast_arrays(np.asarray(x1, dtype=float), np.asarray(x2, dtype=float))
+    fa, fb = np.asarray(func(a), dtype=float), np.asarray(func(b), dtype=float)
+    a, b, fa, fb = [v.copy() for v in np.broadcast_arrays(a, b, fa, fb)]
+    functionCalls = 2
+
+    if (fa*fb > 0.0).any():
+        raise ValueError('No root in interval from min_x to max_x')
+
+    root = np.where(fa == 0.0, a, b)
+    converged = (fa == 0.0) | (fb == 0.0) | (np.abs(b - a) < x_accuracy)
+    iterations = np.zeros(a.shape, dtype=int)
+    side = np.zeros(a.shape, dtype=int)
+    i = 0
+
+    while (i < maxIterations and not converged.all()):
+        i += 1
+        active = ~converged
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = np.where(active, (a * fb - b * fa) / (fb - fa), root)
+        c = np.where(np.isfinite(c), c, 0.5 * (a + b))
+        fc = np.asarray(func(c), dtype=float)
+        functionCalls += 1
+        iterations += active
+
+        # The end point with the same sign as fc is replaced. If the same end is replaced twice in a row
+        # the function value kept at the other end is halved (Illinois step)
+        replaceB = active & (fc * fb > 0.0)
+        replaceA = active & (fc * fa > 0.0)
+        fa = np.where(replaceB & (side == -1), 0.5 * fa, fa)
+        fb = np.where(replaceA & (side == 1), 0.5 * fb, fb)
+        b, fb = np.where(replaceB, c, b), np.where(replaceB, fc, fb)
+        a, fa = np.where(replaceA, c, a), np.where(replaceA, fc, fa)
+        side = np.where(replaceB, -1, np.where(replaceA, 1, side))
+
+        step = np.abs(c - root)
+        root = np.where(active, c, root)
+        converged = converged | (active & ((fc == 0.0) | (np.abs(b - a) < x_accuracy) | (step < 0.5 * x_accuracy)))
+
+    return RootResult(root, iterations, functionCalls, converged)
+
+
+
+# Coefficients of the Acklam inverse normal (Norm.InverseCdf, NormInverseCdf)
+_AcklamA = (-39.6968302866538, 220.946098424521, -275.928510446969, 138.357751867269, -30.6647980661472, 2.50662827745924)
+_AcklamB = (-54.4760987982241, 161.585836858041, -155.698979859887, 66.8013118877197, -13.2806815528857)
+_AcklamC = (-7.78489400243029E-03, -0.322396458041136, -2.40075827716184, -2.54973253934373, 4.37466414146497, 2.93816398269878)
+_AcklamD = (7.78469570904146E-03, 0.32246712907004, 2.445134137143, 3.75440866190742)
+_AcklamPLow = 0.02425
+
+# Coefficients of the Moro inverse normal (Norm.Moro, NormMoro), built once at import
+_MoroA = (2.50662823884, -18.61500062529, 41.39119773534, -25.44106049637)
+_MoroB = (-8.47351093090, 23.08336743743, -21.06224101826, 3.13082909833)
+_MoroC = (0.3374754822726147, 0.9761690190917186, 0.1607979714918209, 0.0276438810333863, 0.0038405729373609,
+          0.0003951896511919, 0.0000321767881768, 0.0000002888167364, 0.0000003960315187)
+
+
+class NormPrecision(enum.Enum):
+    # Fast:  Abramowitz & Stegun 26.2.17 polynomial (Norm.cdfM), absolute error below 7.5E-8
+    # Exact: erfc based, double precision (relative error below 1E-13, also in the far tails)
+    Fast = 1
+    Exact = 2
+
+
+def NormPdf(x):
+    # Standard normal density for a float or a NumPy array
+    if isinstance(x, (float, int)):
+        return Constants._OneOverRootTwoPi * math.exp(-0.5 * x * x)
+    return Constants._OneOverRootTwoPi * np.exp(-0.5 * np.asarray(x, dtype=float)**2)
+
+
+def NormCdf(x, precision: NormPrecision = NormPrecision.Exact):
+    """   Standard normal distribution function for a float or a NumPy array (element-wise).
+        NormPrecision.Exact: 0.5*erfc(-x/sqrt(2)), double precision with relative accuracy in
+                             the lower tail (no 1 - cdf cancellation)
+        NormPrecision.Fast:  Abramowitz & Stegun 26.2.17 five term polynomial, |error| < 7.5E-8
+    """
+    if (precision == NormPrecision.Exact):
+        if isinstance(x, (float, int)):
+            return 0.5 * math.erfc(-x / Constants._SqrtTwo)
+        return ss.ndtr(x)
+
+    xa = np.asarray(x, dtype=float)
+    y = 1.0 / (1.0 + 0.2316419 * np.abs(xa))
+    z = y * (0.31938153 + y * (-0.356563782 + y * (1.781477937 + y * (-1.821255978 + y * 1.330274429))))
+    nu = 1.0 - z * Constants._OneOverRootTwoPi * np.exp(-0.5 * xa * xa)
+    retval = np.where(xa > 0.0, nu, 1.0 - nu)
+    
+    return float(retval) if isinstance(x, (float, int)) else retval
+
     
 class Norm:    
     
@@ -111,7 +280,7 @@ class Norm:
 
     
     def pdf(self, x):
-        return Constants._OneOverRootTwoPi * math.exp(-x * x / 2.0)
+        return NormPdf(x)
 
 
     def InfErf(self, x):
@@ -186,7 +355,7 @@ class Norm:
         
 
     def cdf(self, x):       
-        return self.cdfI(x)
+        return NormCdf(x)
 
 
     def cdfM(self, x):
@@ -216,32 +385,12 @@ class Norm:
             for single precision (Ppnd7).  The agreement for p = 0.01
             to p = 0.99 is no worse than 1.0E-7, the accuracy of Ppnd7.
         """
-        a1 = -39.6968302866538
-        a2 = 220.946098424521
-        a3 = -275.928510446969
-        a4 = 138.357751867269
-        a5 = -30.6647980661472
-        a6 = 2.50662827745924
-
-        b1 = -54.4760987982241
-        b2 = 161.585836858041
-        b3 = -155.698979859887
-        b4 = 66.8013118877197
-        b5 = -13.2806815528857
-
-        c1 = -7.78489400243029E-03
-        c2 = -0.322396458041136
-        c3 = -2.40075827716184
-        c4 = -2.54973253934373
-        c5 = 4.37466414146497
-        c6 = 2.93816398269878
-
-        d1 = 7.78469570904146E-03
-        d2 = 0.32246712907004
-        d3 = 2.445134137143
-        d4 = 3.75440866190742
-
-        p_low = 0.02425
+        a1, a2, a3, a4, a5, a6 = _AcklamA
+        b1, b2, b3, b4, b5 = _AcklamB
+        c1, c2, c3, c4, c5, c6 = _AcklamC
+        d1, d2, d3, d4 = _AcklamD
+
+        p_low = _AcklamPLow
         p_high = 1.0 - p_low
 
         retval = 0.0
@@ -264,31 +413,9 @@ class Norm:
     def Moro(self, u):
         
         # Moro Inverse Cumulative Normal
-        a = np.array ([2.50662823884, 
-                    -18.61500062529, 
-                    41.39119773534, 
-                    -25.44106049637],
-                    dtype=float
-                    )
-
-        b = np.array([-8.47351093090,
-                    23.08336743743,
-                    -21.06224101826,
-                    3.13082909833],
-                    dtype=float
-                    )
-        
-        c = np.array([0.3374754822726147,
-                    0.9761690190917186,
-                    0.1607979714918209,
-                    0.0276438810333863,
-                    0.0038405729373609,
-                    0.0003951896511919,
-                    0.0000321767881768,
-                    0.0000002888167364,
-                    0.0000003960315187],
-                    dtype=float
-                    )
+        a = _MoroA
+        b = _MoroB
+        c = _MoroC
 
         x = u - 0.5
         r = 0.0
@@ -311,6 +438,51 @@ class Norm:
         return r
 
 
+def NormInverseCdf(x):
+    """   Vectorized Norm.InverseCdf() (Acklam): maps an array of probabilities to normals in one call 
+        with the same coefficients and evaluation order as the scalar version. As for the scalar 
+        version 1.0 is returned for x outside [0, 1].
+    """
+    a1, a2, a3, a4, a5, a6 = _AcklamA
+    b1, b2, b3, b4, b5 = _AcklamB
+    c1, c2, c3, c4, c5, c6 = _AcklamC
+    d1, d2, d3, d4 = _AcklamD
+
+    x = np.asarray(x, dtype=float)
+    p_low = _AcklamPLow
+    p_high = 1.0 - p_low
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Tails: q = sqrt(-2 log(min(x, 1-x))), the sign is applied below
+        q = np.sqrt(-2 * np.log(np.where(x < p_low, x, 1 - x)))
+        tail = (((((c1 * q + c2) * q + c3) * q + c4) * q + c5) * q + c6) /((((d1 * q + d2) * q + d3) * q + d4) * q + 1)
+
+        q = x - 0.5
+        r = q * q
+        central = (((((a1 * r + a2) * r + a3) * r + a4) * r + a5) * r + a6) * q /(((((b1 * r + b2) * r + b3) * r + b4) * r + b5) * r + 1)
+
+    retval = np.where(x < p_low, tail, np.where(x <= p_high, central, -tail))
+    return np.where((x < 0) | (x > 1), 1.0, retval)
+
+
+def NormMoro(u):
+    # Vectorized Norm.Moro(): Beasley-Springer for |u - 0.5| < 0.42 and Moro in the tails
+    a = _MoroA
+    b = _MoroB
+    c = _MoroC
+
+    u = np.asarray(u, dtype=float)
+    x = u - 0.5
+    y = x * x
+    central = x * (((a[3] * y + a[2]) * y + a[1]) * y + a[0]) /((((b[3] * y + b[2]) * y + b[1]) * y + b[0]) * y + 1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.log(-np.log(np.where(x > 0.0, 1.0 - u, u)))
+        r = c[0] + r * (c[1] + r * (c[2] + r * (c[3] + r * (c[4] + r * (c[5] + r * (c[6] + r * (c[7] + r * c[8])))))))
+
+    return np.where(np.abs(x) < 0.42, central, np.where(x < 0.0, -r, r))
+
+
 def FindIndex(x, data):
     """     Given Container data[num_cols], and given a value x, a value index
     is returned such that x is between data[index] and data[index+1]. data must
@@ -346,8 +518,32 @@ class Interpolation:
     
     
     def GetInterpolatedValue(self, x, xs, ys):
+        # x may be a float or a NumPy array
+        coefficients = self.Prepare(xs, ys)
+        if (np.ndim(x) > 0):
+            return self.GetPreparedValueArray(np.asarray(x, dtype=float), xs, ys, coefficients)
+        return self.GetPreparedValue(x, xs, ys, coefficients)
+    
+    
+    def Prepare(self, xs, ys):
+        # Coefficients depending on the nodes (xs, ys) only. Computed once and re-used by GetPreparedValue()
+        # as long as the nodes are unchanged
+        return None
+    
+    
+    def GetPreparedValue(self, x, xs, ys, coefficients):
         pass 
     
+    
+    def GetPreparedValueArray(self, x, xs, ys, coefficients):
+        # Element-wise GetPreparedValue() for a NumPy array x. Overridden by vectorized versions
+        return np.array([self.GetPreparedValue(xi, xs, ys, coefficients) for xi in x])
+    
+    
+    def GetSegmentIndex(self, x, xs):
+        # Vectorized bracketing: index i of the segment [xs[i], xs[i+1]] used for x (end segments outside the range)
+        return np.clip(np.searchsorted(xs, x, side='right') - 1, 0, len(xs) - 2)
+    
 class PiecewiseLinearInterpolation(Interpolation):
 
     def __init__(self, flatExtrapolation=False) -> None:
@@ -364,7 +560,7 @@ class PiecewiseLinearInterpolation(Interpolation):
         return y
 
 
-    def GetInterpolatedValue(self, x, xs, ys):
+    def GetPreparedValue(self, x, xs, ys, coefficients=None):
         
         nx = len(xs)
         
@@ -385,12 +581,29 @@ class PiecewiseLinearInterpolation(Interpolation):
         return y
 
 
+    def GetPreparedValueArray(self, x, xs, ys, coefficients=None):
+        
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        i = self.GetSegmentIndex(x, xs)
+        y = ys[i] + (ys[i + 1] - ys[i])/(xs[i + 1] - xs[i])*(x - xs[i])
+        
+        if (self._flatExtrapolation==True):
+            y = np.where(x < xs[0], ys[0], np.where(x > xs[-1], ys[-1], y))
+        
+        return y
+
+
 class CubicSplineInterpolation(Interpolation):
     
     def __init__(self, flatExtrapolation=False):
         super().__init__(flatExtrapolation)
     
-    def GetInterpolatedValue(self, x, xs, ys):
+    def Prepare(self, xs, ys):
+        # Second derivatives of the spline in the nodes
+        return self.spline(xs, ys)
+
+
+    def GetPreparedValue(self, x, xs, ys, y2s):
         # Method taken from Numerical Recipes in C
         # http://phys.uri.edu/nigh/NumRec/bookfpdf/f3-3.pdf
         
@@ -400,10 +613,33 @@ class CubicSplineInterpolation(Interpolation):
         elif (x > xs[nx - 1] and self._flatExtrapolation==True):
             y = ys[nx - 1]
         else:
-            y2s = self.spline(xs, ys)
             y = self.splint(x, xs, ys, y2s)
         
         return y
+
+
+    def GetPreparedValueArray(self, x, xs, ys, y2s):
+        # Vectorized splint() (with the flat extrapolation of GetPreparedValue())
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        nx = len(xs)
+        
+        klo = self.GetSegmentIndex(x, xs)
+        khi = klo + 1
+        h = xs[khi] - xs[klo]
+        a = (xs[khi] - x) / h
+        b = (x - xs[klo]) / h
+        y = a * ys[klo] + b * ys[khi] + ((a * a * a - a) * y2s[klo] + (b * b * b - b) * y2s[khi]) * (h * h) / 6.0
+        
+        alphaLow = (ys[1] - ys[0]) / (xs[1] - xs[0]) - 1.0 / 6.0 * (xs[1] - xs[0]) * (2.0 * y2s[0] + y2s[1])
+        alphaHigh = ((ys[nx - 1] - ys[nx - 2]) / (xs[nx - 1] - xs[nx - 2]) +
+                     1.0 / 6.0 * (xs[nx - 1] - xs[nx - 2]) * (y2s[nx - 2] + 2 * y2s[nx - 1]))
+        y = np.where(x <= xs[0], ys[0] + alphaLow * (x - xs[0]), y)
+        y = np.where(x >= xs[nx - 1], ys[nx - 1] + alphaHigh * (x - xs[nx - 1]), y)
+        
+        if (self._flatExtrapolation==True):
+            y = np.where(x < xs[0], ys[0], np.where(x > xs[nx - 1], ys[nx - 1], y))
+        
+        return y
         
 
     def spline(self, xs, ys, yp1=0.99e31, ypn=0.99e31):
@@ -490,18 +726,59 @@ class Test_Utility(unittest.TestCase):
     def test_Bisection(self):
         self.assertEqual(round(bisection(g, 0.0, 7.0, 0.00000001) , 7), round(4.1234321, 7))
 
+    def test_Brent(self):
+        result = brent(g, 0.0, 7.0, 1.0e-12, fullOutput=True)
+        self.assertAlmostEqual(result.root, 4.1234321, 12)
+        self.assertTrue(result.converged)
+        self.assertLessEqual(result.functionCalls, 5)
+        
+        # Superlinear: far fewer evaluations than bisection to full accuracy on a non-linear function
+        result = brent(lambda x: math.exp(x) - 3.0, -5.0, 5.0, 1.0e-14, fullOutput=True)
+        self.assertAlmostEqual(result.root, math.log(3.0), 13)
+        self.assertLess(result.functionCalls, 15)
+        self.assertEqual(brent(lambda x: x*x - 2.0, 0.0, 2.0, 1.0e-12), brent(lambda x: x*x - 2.0, 0.0, 2.0, 1.0e-12, fullOutput=True).root)
+        self.assertRaises(ValueError, brent, g, 5.0, 7.0, 1.0e-8)
+
+    def test_Illinois(self):
+        targets = np.linspace(0.1, 50.0, 1000)
+        result = illinois(lambda x: x*x*x - targets, 0.0, 4.0, 1.0e-12)
+        self.assertTrue(result.converged.all())
+        self.assertLess(np.max(np.abs(result.root - np.cbrt(targets))), 1.0e-11)
+        self.assertLess(result.functionCalls, 40)
+        self.assertRaises(ValueError, illinois, lambda x: x - targets, 0.0, 1.0, 1.0e-8)
+
     def test_ICdf(self):
         self.assertEqual(round(Norm().cdfI(2.134), 8), round(0.983578609590808, 8))
        
     def test_MCdf(self):
         self.assertEqual(round(Norm().cdfM(3.0), 8), round(0.998650032777765, 8))
 
+    def test_NormCdf(self):
+        xs = np.array([-9.0, -3.3, -0.5, 0.0, 0.7, 2.134, 3.0])
+        exact = NormCdf(xs)
+        fast = NormCdf(xs, NormPrecision.Fast)
+        for i in range(len(xs)):
+            self.assertAlmostEqual(exact[i]/NormCdf(float(xs[i])), 1.0, 12)
+            self.assertAlmostEqual(fast[i], Norm().cdfM(xs[i]), 14)
+            self.assertLess(abs(fast[i] - exact[i]), 7.5e-8)
+        self.assertEqual(round(NormCdf(2.134), 12), round(0.983578609590808, 12))
+        self.assertAlmostEqual(NormCdf(-9.0)/1.12858840595384e-19, 1.0, 12)
+        self.assertAlmostEqual(NormPdf(np.array([0.3]))[0], Norm().pdf(0.3), 15)
+
     def test_InverseCdf(self):
         self.assertEqual(round(Norm().InverseCdf(0.9752), 8), round(1.96339753624734, 8))
     
     def test_Moro(self):
         self.assertEqual(round(Norm().Moro(0.9752), 8), round(1.96339753624734, 8))        
 
+    def test_NormInverseCdfArray(self):
+        us = np.concatenate([np.linspace(1.0e-12, 1.0 - 1.0e-12, 20001), np.array([0.001, 0.02425, 0.08, 0.92, 0.97575, 0.9752])])
+        acklam = NormInverseCdf(us)
+        moro = NormMoro(us)
+        n = Norm()
+        self.assertTrue(all(acklam[i] == n.InverseCdf(us[i]) for i in range(len(us))))
+        self.assertTrue(all(moro[i] == n.Moro(us[i]) for i in range(len(us))))
+
     def test_CubicSplineInterpolation(self):
         xs = np.array([9.796265875871027, 10.067098505250692, 10.356101824110898, 10.687697656702378, 11.069582777590423])
         ys = np.array([0.09852,	0.09542, 0.0973, 0.10582, 0.11732])
@@ -511,6 +788,16 @@ class Test_Utility(unittest.TestCase):
         self.assertEqual(round(cs.GetInterpolatedValue(10.7, xs, ys), 12), round(0.106188572556555, 12))
             # Linear extrapolation above right end point
         self.assertEqual(round(cs.GetInterpolatedValue(11.9, xs, ys), 12), round(0.14239424307285, 12))
+            # Spline coefficients prepared once and re-used
+        y2s = cs.Prepare(xs, ys)
+        self.assertEqual(cs.GetPreparedValue(10.7, xs, ys, y2s), cs.GetInterpolatedValue(10.7, xs, ys))
+            # Vectorized lookups agree with the scalar ones, also outside the nodes and on the nodes
+        x = np.concatenate([np.linspace(9.0, 12.0, 301), xs])
+        for flat in [False, True]:
+            cs = CubicSplineInterpolation(flat)
+            vals = cs.GetInterpolatedValue(x, xs, ys)
+            for i in range(len(x)):
+                self.assertAlmostEqual(vals[i], cs.GetInterpolatedValue(x[i], xs, ys), 15)
 
     def test_PieceviseLinear(self):
         xa = np.array([2.0, 4.1, 7.3331, 9.998])
@@ -522,6 +809,13 @@ class Test_Utility(unittest.TestCase):
         
         pl._flatExtrapolation = False
         self.assertEqual(round(pl.GetInterpolatedValue(21.1, xa, ya), 13), 34.0130548988705)
+        
+        x = np.concatenate([np.linspace(0.0, 12.0, 121), xa])
+        for flat in [False, True]:
+            pl._flatExtrapolation = flat
+            vals = pl.GetInterpolatedValue(x, xa, ya)
+            for i in range(len(x)):
+                self.assertAlmostEqual(vals[i], pl.GetInterpolatedValue(x[i], xa, ya), 14)
 
 if __name__ == '__main__':
     unittest.main()
@@ -64,10 +64,7 @@ sabr_wing = sw.SABRWingSurface(spot, r, q, expiryTerm, vol_smile)
 bs_option = bs.Vanilla(spot, atm_strike, expiryTerm, r, q, vol_smile[2])
 
 
-option_price_vec = np.zeros(5)
-for i in range(5):
-    bs_option._strike = strike_vec[i] #math.exp(logmon_strike_vec[i])*atm_strike
-    option_price_vec[i] = bs_option.GetBaseOptionValue(bs.OptionType.Call, vol_smile[i])    
+option_price_vec = bs_option.GetOptionValueArray(strike_vec, vol_smile, bs.OptionType.Call)
 
 
 # Granular x-axis for plot
@@ -82,28 +79,35 @@ cs = u.CubicSplineInterpolation()
 pl = u.PiecewiseLinearInterpolation()
 
 
-dt['CS_Vol_Smile'] = dt.apply(lambda row: cs.GetInterpolatedValue(row['Strikes'], strike_vec, vol_smile), axis=1)
-dt['PL_Vol_Smile'] = dt.apply(lambda row: pl.GetInterpolatedValue(row['Strikes'], strike_vec, vol_smile), axis=1)
-dt['SABR_Vol_Smile'] = dt.apply(lambda row: sabr.GetVolatility(row['Strikes']), axis=1)
-dt['SABR_Wing_Vol'] = dt.apply(lambda row: sabr_wing.GetVolatility(row['Strikes']), axis=1)
+dt['CS_Vol_Smile'] = cs.GetInterpolatedValue(plot_strikes, strike_vec, vol_smile)
+dt['PL_Vol_Smile'] = pl.GetInterpolatedValue(plot_strikes, strike_vec, vol_smile)
+dt['SABR_Vol_Smile'] = sabr.GetVolatility(plot_strikes)
+dt['SABR_Wing_Vol'] = sabr_wing.GetVolatility(plot_strikes)
 
 
-for index, i in dt.iterrows():        
-    bs_option._strike = dt.loc[index, 'Strikes']
-    dt.loc[index, 'CS_Price'] = bs_option.GetBaseOptionValue(bs.OptionType.Call, dt.loc[index, 'CS_Vol_Smile'])
-    dt.loc[index, 'PL_Price'] = bs_option.GetBaseOptionValue(bs.OptionType.Call, dt.loc[index, 'PL_Vol_Smile'])
-    dt.loc[index, 'SABR_Price'] = bs_option.GetBaseOptionValue(bs.OptionType.Call, dt.loc[index, 'SABR_Vol_Smile'])
-    dt.loc[index, 'SABR_WingPrice'] = bs_option.GetBaseOptionValue(bs.OptionType.Call, dt.loc[index, 'SABR_Wing_Vol'])
-    # dt.loc[index, 'InnerValue'] = max(bs_option._spot - bs_option._strike, 0)
+dt['CS_Price'] = bs_option.GetOptionValueArray(dt['Strikes'].values, dt['CS_Vol_Smile'].values, bs.OptionType.Call)
+dt['PL_Price'] = bs_option.GetOptionValueArray(dt['Strikes'].values, dt['PL_Vol_Smile'].values, bs.OptionType.Call)
+dt['SABR_Price'] = bs_option.GetOptionValueArray(dt['Strikes'].values, dt['SABR_Vol_Smile'].values, bs.OptionType.Call)
+dt['SABR_WingPrice'] = bs_option.GetOptionValueArray(dt['Strikes'].values, dt['SABR_Wing_Vol'].values, bs.OptionType.Call)
 
 
-for index, i in dt.iterrows():
-    
-    if ((index >= 1) and (index <= 119 - 1)):
-        dt.loc[index, 'CS_pdf'] = (dt.loc[index + 1, 'CS_Price']+ dt.loc[index - 1, 'CS_Price'] - 2*dt.loc[index, 'CS_Price'])/(delta_K*delta_K)
-        dt.loc[index, 'PL_pdf'] = (dt.loc[index + 1, 'PL_Price']+ dt.loc[index - 1, 'PL_Price'] - 2*dt.loc[index, 'PL_Price'])/(delta_K*delta_K)
-        dt.loc[index, 'SABR_pdf'] = (dt.loc[index + 1, 'SABR_Price']+ dt.loc[index - 1, 'SABR_Price'] - 2*dt.loc[index, 'SABR_Price'])/(delta_K*delta_K)
-        dt.loc[index, 'SABRWing_pdf'] = (dt.loc[index + 1, 'SABR_WingPrice']+ dt.loc[index - 1, 'SABR_WingPrice'] - 2*dt.loc[index, 'SABR_WingPrice'])/(delta_K*delta_K)
+def SecondDifference(prices, delta):
+    # Central second differences of prices on the uniform strike grid (nan at both ends)
+    pdf = np.full(len(prices), np.nan)
+    pdf[1:-1] = (prices[2:] + prices[:-2] - 2*prices[1:-1])/(delta*delta)
+    return pdf
+
+
+dt['CS_pdf'] = SecondDifference(dt['CS_Price'].values, delta_K)
+dt['PL_pdf'] = SecondDifference(dt['PL_Price'].values, delta_K)
+
+# SABR densities from the analytic strike derivatives of the surfaces
+sabr_density = sabr.GetRiskNeutralDensity(plot_strikes)
+sabr_wing_density = sabr_wing.GetRiskNeutralDensity(plot_strikes)
+dt['SABR_pdf'] = sabr_density.pdf
+dt['SABRWing_pdf'] = sabr_wing_density.pdf
+print('SABR Wing moments (mean, variance, skewness, kurtosis):', sabr_wing_density.moments)
+print('SABR Wing butterfly arbitrage at strikes:', plot_strikes[sabr_wing_density.arbitrage])
 
 # print(dt)
 
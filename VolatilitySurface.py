@@ -3,27 +3,211 @@
 
 """
 import math as m
+import collections
+import enum
 import Utility as u
 import unittest
+import copy
 import numpy as np
 import StrikeFromDelta as sfd
+import DepositCurve as dc
+import BlackScholes as bs
 import scipy.optimize as so
 
 
+class CalibrationMethod(enum.Enum):
+    # Powell:             derivative free minimisation of the weighted squared error (SABRCalibObject)
+    # LevenbergMarquardt: least squares on the weighted residuals with the analytic SABR Jacobian
+    Powell = 1
+    LevenbergMarquardt = 2
+
+
+# Risk-neutral distribution of the spot at expiry on a strike grid (see FXVolSurface.GetRiskNeutralDensity()). 
+# moments = [mean, variance, skewness, kurtosis], arbitrage flags the strikes with a negative pdf (butterfly 
+# arbitrage) or a cdf outside [0, 1] (call spread arbitrage)
+RiskNeutralDensity = collections.namedtuple('RiskNeutralDensity', ['strikes', 'pdf', 'cdf', 'moments', 'arbitrage'])
+
+
+# Near the forward x = ln(F/K) and L(z) in the Obloj I0 = vovol*x/L(z) both vanish and the closed forms cancel.
+# Where |x|*max(zeta, 1 - beta) is below the threshold, I0 and its strike derivatives are taken from the power
+# series of I0 in x instead: SabrForwardThreshold/SabrForwardOrder for the derivatives, the kernel (value only) 
+# switches much closer to the forward
+SabrForwardThreshold = 0.05
+SabrForwardOrder = 12
+SabrKernelForwardThreshold = 1.0e-4
+SabrKernelForwardOrder = 4
+
+
+def SabrForwardSeries(x, oneMinusBeta, corr, zeta, order=SabrForwardOrder):
+    """   f, df/dx and d2f/dx2 of I0 = alpha*F^(beta-1)*f(x) near the forward, x = ln(F/K), zeta = vovol*F^(1-beta)/alpha,
+        from the first order terms of the power series of f (f = 1 + a1*x + a2*x^2 + ..., a1 = (1 - beta - corr*zeta)/2).
+        The coefficients are composed from z/x = zeta*(1 - exp(-(1-beta)*x))/((1-beta)*x) and L(z)/z = sum P_k(corr)*z^k/(k+1)
+        (P_k Legendre polynomials, dL/dz = 1/sqrt(1 - 2*corr*z + z^2)). Inputs are broadcast against each other.
+    """
+    def Multiply(a, b):
+        return [sum(a[i]*b[k - i] for i in range(k + 1)) for k in range(order)]
+    
+    # (z/x)/zeta and the Legendre polynomials P_k(corr)
+    zOverX = [(-oneMinusBeta)**k/m.factorial(k + 1) for k in range(order)]
+    legendre = [1.0 + 0.0*corr, corr]
+    for k in range(1, order - 1):
+        legendre.append(((2*k + 1)*corr*legendre[k] - k*legendre[k - 1])/(k + 1))
+    
+    # L/z as a series in x (Horner in z = zeta*x*zOverX), then f = zeta*x/L = 1/((z/x)/zeta*(L/z))
+    LOverZ = [legendre[order - 1]/order] + [0.0]*(order - 1)
+    for k in range(order - 2, -1, -1):
+        LOverZ = [legendre[k]/(k + 1)] + [zeta*c for c in Multiply(zOverX, LOverZ)[:order - 1]]
+    denominator = Multiply(zOverX, LOverZ)
+    a = [1.0]
+    for k in range(1, order):
+        a.append(-sum(denominator[j]*a[k - j] for j in range(1, k + 1)))
+    
+    f, df, d2f = a[order - 1], (order - 1)*a[order - 1], (order - 1)*(order - 2)*a[order - 1]
+    for k in range(order - 2, -1, -1):
+        f = a[k] + x*f
+        if (k >= 1):
+            df = k*a[k] + x*df
+        if (k >= 2):
+            d2f = k*(k - 1)*a[k] + x*d2f
+    return f, df, d2f
+
+
+def SabrImpliedVolKernel(strikes, forward, expiryTerm, alpha, corr, vovol, beta, forwardPow=None):
+    """   Vectorized SABR implied vol I0*(1 + I1*T), I0 from Obloj and I1 from Hagan et. al. (see I0_JObloj()
+        and I1_Hagan()). strikes and the parameters (alpha, corr, vovol, beta) are broadcast against each other,
+        e.g. strikes of shape (n,) and parameters of shape (m, 1) give the vols of m parameter sets, shape (m, n).
+        The vovol == 0 limit and the strikes near the forward (SabrForwardSeries()) are selected by masks.
+        forwardPow = forward^(1-beta) may be passed when it is cached per surface.
+    """
+    K = np.asarray(strikes, dtype=float)
+    alpha, corr, vovol, beta = [float(v) if isinstance(v, (float, int)) else np.asarray(v, dtype=float) for v in [alpha, corr, vovol, beta]]
+    oneMinusBeta = 1.0 - beta
+    if (forwardPow is None):
+        forwardPow = np.power(forward, oneMinusBeta)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.log(forward / K)
+        powDiff = forwardPow - np.power(K, oneMinusBeta)
+        if isinstance(beta, float):
+            z = vovol * x / alpha if beta == 1.0 else (vovol / alpha) * powDiff / oneMinusBeta
+        else:
+            z = np.where(beta == 1.0, vovol * x / alpha, (vovol / alpha) * powDiff / oneMinusBeta)
+        I0 = vovol * x / np.log((np.sqrt(1.0 - 2.0 * corr * z + z * z) + z - corr) / (1.0 - corr))
+        
+        # Limits selected by masks, only evaluated when present
+        zeroVovol = (vovol == 0.0) & (beta != 1.0)
+        if (zeroVovol.any() if isinstance(zeroVovol, np.ndarray) else zeroVovol):
+            I0 = np.where(zeroVovol, x * alpha * oneMinusBeta / powDiff, I0)
+        zeta = vovol * forwardPow / alpha
+        atm = np.abs(x) * np.maximum(np.abs(zeta), oneMinusBeta) < SabrKernelForwardThreshold
+        if (atm.any() if isinstance(atm, np.ndarray) else atm):
+            f = SabrForwardSeries(x, oneMinusBeta, corr, zeta, SabrKernelForwardOrder)[0]
+            I0 = np.where(atm, alpha / forwardPow * f, I0)
+    
+    FKPow = np.power(forward * K, oneMinusBeta)
+    I1 = (oneMinusBeta * oneMinusBeta / 24.0 * alpha * alpha / FKPow + 
+          1.0/4.0 * corr * vovol * alpha * beta / np.sqrt(FKPow) + 
+          (2.0 - 3.0 * corr * corr) / 24.0 * vovol * vovol)
+    
+    return I0 * (1.0 + I1 * expiryTerm)
+
+
+def SabrStrikeDerivatives(strikes, forward, expiryTerm, alpha, corr, vovol, beta):
+    """   Vectorized SABR vol and its first and second strike derivatives (as SABRWingSurface.dSABRdK() and 
+        d2SABRdKdK()). All inputs are broadcast against each other, e.g. one strike per surface and arrays of 
+        forwards and parameters of the same shape. The vovol == 0 limit and the strikes near the forward 
+        (SabrForwardSeries()) are selected by masks.
+    """
+    K, F, T = np.asarray(strikes, dtype=float), np.asarray(forward, dtype=float), np.asarray(expiryTerm, dtype=float)
+    alpha, corr, vovol, beta = [float(v) if isinstance(v, (float, int)) else np.asarray(v, dtype=float) for v in [alpha, corr, vovol, beta]]
+    oneMinusBeta = 1.0 - beta
+    
+    # Powers of K and F*K from logarithms computed once: KPow = K^-beta, FKPow = (F*K)^(1-beta)
+    logK = np.log(K)
+    logF = np.log(F)
+    KPow = np.exp(-beta*logK)
+    FPow = np.exp(oneMinusBeta*logF)
+    FK = F*K
+    FKPow = FPow*K*KPow
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = logF - logK
+        powDiff = FPow - K*KPow
+        if isinstance(beta, float):
+            z = vovol*x/alpha if beta == 1.0 else (vovol/alpha)*powDiff/oneMinusBeta
+        else:
+            z = np.where(beta == 1.0, vovol*x/alpha, (vovol/alpha)*powDiff/oneMinusBeta)
+        dzdK = -vovol/alpha*KPow
+        d2zdKdK = vovol/alpha*beta*KPow/K
+        Q = 1.0 - 2.0*corr*z + z*z
+        rootQ = np.sqrt(Q)
+        S = rootQ + z - corr
+        L = np.log(S/(1.0 - corr))
+        zdzdK = (z - corr)*dzdK
+        g = zdzdK/rootQ + dzdK
+        dlog = g/S
+        
+        # I0 (Obloj) and its strike derivatives
+        vovolOverL = vovol/L
+        I0 = vovolOverL*x
+        dI0 = -vovolOverL/K - I0/L*dlog
+        d2I0 = (vovolOverL/(K*K) + vovolOverL/(K*L)*dlog + (vovolOverL/(K*L) + 2.0*I0/(L*L)*dlog)*dlog
+                - I0/L*(-dlog*dlog + (-zdzdK*zdzdK/(Q*rootQ) + (dzdK*dzdK + (z - corr)*d2zdKdK)/rootQ + d2zdKdK)/S))
+        
+        zeroVovol = (vovol == 0.0) & (beta != 1.0)
+        if (zeroVovol.any() if isinstance(zeroVovol, np.ndarray) else zeroVovol):
+            frac = oneMinusBeta/powDiff
+            I0 = np.where(zeroVovol, x*alpha*frac, I0)
+            dI0 = np.where(zeroVovol, -alpha*frac/K + x*alpha*frac*frac*KPow, dI0)
+            d2I0 = np.where(zeroVovol, alpha*frac/(K*K) - 2.0*alpha*frac*frac*KPow/K
+                            + 2.0*x*alpha*frac**3*KPow*KPow - x*alpha*frac*frac*beta*KPow/K, d2I0)
+        # Near the forward: I0 = alpha*F^(beta-1)*f(x), dx/dK = -1/K
+        zeta = vovol*FPow/alpha
+        atm = np.abs(x)*np.maximum(np.abs(zeta), oneMinusBeta) < SabrForwardThreshold
+        if (atm.any() if isinstance(atm, np.ndarray) else atm):
+            f, df, d2f = SabrForwardSeries(x, oneMinusBeta, corr, zeta)
+            I0F = alpha/FPow
+            I0 = np.where(atm, I0F*f, I0)
+            dI0 = np.where(atm, -I0F*df/K, dI0)
+            d2I0 = np.where(atm, I0F*(d2f + df)/(K*K), d2I0)
+    
+    # I1 (Hagan) and its strike derivatives
+    rootFKPow = np.sqrt(FKPow)
+    I1 = (oneMinusBeta*oneMinusBeta/24.0*alpha*alpha/FKPow + 0.25*corr*vovol*alpha*beta/rootFKPow + (2.0 - 3.0*corr*corr)/24.0*vovol*vovol)
+    dI1 = -oneMinusBeta**3/24.0*alpha*alpha/(FK*FKPow)*F - 0.125*alpha*beta*corr*vovol*oneMinusBeta/(FK*rootFKPow)*F
+    d2I1 = (alpha*alpha*oneMinusBeta**3*(2.0 - beta)/24.0/(FK*FK*FKPow)*F*F + alpha*beta*corr*vovol*oneMinusBeta*(3.0 - beta)/16.0/(FK*FK*rootFKPow)*F*F)
+    
+    vol = I0*(1.0 + I1*T)
+    dvoldK = dI0*(1.0 + I1*T) + I0*dI1*T
+    d2voldKdK = d2I0*(1.0 + I1*T) + 2.0*dI0*dI1*T + I0*d2I1*T
+    return vol, dvoldK, d2voldKdK
+
+
 class FXVolSurface:
     
     def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, volatilityInterpolation: u.Interpolation = u.CubicSplineInterpolation(False)):
 
+        # Deposits: floats or DepositCurve objects, stored as the deposits at expiryTerm
         self._spot = spot
         self._expiryTerm = expiryTerm
-        self._volatilitySmile = volatilitySmile
-        self._domesticDeposit = domesticDeposit
-        self._foreignDeposit = foreignDeposit
+        self._volatilitySmile = np.array(volatilitySmile, dtype=float)
+        self._domesticDeposit = dc.GetDeposit(domesticDeposit, expiryTerm)
+        self._foreignDeposit = dc.GetDeposit(foreignDeposit, expiryTerm)
         self._volatilityInterpolation = volatilityInterpolation        
         self._ATMVol = volatilitySmile[2]
         self._rr25 = volatilitySmile[3] - volatilitySmile[1]
-        self._sd = sfd.StrikeFromDelta(spot, domesticDeposit, foreignDeposit, expiryTerm)
+        self._sd = sfd.StrikeFromDelta(spot, self._domesticDeposit, self._foreignDeposit, expiryTerm)
+        self._forward = self._sd.GetForward()
+        
+        # State derived from the smile (strikes, log-moneyness and interpolation coefficients) is computed once 
+        # per smile version. _smileVersion is bumped whenever the smile is updated, and the derived state is 
+        # rebuilt only when _strikeVersion lags behind. The surface holds its own copy of the smile, so the
+        # quotes cannot change without a new version
+        self._smileVersion = 0
+        self._strikeVersion = -1
         self._strikes = np.nan
+        self._moneyness = np.nan
+        self._interpolationCoefficients = None
     
     
     def SetVolatilitySmile(self, volatilitysmile) -> None:    
@@ -33,37 +217,131 @@ class FXVolSurface:
     
     
     def UpdateVolatilities(self, volatilitysmile) -> None:
-        self._volatilitySmile = volatilitysmile
-        self._ATMVol = volatilitysmile[2]
-        self._rr25 = volatilitysmile[3] - volatilitysmile[1]
+        self._volatilitySmile = np.array(volatilitysmile, dtype=float)
+        self._ATMVol = self._volatilitySmile[2]
+        self._rr25 = self._volatilitySmile[3] - self._volatilitySmile[1]
+        self._smileVersion += 1
+        pass
+    
+    
+    def IsCurrentSmile(self, smile_vec) -> bool:
+        # The own smile (GetVolatility()) is recognised by identity, smiles passed in are compared by value
+        return (smile_vec is self._volatilitySmile) or np.array_equal(smile_vec, self._volatilitySmile)
+    
+    
+    def UpdateSmileState(self) -> None:
+        # Re-derive strikes, moneyness and interpolation coefficients if the smile has changed since last time
+        if (self._strikeVersion != self._smileVersion):
+            self.CalcStrikeVector()
         pass
     
     
     def GetVolatility(self, strike):        
+        # strike may be a float or a NumPy array of strikes (an array of vols is returned)
         return self.GetVolatilityFromSmile(strike, self._volatilitySmile)
 
 
     def GetVolatilityFromSmile(self, strike, smile_vec):
         
-        self.SetVolatilitySmile(smile_vec)
-        atm_strike = self._strikes[2]
-        moneyness_vec = self._sd.GetLogMoneynessStrVec(self._strikes)
-        x = m.log(strike/atm_strike)
-
-        return self._volatilityInterpolation.GetInterpolatedValue(x, moneyness_vec, smile_vec)
+        if not self.IsCurrentSmile(smile_vec):
+            self.UpdateVolatilities(smile_vec)
+        self.UpdateSmileState()
+        
+        if (np.ndim(strike) > 0):
+            x = np.log(np.asarray(strike, dtype=float)/self._strikes[2])
+            return self._volatilityInterpolation.GetPreparedValueArray(x, self._moneyness, self._volatilitySmile, self._interpolationCoefficients)
+        
+        x = m.log(strike/self._strikes[2])
+        return self._volatilityInterpolation.GetPreparedValue(x, self._moneyness, self._volatilitySmile, self._interpolationCoefficients)
 
 
     def CalcStrikeVector(self) -> None:        
-        self._strikes = self._sd.GetStrikeVector(self._volatilitySmile)        
+        self.SetStrikeVector(self._sd.GetStrikeVector(self._volatilitySmile))
+        pass
+
+
+    def SetStrikeVector(self, strikes) -> None:
+        # Strikes of the current smile and the state derived from them
+        self._strikes = strikes
+        self._moneyness = self._sd.GetLogMoneynessStrVec(self._strikes)
+        self._interpolationCoefficients = self._volatilityInterpolation.Prepare(self._moneyness, self._volatilitySmile)
+        self._strikeVersion = self._smileVersion
         pass
 
 
+    def Recalibrate(self) -> None:
+        # Re-derive model parameters after the smile has changed. Nothing to calibrate for an interpolated smile
+        pass
+
+
+    def GetShockedSurface(self, smileShift):
+        # Copy of this surface with smileShift (parallel shift or a 5-vector of shifts) added to the quoted smile
+        # and recalibrated once. The surface itself is not modified
+        shocked = copy.deepcopy(self)
+        shocked.SetVolatilitySmile(np.asarray(self._volatilitySmile, dtype=float) + smileShift)
+        shocked.Recalibrate()
+        return shocked
+
+
+    def GetVolatilityStrikeDerivatives(self, strikes):
+        # Vols and their first and second strike derivatives (central differences of the vectorized GetVolatility())
+        h = 1.0e-4*strikes
+        vols = self.GetVolatility(np.concatenate([strikes - h, strikes, strikes + h])).reshape(3, -1)
+        return vols[1], (vols[2] - vols[0])/(2.0*h), (vols[2] - 2.0*vols[1] + vols[0])/(h*h)
+
+
+    def GetCallStrikeDerivatives(self, strikes):
+        # dC/dK and d2C/dK2 of the call prices on the smile: Black-Scholes strike Greeks plus the chain rule
+        # through the vol, d2C/dK2 = dualGamma + 2*dualVega*vol' + volga*vol'^2 + vega*vol''
+        vols, dvoldK, d2voldKdK = self.GetVolatilityStrikeDerivatives(strikes)
+        greeks = bs.GarmanKohlhagenGreeks(self._spot, strikes, self._expiryTerm, self._domesticDeposit, self._foreignDeposit, vols, bs.OptionType.Call)
+        dCdK = greeks.dualDelta + greeks.vega*dvoldK
+        d2CdKdK = greeks.dualGamma + 2.0*greeks.dualVega*dvoldK + greeks.volga*dvoldK*dvoldK + greeks.vega*d2voldKdK
+        return dCdK, d2CdKdK
+
+
+    def GetDensityStrikes(self, numberOfStrikes=401, standardDeviations=6.0):
+        # Strike grid uniform in log-moneyness, standardDeviations ATM standard deviations around the forward
+        width = standardDeviations*self._volatilitySmile[2]*m.sqrt(self._expiryTerm)
+        return self._forward*np.exp(np.linspace(-width, width, numberOfStrikes))
+
+
+    def GetRiskNeutralDensity(self, strikes=None):
+        """   Risk-neutral pdf and cdf of the spot at expiry on a strike grid (default GetDensityStrikes()), from the
+            strike derivatives of the call prices (Breeden-Litzenberger): pdf = exp(rd*T)*d2C/dK2 and 
+            cdf = 1 + exp(rd*T)*dC/dK. The derivatives are analytic for SABR surfaces, no prices are bumped.
+            The moments are integrated over the grid (trapezoidal rule) and normalised by the mass on the grid.
+        """
+        K = self.GetDensityStrikes() if strikes is None else np.atleast_1d(np.asarray(strikes, dtype=float))
+        dCdK, d2CdKdK = self.GetCallStrikeDerivatives(K)
+        compounding = m.exp(self._domesticDeposit*self._expiryTerm)
+        pdf = compounding*d2CdKdK
+        cdf = 1.0 + compounding*dCdK
+        
+        moments = np.full(4, np.nan)
+        if (len(K) > 1):
+            weights = np.zeros(len(K))
+            weights[:-1] += 0.5*np.diff(K)
+            weights[1:] += 0.5*np.diff(K)
+            weights *= pdf
+            mass = weights.sum()
+            mean = weights@K/mass
+            centred = K - mean
+            centred2 = centred*centred
+            variance = weights@centred2/mass
+            moments = np.array([mean, variance, weights@(centred2*centred)/mass/variance**1.5, weights@(centred2*centred2)/mass/(variance*variance)])
+        
+        return RiskNeutralDensity(K, pdf, cdf, moments, (pdf < 0.0) | (cdf < 0.0) | (cdf > 1.0))
+
+
 class SABRVolSurface(FXVolSurface):
     
-    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta=0.85):
+    def __init__(self, spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile, beta=0.85, calibrationWeights=(1.0, 1.0, 2.0, 1.0, 1.0), 
+                 calibrationMethod: CalibrationMethod = CalibrationMethod.Powell, warmStartTolerance=0.005, calibrationState=None):
         super().__init__(spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile)
 
         self._beta = beta              
+        self._forwardPow = pow(self._forward, 1.0 - beta)
         self._alpha0 = np.nan
         self._alpha = np.nan
         self._alphamin = np.nan
@@ -76,19 +354,62 @@ class SABRVolSurface(FXVolSurface):
         self._vovolmax = np.nan
         
         self._sabrrr25 = np.nan        
+        self._calibratedVersion = -1
+        self._calibrationMethod = calibrationMethod
         
-        self.CalcStrikeVector()
-        self._calibrationWeights = np.array([1.0, 1.0, 2.0, 1.0, 1.0])              
-        self.SabrCalibration()
+        # Recalibration is seeded from the previous parameters when no quote has moved more than warmStartTolerance
+        # since the last calibration (0.0 disables warm starts)
+        self._warmStartTolerance = warmStartTolerance
+        self._calibratedSmile = None
+        self._warmStarted = False
+        self._calibrationEvaluations = 0
+        
+        self._calibrationWeights = np.array(calibrationWeights, dtype=float)
+        
+        # A surface may be hydrated from a stored calibration (see GetCalibrationState()) instead of calibrating
+        if (calibrationState is None):
+            self.CalcStrikeVector()
+            self.SabrCalibration()
+        else:
+            self.SetCalibrationState(calibrationState)
         
         
     def GetVolatilityFromSmile(self, strike, smile_vec):
         
-        if (smile_vec != self._volatilitySmile).any():        
-            self.SetVolatilitySmile(smile_vec)        
-            self.SabrCalibration()
+        if not self.IsCurrentSmile(smile_vec):
+            self.UpdateVolatilities(smile_vec)
+        if (self._calibratedVersion != self._smileVersion):
+            self.Recalibrate()
+        
+        if (np.ndim(strike) > 0):
+            return self.SabrImpliedVolArray(np.asarray(strike, dtype=float), self._alpha, self._corr, self._vovol, self._beta)
             
         return self.SabrImpliedVol(strike, self._alpha, self._corr, self._vovol, self._beta)
+
+
+    def GetCalibrationState(self):
+        # Calibrated state of the surface as a dictionary of arrays: SABR parameters, their bounds and the strikes
+        return {'sabrParameters': np.array([self._alpha, self._corr, self._vovol]),
+                'parameterBounds': np.array([self._alphamin, self._alphamax, self._vovolmin, self._vovolmax]),
+                'strikes': np.array(self._strikes, dtype=float)}
+
+
+    def SetCalibrationState(self, calibrationState) -> None:
+        # Hydrate the surface from GetCalibrationState() of a surface calibrated to the same inputs (no calibration)
+        self._alpha, self._corr, self._vovol = [float(x) for x in calibrationState['sabrParameters']]
+        self._alphamin, self._alphamax, self._vovolmin, self._vovolmax = [float(x) for x in calibrationState['parameterBounds']]
+        self.SetStrikeVector(np.array(calibrationState['strikes'], dtype=float))
+        self._calibratedVersion = self._smileVersion
+        self._calibratedSmile = np.array(self._volatilitySmile, dtype=float)
+        self._warmStarted = False
+        pass
+
+
+    def Recalibrate(self) -> None:
+        self.UpdateSmileState()
+        if not self.SabrWarmStartCalibration():
+            self.SabrCalibration()
+        pass
   
 
     def SabrImplVolFwd(self, strike, forward, alpha, corr, vovol, beta):
@@ -96,17 +417,17 @@ class SABRVolSurface(FXVolSurface):
 
 
     def SabrImpliedVol(self, strike, alpha, corr, vovol, beta):  
-        forward = sfd.ForwardContinuousDeposit(self._spot, self._domesticDeposit, self._foreignDeposit, self._expiryTerm)      
-        return self.SabrImplVolFwd(strike, forward, alpha, corr, vovol, beta)
+        return self.SabrImplVolFwd(strike, self._forward, alpha, corr, vovol, beta)
 
 
     # The I0_JObloj(), the I0() method from "Fine-tune your smile - correction to Hagan et. al." by Jan Oblój
     def I0_JObloj(self, strike, forward, alpha, corr, vovol, beta):
         
         x = self.GetI0x(strike, forward)        
+        zeta = vovol * pow(forward, 1.0 - beta) / alpha
         
-        if (strike == forward):
-            retval = alpha * pow(strike, (beta - 1.0))
+        if (abs(x) * max(abs(zeta), 1.0 - beta) < SabrKernelForwardThreshold):
+            retval = alpha * pow(forward, (beta - 1.0)) * float(SabrForwardSeries(x, 1.0 - beta, corr, zeta, SabrKernelForwardOrder)[0])
         elif ((vovol == 0.0) and (beta != 1.0)):
             retval = x * alpha * (1.0 - beta) / (pow(forward, (1.0 - beta)) - pow(strike, (1.0 - beta)))
         else:            
@@ -117,6 +438,19 @@ class SABRVolSurface(FXVolSurface):
         return retval
 
 
+    def SabrImpliedVolArray(self, strikes, alpha, corr, vovol, beta):
+        # Vectorized SabrImpliedVol(), strikes and parameters broadcast (see SabrImpliedVolKernel())
+        forwardPow = self._forwardPow if isinstance(beta, (float, int)) and beta == self._beta else None
+        return SabrImpliedVolKernel(strikes, self._forward, self._expiryTerm, alpha, corr, vovol, beta, forwardPow)
+
+
+    def GetVolatilityStrikeDerivatives(self, strikes):
+        # Analytic strike derivatives of the SABR vol (SabrStrikeDerivatives())
+        if (self._calibratedVersion != self._smileVersion):
+            self.Recalibrate()
+        return SabrStrikeDerivatives(strikes, self._forward, self._expiryTerm, self._alpha, self._corr, self._vovol, self._beta)
+
+
     def GetI0z(self, strike, forward, alpha, vovol, beta):
         
         x = self.GetI0x(strike, forward)
@@ -145,6 +479,105 @@ class SABRVolSurface(FXVolSurface):
                 (2.0 - 3.0 * corr * corr) / 24.0 * vovol * vovol)
 
 
+    # Gradient of I0_JObloj() with respect to (alpha, corr, vovol). With D = ln((sqrt(1 - 2*corr*z + z^2) + z - corr)/(1 - corr))
+    # we have dD/dz = 1/sqrt(1 - 2*corr*z + z^2), dz/dalpha = -z/alpha and dz/dvovol = z/vovol
+    def GetI0Gradient(self, strike, forward, alpha, corr, vovol, beta):
+
+        x = self.GetI0x(strike, forward)
+        forwardPow = pow(forward, 1.0 - beta)
+
+        if (abs(x) * max(abs(vovol * forwardPow / alpha), 1.0 - beta) < SabrKernelForwardThreshold):
+            # Near the forward: I0 = alpha/F^(1-beta)*(1 + a1*x + a2*x^2 + O(x^3)), see SabrForwardSeries()
+            return np.array([(1.0 + 0.5 * (1.0 - beta) * x + ((1.0 - beta)**2 - (2.0 - 3.0 * corr * corr) * (vovol * forwardPow / alpha)**2) / 12.0 * x * x) / forwardPow,
+                             -0.5 * vovol * x - 0.5 * corr * vovol * vovol * forwardPow / alpha * x * x,
+                             -0.5 * corr * x + (2.0 - 3.0 * corr * corr) * vovol * forwardPow / (6.0 * alpha) * x * x])
+        elif ((vovol == 0.0) and (beta != 1.0)):
+            # I0 = I0(vovol=0)*(1 - corr*z/2 + O(z^2)) => dI0/dvovol = -corr*x/2 at vovol = 0
+            I0 = x * alpha * (1.0 - beta) / (pow(forward, (1.0 - beta)) - pow(strike, (1.0 - beta)))
+            return np.array([I0 / alpha, 0.0, -0.5 * corr * x])
+        else:
+            z = self.GetI0z(strike, forward, alpha, vovol, beta)
+            sqrtz = m.sqrt(1.0 - 2.0 * corr * z + z * z)
+            num = sqrtz + z - corr
+            D = m.log(num / (1.0 - corr))
+            dDdcorr = (-z / sqrtz - 1.0) / num + 1.0 / (1.0 - corr)
+
+            return np.array([vovol * x * z / (alpha * D * D * sqrtz),
+                             -vovol * x * dDdcorr / (D * D),
+                             x / D - x * z / (D * D * sqrtz)])
+
+
+    # Gradient of I1_Hagan() with respect to (alpha, corr, vovol)
+    def GetI1Gradient(self, strike, forward, alpha, corr, vovol, beta):
+
+        fk = pow(forward * strike, (1.0 - beta)/2.0)
+        return np.array([pow((beta - 1.0), 2.0)/12.0 * alpha / (fk * fk) + 1.0/4.0 * corr * vovol * beta / fk,
+                         1.0/4.0 * vovol * alpha * beta / fk - corr * vovol * vovol / 4.0,
+                         1.0/4.0 * corr * alpha * beta / fk + (2.0 - 3.0 * corr * corr) / 12.0 * vovol])
+
+
+    # Analytic gradient of the SABR implied vol, I0*(1 + I1*T), with respect to (alpha, corr, vovol)
+    def SabrImpliedVolGradient(self, strike, alpha, corr, vovol, beta):
+
+        forward = self._forward
+        I0 = self.I0_JObloj(strike, forward, alpha, corr, vovol, beta)
+        I1 = self.I1_Hagan(strike, forward, alpha, corr, vovol, beta)
+
+        return (self.GetI0Gradient(strike, forward, alpha, corr, vovol, beta) * (1.0 + I1 * self._expiryTerm) 
+                + I0 * self._expiryTerm * self.GetI1Gradient(strike, forward, alpha, corr, vovol, beta))
+
+
+    # Gradient (in alpha, corr, vovol) of half the weighted squared calibration error, J^T*W*(sabrvols - smile)
+    def SABRCalibGradient(self, params, strikes, smile_vec):
+
+        g = np.zeros(3)
+        for i in range(5):
+            sabrvol = self.SabrImpliedVol(strikes[i], params[0], params[1], params[2], self._beta)
+            g += self._calibrationWeights[i] * (sabrvol - smile_vec[i]) * self.SabrImpliedVolGradient(strikes[i], params[0], params[1], params[2], self._beta)
+
+        return g
+
+
+    def GetCalibrationSensitivity(self):
+        """   Sensitivity of the calibrated (alpha, corr, vovol) to the five smile quotes (3x5 matrix).
+            Implicit function theorem at the calibrated optimum: the calibration gradient g(params, smile) 
+            vanishes, so dparams/dsmile = -(dg/dparams)^-1 dg/dsmile. g itself is analytic (see 
+            SabrImpliedVolGradient()); its derivatives are taken by central differences of g, which 
+            includes the move of the five strikes with the quotes. No recalibration is performed.
+        """
+        params = np.array([self._alpha, self._corr, self._vovol])
+        smile_vec = np.array(self._volatilitySmile, dtype=float)
+
+        dgdp = np.zeros((3, 3))
+        for j in range(3):
+            h = 1.0e-6 * max(abs(params[j]), 1.0e-2)
+            up, down = params.copy(), params.copy()
+            up[j] += h
+            down[j] -= h
+            dgdp[:, j] = (self.SABRCalibGradient(up, self._strikes, smile_vec) - self.SABRCalibGradient(down, self._strikes, smile_vec)) / (2.0 * h)
+
+        dgdq = np.zeros((3, 5))
+        for j in range(5):
+            h = 1.0e-6
+            up, down = smile_vec.copy(), smile_vec.copy()
+            up[j] += h
+            down[j] -= h
+            dgdq[:, j] = (self.SABRCalibGradient(params, self._sd.GetStrikeVector(up), up) 
+                          - self.SABRCalibGradient(params, self._sd.GetStrikeVector(down), down)) / (2.0 * h)
+
+        return -np.linalg.solve(dgdp, dgdq)
+
+
+    def GetBucketedVega(self, strike, optionType: bs.OptionType):
+        # Sensitivity of the option value to each of the five quoted vols (10P, 25P, ATM, 25C, 10C) in one pass:
+        # vega(K)*dSABR(K)/dparams*dparams/dsmile, see GetCalibrationSensitivity()
+        vol = self.SabrImpliedVol(strike, self._alpha, self._corr, self._vovol, self._beta)
+        market = bs.MarketState(self._spot, self._domesticDeposit, self._foreignDeposit)
+        vega = bs.VanillaGreeks(market, bs.VanillaContract(strike, self._expiryTerm, optionType), vol).vega
+        
+        return vega * (self.SabrImpliedVolGradient(strike, self._alpha, self._corr, self._vovol, self._beta) @ self.GetCalibrationSensitivity())
+
+
     # This method established the differencence between the SABR implied vol and the ATM volatility for a given alpha    
     def FirstGuessAlphaMax(self, x):
     
@@ -182,16 +615,21 @@ class SABRVolSurface(FXVolSurface):
         # Initial guess and bounds on Max_Alpha given vovol found above and corr = 1.0 we find the upper bound of
         # alpha. We solve equation 9 in PP to establish this bound. Note, that as vovol is a guess then alpha may be
         # larger than the alpha established as the max alpha. For that reason we chooes alphamax = alpha *1.2
-        self._alpha0 = u.bisection(self.FirstGuessAlphaMax, self._ATMVol/2.0, self._ATMVol*3.0, 0.00001, 10)
+        self._alpha0 = u.brent(self.FirstGuessAlphaMax, self._ATMVol/2.0, self._ATMVol*3.0, 1.0e-8)
         self._alphamin = self._alpha0 * 0.7       
         self._alphamax = self._alpha0 * 1.2
                
+        # The vovol guess is scaled until the 25 delta risk reversal can be matched by a correlation in [-1, 1]
         self._corr0=0
+        attempts = 0
         while (self._corr0==0.0):
         
             try:                
-                self._corr0 = u.bisection(self.FirstGuessCorrelation, -0.9999, 0.99999, 0.00001, 10)                 
-            except:                
+                self._corr0 = u.brent(self.FirstGuessCorrelation, -0.9999, 0.99999, 1.0e-8)
+            except ValueError:                
+                attempts += 1
+                if (attempts > 50):
+                    raise ValueError('No first guess on the SABR correlation - SABRVolSurface->SABRFirstGuess')
                 if (abs(self._sabrrr25) < abs(self._rr25)):
                     self._vovol0 *= 1.2
                 else:
@@ -204,37 +642,105 @@ class SABRVolSurface(FXVolSurface):
 
 
     def SABRCalibObject(self, v):
+        # Weighted squared calibration error over the five strikes (one vectorized SABR evaluation)
+        r = self.SABRCalibResiduals(v)
+        return float(r @ r)
         
-        s = 0.0
-        for i in range(5):
-            
-            sabrvol = self.SabrImpliedVol(self._strikes[i], u.RealAxisToIntervalAB(v[0], self._alphamin, self._alphamax),
-                                                            u.RealAxisToIntervalAB(v[1], -0.9999, 0.9999),
-                                                            u.RealAxisToIntervalAB(v[2], self._vovolmin, self._vovolmax),
-                                                            self._beta)
-            s += pow(sabrvol - self._volatilitySmile[i], 2) * self._calibrationWeights[i]
-            
-        return s
+
+    def GetCalibrationParameters(self, v):
+        # Map the unbounded calibration variables v back to (alpha, corr, vovol)
+        return (u.RealAxisToIntervalAB(v[0], self._alphamin, self._alphamax),
+                u.RealAxisToIntervalAB(v[1], -0.9999, 0.9999),
+                u.RealAxisToIntervalAB(v[2], self._vovolmin, self._vovolmax))
+
+
+    def SABRCalibResiduals(self, v):
+        # Weighted residuals sqrt(w_i)*(sabrvol_i - smile_i), vectorized over the five strikes. Their sum of 
+        # squares is SABRCalibObject(v)
+        alpha, corr, vovol = self.GetCalibrationParameters(v)
+        sabrvols = self.SabrImpliedVolArray(np.asarray(self._strikes, dtype=float), alpha, corr, vovol, self._beta)
+        return np.sqrt(self._calibrationWeights) * (sabrvols - np.asarray(self._volatilitySmile, dtype=float))
+
+
+    def SABRCalibJacobian(self, v):
+        # Analytic Jacobian of SABRCalibResiduals(): dsabrvol/dparams (SabrImpliedVolGradient) times the 
+        # derivative of the interval maps, dx/dy = 1/(dy/dx) with y = (x-(a+b)/2)/((x-a)(x-b))
+        params = self.GetCalibrationParameters(v)
+        bounds = [(self._alphamin, self._alphamax), (-0.9999, 0.9999), (self._vovolmin, self._vovolmax)]
+        dxdy = np.zeros(3)
+        for j in range(3):
+            x, (a, b) = params[j], bounds[j]
+            dxdy[j] = ((x - a) * (x - b))**2 / ((x - a) * (x - b) - (x - (a + b) / 2.0) * (2.0 * x - a - b))
+        
+        gradients = np.array([self.SabrImpliedVolGradient(strike, params[0], params[1], params[2], self._beta) for strike in self._strikes])
+        return np.sqrt(self._calibrationWeights)[:, None] * gradients * dxdy[None, :]
         
 
     def SabrCalibration(self) -> None:
         
         # Pre-calibation - First guess on a solution
         self.SABRFirstGuess()
+        self.OptimizeCalibration(self._alpha0, self._corr0, self._vovol0)
+        self._warmStarted = False
+        
+        pass
+
+
+    def SabrWarmStartCalibration(self) -> bool:
+        """   Recalibrate from the previous (alpha, corr, vovol) and parameter bounds, skipping SABRFirstGuess(). 
+            Only attempted when no quote has moved more than _warmStartTolerance since the last calibration. 
+            Returns False (and the caller falls back to SabrCalibration()) if no warm start is possible, if the 
+            optimizer does not converge or if a parameter ends up at its bound.
+        """
+        if (self._calibratedSmile is None or self._warmStartTolerance <= 0.0 or 
+            np.max(np.abs(np.asarray(self._volatilitySmile, dtype=float) - self._calibratedSmile)) > self._warmStartTolerance):
+            return False
+        
+        # Quotes unchanged since the last calibration: the parameters still apply
+        if np.array_equal(self._volatilitySmile, self._calibratedSmile):
+            self._calibratedVersion = self._smileVersion
+            self._calibrationEvaluations = 0
+            self._warmStarted = True
+            return True
+        
+        bounds = [(self._alphamin, self._alphamax), (-0.9999, 0.9999), (self._vovolmin, self._vovolmax)]
+        if not all(a < x < b for x, (a, b) in zip([self._alpha, self._corr, self._vovol], bounds)):
+            return False
+        
+        if not self.OptimizeCalibration(self._alpha, self._corr, self._vovol):
+            return False
+        
+        for x, (a, b) in zip([self._alpha, self._corr, self._vovol], bounds):
+            if not (1.0e-4 < (x - a) / (b - a) < 1.0 - 1.0e-4):
+                return False
+        
+        self._warmStarted = True
+        return True
+
+
+    def OptimizeCalibration(self, alpha0, corr0, vovol0) -> bool:
+        # Minimise the calibration error from (alpha0, corr0, vovol0) within the current parameter bounds. 
+        # Returns True if the optimizer reports convergence
         
         # Calibrate, parameters mapped to R3
-        x0 = np.array([u.IntervalABToRealAxis(self._alpha0, self._alphamin, self._alphamax),
-                       u.IntervalABToRealAxis(self._corr0, -0.9999, 0.9999), 
-                       u.IntervalABToRealAxis(self._vovol0, self._vovolmin, self._vovolmax)])
-        x_min = so.minimize(self.SABRCalibObject, x0, method='Powell', tol=0.0000001)
+        x0 = np.array([u.IntervalABToRealAxis(alpha0, self._alphamin, self._alphamax),
+                       u.IntervalABToRealAxis(corr0, -0.9999, 0.9999), 
+                       u.IntervalABToRealAxis(vovol0, self._vovolmin, self._vovolmax)])
+        if (self._calibrationMethod == CalibrationMethod.LevenbergMarquardt):
+            x_min = so.least_squares(self.SABRCalibResiduals, x0, jac=self.SABRCalibJacobian, method='lm', xtol=1.0e-10, ftol=1.0e-12)
+        else:
+            x_min = so.minimize(self.SABRCalibObject, x0, method='Powell', tol=0.0000001)
         # print(x_min)
+        self._calibrationEvaluations = x_min.nfev
         
         # Map result back tp min/max intervals
         self._alpha = u.RealAxisToIntervalAB(x_min.x[0], self._alphamin, self._alphamax)
         self._corr = u.RealAxisToIntervalAB(x_min.x[1], -0.9999, 0.9999)
         self._vovol= u.RealAxisToIntervalAB(x_min.x[2], self._vovolmin, self._vovolmax)
+        self._calibratedVersion = self._smileVersion
+        self._calibratedSmile = np.array(self._volatilitySmile, dtype=float)
         
-        pass
+        return bool(x_min.success)
 
 
     
@@ -250,6 +756,127 @@ class Test_VolSurface(unittest.TestCase):
         self.assertEqual(round(vs.GetVolatility(90.123), 14), round(0.154975045068546, 14))
         self.assertEqual(round(vs.GetVolatility(94.123), 14), round(0.174995, 14))
         
+    def test_SmileStateCache(self):
+        vs_vec = np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995])        
+        vs = FXVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec, u.CubicSplineInterpolation(True))
+        vol = vs.GetVolatility(90.123)
+        strikes = vs._strikes
+        self.assertEqual(vs.GetVolatility(90.123), vol)
+        self.assertIs(vs._strikes, strikes)
+        
+        # A new smile invalidates the derived state once, and matches a surface built from that smile
+        shifted = vs_vec + 0.01
+        fresh = FXVolSurface(85.3678, 0.012, 0.0053, 61/365.0, shifted, u.CubicSplineInterpolation(True))
+        self.assertEqual(vs.GetVolatilityFromSmile(90.123, shifted), fresh.GetVolatility(90.123))
+        self.assertEqual(vs._strikeVersion, vs._smileVersion)
+        
+        # Smiles are copied in: editing the array passed in does not change the surface
+        shifted += 0.01
+        self.assertEqual(vs.GetVolatility(90.123), fresh.GetVolatility(90.123))
+        self.assertEqual(vs._strikeVersion, vs._smileVersion)
+
+    def test_GetVolatilityArray(self):
+        vs_vec = np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995])
+        strikes = np.linspace(75.0, 100.0, 51)
+        for surface in [FXVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec, u.CubicSplineInterpolation(True)),
+                        FXVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec, u.PiecewiseLinearInterpolation(False)),
+                        SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec)]:
+            strikes[25] = sfd.ForwardContinuousDeposit(85.3678, 0.012, 0.0053, 61/365.0)
+            vols = surface.GetVolatility(strikes)
+            self.assertEqual(vols.shape, strikes.shape)
+            for i in range(len(strikes)):
+                self.assertAlmostEqual(vols[i], surface.GetVolatility(float(strikes[i])), 14)
+
+    def test_SabrImpliedVolKernel(self):
+        sabr = SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995]))
+        strikes = np.array([78.0, 82.5, sabr._forward, 88.0, 95.0])
+        
+        # Many parameter sets at once, including vovol == 0 and beta == 1
+        alphas = np.array([[0.15], [0.2], [0.18], [0.1]])
+        corrs = np.array([[-0.3], [0.2], [0.0], [0.5]])
+        vovols = np.array([[1.2], [0.0], [0.6], [2.0]])
+        betas = np.array([[0.85], [0.5], [1.0], [0.85]])
+        vols = SabrImpliedVolKernel(strikes, sabr._forward, sabr._expiryTerm, alphas, corrs, vovols, betas)
+        self.assertEqual(vols.shape, (4, 5))
+        for i in range(4):
+            for j in range(5):
+                expected = sabr.SabrImpliedVol(strikes[j], alphas[i, 0], corrs[i, 0], vovols[i, 0], betas[i, 0])
+                self.assertAlmostEqual(vols[i, j], expected, 14)
+        
+    def test_LevenbergMarquardtCalibration(self):
+        vs_vec = np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995])
+        powell = SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec)
+        lm = SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec, calibrationMethod=CalibrationMethod.LevenbergMarquardt)
+        
+        # Analytic Jacobian of the residuals against central differences
+        v = np.array([0.3, -0.2, 0.1])
+        J = lm.SABRCalibJacobian(v)
+        for j in range(3):
+            h = np.zeros(3)
+            h[j] = 1.0e-6
+            dr = (lm.SABRCalibResiduals(v + h) - lm.SABRCalibResiduals(v - h)) / 2.0e-6
+            for i in range(5):
+                self.assertAlmostEqual(J[i, j], dr[i], 7)
+        
+        # Same fit as Powell with a fraction of the objective evaluations
+        self.assertAlmostEqual(lm._alpha, powell._alpha, 5)
+        self.assertAlmostEqual(lm._corr, powell._corr, 5)
+        self.assertAlmostEqual(lm._vovol, powell._vovol, 4)
+        self.assertLess(lm._calibrationEvaluations * 10, powell._calibrationEvaluations)
+        
+    def test_WarmStartRecalibration(self):
+        vs_vec = np.array([0.117885, 0.1191, 0.1300, 0.1501, 0.174995])
+        sabr = SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, vs_vec, calibrationMethod=CalibrationMethod.LevenbergMarquardt)
+        
+        # A tick of a few basis points is recalibrated from the previous parameters to the cold start fit
+        tick = vs_vec + np.array([0.0002, -0.0001, 0.0003, 0.0001, -0.0002])
+        vol = sabr.GetVolatilityFromSmile(88.0, tick)
+        cold = SABRVolSurface(85.3678, 0.012, 0.0053, 61/365.0, tick, calibrationMethod=CalibrationMethod.LevenbergMarquardt)
+        self.assertTrue(sabr._warmStarted)
+        self.assertLess(sabr._calibrationEvaluations, cold._calibrationEvaluations)
+        self.assertAlmostEqual(vol, cold.GetVolatility(88.0), 9)
+        
+        # A large move falls back to the full first guess
+        sabr.GetVolatilityFromSmile(88.0, vs_vec + 0.02)
+        self.assertFalse(sabr._warmStarted)
+        
+    def test_RiskNeutralDensity(self):
+        vs_vec = np.array([0.189, 0.171, 0.153, 0.146, 0.146])
+        for surface in [FXVolSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, vs_vec), SABRVolSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, vs_vec)]:
+            density = surface.GetRiskNeutralDensity()
+            self.assertFalse(density.arbitrage.any())
+            self.assertAlmostEqual(density.moments[0]/surface._forward, 1.0, 3)
+            
+            # Breeden-Litzenberger against finite differences of the call prices
+            K = density.strikes[100:300:20]
+            h = 1.0e-3
+            C = lambda k: bs.GarmanKohlhagenValue(11.7336, k, 30/365.0, 0.001671885, 0.061701683, surface.GetVolatility(k), bs.OptionType.Call)
+            compounding = m.exp(0.001671885*30/365.0)
+            self.assertLess(np.abs(compounding*(C(K + h) - 2.0*C(K) + C(K - h))/(h*h) - density.pdf[100:300:20]).max(), 1.0e-5)
+            self.assertLess(np.abs(1.0 + compounding*(C(K + h) - C(K - h))/(2.0*h) - density.cdf[100:300:20]).max(), 1.0e-6)
+        
+    def test_SabrNearForward(self):
+        # Near the forward the series replaces the cancelling closed forms: vol and strike derivatives against finite
+        # differences of the kernel (step 1e-3*F, evaluated by the closed form), the density has no spurious flags
+        surface = SABRVolSurface(11.7336, 0.001671885, 0.061701683, 30/365.0, np.array([0.189, 0.171, 0.153, 0.146, 0.146]))
+        F, T, parameters = surface._forward, surface._expiryTerm, (surface._alpha, surface._corr, surface._vovol, surface._beta)
+        h = 1.0e-3*F
+        for K in F*np.array([1.0 + 1.0e-8, 1.0 - 1.0e-8, 1.0 + 1.0e-15, 1.0 - 1.0e-15, 1.0]):
+            v = SabrImpliedVolKernel(K + np.array([-2.0*h, -h, 0.0, h, 2.0*h]), F, T, *parameters)
+            dvdK = (8.0*(v[3] - v[1]) - (v[4] - v[0]))/(12.0*h)
+            d2vdK2 = (16.0*(v[3] + v[1]) - (v[4] + v[0]) - 30.0*v[2])/(12.0*h*h)
+            vol, dvoldK, d2voldKdK = SabrStrikeDerivatives(K, F, T, *parameters)
+            self.assertAlmostEqual(vol, v[2], 14)
+            self.assertAlmostEqual(vol, SabrImpliedVolKernel(F, F, T, *parameters) + dvoldK*(K - F), 14)
+            self.assertAlmostEqual(dvoldK/dvdK, 1.0, 7)
+            self.assertAlmostEqual(d2voldKdK/d2vdK2, 1.0, 6)
+            self.assertAlmostEqual(surface.SabrImpliedVol(float(K), *parameters[:3], surface._beta), vol, 14)
+        
+        density = surface.GetRiskNeutralDensity(F*np.array([0.95, 1.0 - 4.0e-16, 1.0, 1.0 + 4.0e-16, 1.05]))
+        self.assertFalse(density.arbitrage.any())
+        self.assertAlmostEqual(density.pdf[1]/density.pdf[2], 1.0, 12)
+        self.assertAlmostEqual(density.pdf[3]/density.pdf[2], 1.0, 12)
+
     def test_SABR(self):
         # Todo Freitag!!
         pass 
@@ -0,0 +1,202 @@
+"""
+ FX Vanilla option tools: Multi-expiry volatility surface with lazy per-tenor calibration
+
+"""
+import collections
+import math as m
+import numpy as np
+import SABRWing as sw
+import DepositCurve as dc
+import unittest
+
+
+class TermStructureVolSurface:
+    """   Volatility surface over many expiries. Holds the quoted smiles (10dput, 25dput, atm, 25dcall, 10dcall)
+        for each tenor; a tenor (slice) is calibrated on first use only and kept in a bounded LRU cache of at
+        most maxCachedSlices calibrated slices (least recently used slices are dropped and re-calibrated on
+        demand). Slices are SABRWingSurface objects by default, any FXVolSurface class taking
+        (spot, domesticDeposit, foreignDeposit, expiryTerm, volatilitySmile) may be given as sliceClass.
+
+        Between tenors the total variance vol^2*T is interpolated linearly in time at constant forward
+        moneyness ln(K/F(T)). Before the first tenor and after the last one the vol at the same forward
+        moneyness is held flat. Deposits are given per tenor or as DepositCurve objects; tenor deposits are
+        interpolated linearly in r*T (log discount factor), see DepositCurve.
+    """
+
+    def __init__(self, spot, expiryTerms, domesticDeposits, foreignDeposits, volatilitySmiles, sliceClass=sw.SABRWingSurface, maxCachedSlices=12):
+
+        self._expiryTerms = np.asarray(expiryTerms, dtype=float)
+
+        if (self._expiryTerms.ndim != 1 or len(self._expiryTerms) == 0 or (self._expiryTerms <= 0.0).any() or (np.diff(self._expiryTerms) <= 0.0).any()):
+            raise ValueError('Expiry terms must be positive and strictly increasing - TermStructureVolSurface')
+        if (maxCachedSlices < 2):
+            raise ValueError('maxCachedSlices must be at least 2 (the slices bracketing an expiry) - TermStructureVolSurface')
+
+        numberOfTenors = len(self._expiryTerms)
+        self._spot = spot
+        curves = [deposits if isinstance(deposits, dc.DepositCurve) else dc.DepositCurve(self._expiryTerms, deposits)
+                  for deposits in [domesticDeposits, foreignDeposits]]
+        self._forwardCurve = dc.ForwardCurve(spot, *curves)
+        self._domesticDeposits = curves[0].GetDeposit(self._expiryTerms)
+        self._foreignDeposits = curves[1].GetDeposit(self._expiryTerms)
+        self._volatilitySmiles = np.array(volatilitySmiles, dtype=float).reshape(numberOfTenors, 5)
+        self._forwards = self._forwardCurve.GetForward(self._expiryTerms)
+        self._sliceClass = sliceClass
+        self._maxCachedSlices = maxCachedSlices
+        self._slices = collections.OrderedDict()
+        self._numberOfCalibrations = 0
+
+
+    def GetNumberOfTenors(self):
+        return len(self._expiryTerms)
+
+
+    def GetSlice(self, index):
+        # Calibrated surface of tenor index (calibrated on first use, least recently used slice evicted)
+        if (index in self._slices):
+            self._slices.move_to_end(index)
+            return self._slices[index]
+
+        # The slice gets its own copy of the quotes, so SetVolatilitySmile() cannot modify slices handed out before
+        surface = self._sliceClass(self._spot, self._domesticDeposits[index], self._foreignDeposits[index],
+                                   self._expiryTerms[index], self._volatilitySmiles[index].copy())
+        self._numberOfCalibrations += 1
+        self._slices[index] = surface
+        if (len(self._slices) > self._maxCachedSlices):
+            self._slices.popitem(last=False)
+
+        return surface
+
+
+    def SetVolatilitySmile(self, index, volatilitySmile) -> None:
+        # New quotes for one tenor. The calibrated slice (if any) is dropped and re-calibrated on next use
+        self._volatilitySmiles[index] = volatilitySmile
+        self._slices.pop(index, None)
+        pass
+
+
+    def GetDeposits(self, expiryTerm):
+        # Domestic and foreign deposit for expiryTerm (float or array)
+        return self._forwardCurve.GetDomesticCurve().GetDeposit(expiryTerm), self._forwardCurve.GetForeignCurve().GetDeposit(expiryTerm)
+
+
+    def GetForward(self, expiryTerm):
+        # Forward for expiryTerm (float: cached, array: one vectorized call), see ForwardCurve
+        return self._forwardCurve.GetForward(expiryTerm)
+
+
+    def GetVolatility(self, expiryTerm, strike):
+        """   Volatility for (expiryTerm, strike). Both may be floats or NumPy arrays (broadcast against each
+            other). Only the slices bracketing the requested expiries are calibrated.
+        """
+        scalar = (np.ndim(expiryTerm) == 0 and np.ndim(strike) == 0)
+        T, K = np.broadcast_arrays(np.asarray(expiryTerm, dtype=float), np.asarray(strike, dtype=float))
+        T, K = T.ravel(), K.ravel()
+
+        if (T <= 0.0).any():
+            raise ValueError('Expiry term must be positive - TermStructureVolSurface->GetVolatility')
+
+        logMoneyness = np.log(K / self.GetForward(T))
+        numberOfTenors = self.GetNumberOfTenors()
+
+        # Bracketing tenors [lower, upper] and the weight of upper in total variance (0 or 1 outside the quoted tenors)
+        upper = np.clip(np.searchsorted(self._expiryTerms, T, side='left'), 0, numberOfTenors - 1)
+        lower = np.clip(upper - 1, 0, numberOfTenors - 1)
+        lower = np.where(T <= self._expiryTerms[0], upper, lower)
+        TLow, TUp = self._expiryTerms[lower], self._expiryTerms[upper]
+        weight = np.where(upper == lower, 1.0, (T - TLow) / np.where(upper == lower, 1.0, TUp - TLow))
+
+        varianceLow, varianceUp = self.GetSliceVariances(lower, upper, logMoneyness, weight < 1.0, weight > 0.0)
+
+        # Inside the quoted tenors the total variance is linear in time, outside the vol is flat
+        inside = (T >= self._expiryTerms[0]) & (T <= self._expiryTerms[-1])
+        totalVariance = (1.0 - weight) * varianceLow * TLow + weight * varianceUp * TUp
+        vols = np.where(inside, np.sqrt(totalVariance / T), np.sqrt(varianceUp))
+
+        if (scalar):
+            return float(vols[0])
+        return vols.reshape(np.broadcast(np.asarray(expiryTerm), np.asarray(strike)).shape)
+
+
+    def GetSliceVariances(self, lower, upper, logMoneyness, neededLower, neededUpper):
+        # Squared slice vols of the lower and upper tenors at the given forward moneyness. Each tenor that is
+        # needed is visited once (one vectorized call for both sides), so no slice is calibrated twice in a call
+        varianceLower = np.zeros(len(lower))
+        varianceUpper = np.zeros(len(upper))
+
+        for index in np.unique(np.concatenate([lower[neededLower], upper[neededUpper]])):
+            maskLower = neededLower & (lower == index)
+            maskUpper = neededUpper & (upper == index)
+            mask = maskLower | maskUpper
+            vols = np.zeros(len(lower))
+            vols[mask] = self.GetSlice(index).GetVolatility(self._forwards[index] * np.exp(logMoneyness[mask]))
+            varianceLower[maskLower] = vols[maskLower] ** 2
+            varianceUpper[maskUpper] = vols[maskUpper] ** 2
+
+        return varianceLower, varianceUpper
+
+
+
+#//     Unit-Test: Term structure volatility surface
+class Test_TermStructure(unittest.TestCase):
+
+    def test_TermStructureVolSurface(self):
+        spot = 11.7336
+        expiryTerms = np.array([7/365.0, 30/365.0, 181/365.0, 365/365.0])
+        rd = np.array([0.000901339, 0.001671885, 0.003722718, 0.00503213])
+        rf = np.array([0.056517435, 0.061701683, 0.061610374, 0.064996107])
+        smiles = np.array([[0.188, 0.172, 0.155, 0.148, 0.148],
+                           [0.189, 0.171, 0.153, 0.146, 0.146],
+                           [0.233, 0.200, 0.172, 0.161, 0.158],
+                           [0.250, 0.209, 0.179, 0.171, 0.169]])
+        ts = TermStructureVolSurface(spot, expiryTerms, rd, rf, smiles, maxCachedSlices=2)
+        self.assertEqual(ts._numberOfCalibrations, 0)
+
+        # On a quoted tenor the slice vol is returned and only that slice is calibrated
+        slice30 = sw.SABRWingSurface(spot, rd[1], rf[1], expiryTerms[1], smiles[1])
+        strikes = np.array([10.5, 11.3, 11.7, 12.4])
+        vols = ts.GetVolatility(expiryTerms[1], strikes)
+        for i in range(len(strikes)):
+            self.assertAlmostEqual(vols[i], slice30.GetVolatility(strikes[i]), 12)
+        self.assertEqual(ts._numberOfCalibrations, 1)
+
+        # Between tenors: total variance linear in time at constant forward moneyness
+        T = 90/365.0
+        slice181 = sw.SABRWingSurface(spot, rd[2], rf[2], expiryTerms[2], smiles[2])
+        k = m.log(11.5/ts.GetForward(T))
+        w = (T - expiryTerms[1])/(expiryTerms[2] - expiryTerms[1])
+        variance = ((1.0 - w)*slice30.GetVolatility(ts._forwards[1]*m.exp(k))**2*expiryTerms[1]
+                    + w*slice181.GetVolatility(ts._forwards[2]*m.exp(k))**2*expiryTerms[2])
+        self.assertAlmostEqual(ts.GetVolatility(T, 11.5), m.sqrt(variance/T), 12)
+        self.assertEqual(ts._numberOfCalibrations, 2)
+
+        # (expiry, strike) arrays, LRU bounded at two slices
+        vols = ts.GetVolatility(np.array([3/365.0, 90/365.0, 2.0]), np.array([11.5, 11.5, 11.5]))
+        self.assertAlmostEqual(vols[1], m.sqrt(variance/T), 12)
+        self.assertEqual(len(ts._slices), 2)
+        self.assertAlmostEqual(ts.GetVolatility(expiryTerms[1], 11.5), slice30.GetVolatility(11.5), 12)
+
+        # Expiries across all tenors in one call calibrate each slice once, at least two slices are cached
+        calibrations = ts._numberOfCalibrations
+        ts.GetVolatility(np.array([3/365.0, 20/365.0, 90/365.0, 0.7, 2.0]), 11.5)
+        self.assertLessEqual(ts._numberOfCalibrations - calibrations, 4)
+        with self.assertRaises(ValueError):
+            TermStructureVolSurface(spot, expiryTerms, rd, rf, smiles, maxCachedSlices=1)
+
+    def test_SetVolatilitySmile(self):
+        # A slice handed out before new quotes keeps its own smile and vols
+        expiryTerms = np.array([30/365.0, 181/365.0])
+        smiles = np.array([[0.189, 0.171, 0.153, 0.146, 0.146], [0.233, 0.200, 0.172, 0.161, 0.158]])
+        ts = TermStructureVolSurface(11.7336, expiryTerms, 0.001671885, 0.061701683, smiles)
+        held = ts.GetSlice(0)
+        strikes = np.array([10.5, 11.7, 12.4])
+        vols = held.GetVolatility(strikes)
+
+        ts.SetVolatilitySmile(0, np.array([0.200, 0.180, 0.160, 0.150, 0.150]))
+        self.assertTrue(np.array_equal(held._volatilitySmile, smiles[0]))
+        self.assertTrue(np.array_equal(held.GetVolatility(strikes), vols))
+        self.assertTrue(np.array_equal(ts.GetSlice(0)._volatilitySmile, [0.200, 0.180, 0.160, 0.150, 0.150]))
+
+
+if __name__ == '__main__':
+    unittest.main()